@@ -12,6 +12,8 @@ https://docs.djangoproject.com/en/3.2/ref/settings/
 import os
 from pathlib import Path
 
+from django.core.exceptions import ImproperlyConfigured
+
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
@@ -40,6 +42,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'pneumonia_app.middleware.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -53,7 +56,8 @@ ROOT_URLCONF = 'PulmoInsight.urls'
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        # the Django backend, recording template render times (see pneumonia_app/metrics.py)
+        'BACKEND': 'pneumonia_app.templating.DjangoTemplates',
         'DIRS': [os.path.join(BASE_DIR, 'templates')],
         'APP_DIRS': True,
         'OPTIONS': {
@@ -73,17 +77,68 @@ TEMPLATES = [
 
 WSGI_APPLICATION = 'PulmoInsight.wsgi.application'
 
+# Builds the test database from the models, migrations are not committed
+TEST_RUNNER = 'pneumonia_app.test_runner.TestRunner'
+
 # Database
 # https://docs.djangoproject.com/en/3.2/ref/settings/#databases
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
-        'OPTIONS': {},
-    }
+# The database profile is picked from the environment:
+#   PULMOINSIGHT_DB_ENGINE=sqlite (default) runs a single-node SQLite database tuned for
+#   concurrent readers and writers (WAL journal, busy timeout, synchronous=NORMAL).
+#   PULMOINSIGHT_DB_ENGINE=postgresql connects to PostgreSQL with the PULMOINSIGHT_DB_* settings
+#   below and keeps connections open across requests (or pools them, see PULMOINSIGHT_DB_POOL).
+# `python manage.py benchmark_db_writes` compares the write throughput of the profiles.
+DATABASE_ENGINE = os.environ.get('PULMOINSIGHT_DB_ENGINE', 'sqlite')
+
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': 20000,
 }
 
+if DATABASE_ENGINE == 'postgresql':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.environ.get('PULMOINSIGHT_DB_NAME', 'pulmoinsight'),
+            'USER': os.environ.get('PULMOINSIGHT_DB_USER', ''),
+            'PASSWORD': os.environ.get('PULMOINSIGHT_DB_PASSWORD', ''),
+            'HOST': os.environ.get('PULMOINSIGHT_DB_HOST', ''),
+            'PORT': os.environ.get('PULMOINSIGHT_DB_PORT', ''),
+            # persistent connections, checked before reuse
+            'CONN_MAX_AGE': int(os.environ.get('PULMOINSIGHT_DB_CONN_MAX_AGE', 600)),
+            'CONN_HEALTH_CHECKS': True,
+            'OPTIONS': {},
+        }
+    }
+
+    # PULMOINSIGHT_DB_POOL=<max size> uses psycopg's connection pool (Django 5.1+). It replaces
+    # persistent connections; on older Django versions run PgBouncer in front of the database.
+    DATABASE_POOL_SIZE = int(os.environ.get('PULMOINSIGHT_DB_POOL', 0))
+    if DATABASE_POOL_SIZE:
+        import django
+
+        if django.VERSION < (5, 1):
+            raise ImproperlyConfigured('PULMOINSIGHT_DB_POOL requires Django 5.1 or later, use PgBouncer instead')
+        DATABASES['default']['CONN_MAX_AGE'] = 0
+        DATABASES['default']['OPTIONS']['pool'] = {'min_size': 1, 'max_size': DATABASE_POOL_SIZE}
+elif DATABASE_ENGINE == 'sqlite':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.environ.get('PULMOINSIGHT_DB_NAME', BASE_DIR / 'db.sqlite3'),
+            'OPTIONS': {
+                # seconds a writer waits for the lock before 'database is locked'
+                'timeout': 20,
+            },
+            # applied to every new connection by pneumonia_app.db.configure_sqlite
+            'PRAGMAS': SQLITE_PRAGMAS,
+        }
+    }
+else:
+    raise ImproperlyConfigured(f'Unknown PULMOINSIGHT_DB_ENGINE: {DATABASE_ENGINE}')
+
 # Password validation
 # https://docs.djangoproject.com/en/3.2/ref/settings/#auth-password-validators
 
@@ -126,9 +181,202 @@ STATICFILES_DIRS = [
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media').replace('\\', '/')
 MEDIA_URL = '/media/'  # url映射
 
+# Uploaded images get WebP/JPEG thumbnails of at most IMAGE_THUMBNAIL_SIZE pixels per side
+# and a model-ready grayscale copy, stored in a 'derivatives' folder next to the original.
+IMAGE_THUMBNAIL_SIZE = 512
+IMAGE_THUMBNAIL_QUALITY = 80
+
+# Images are decoded to grayscale. JPEGs whose shorter side is at least twice
+# IMAGE_DECODE_MIN_SIDE are decoded at 1/2, 1/4 or 1/8 scale, which is still larger than the
+# thumbnails and the model input. Images with more than IMAGE_MAX_PIXELS pixels are rejected
+# from their header, before any pixel is decoded.
+IMAGE_DECODE_MIN_SIDE = IMAGE_THUMBNAIL_SIZE
+IMAGE_MAX_PIXELS = 64 * 1024 * 1024
+
+# Large images can be uploaded in chunks of CHUNKED_UPLOAD_CHUNK_SIZE bytes and resumed after a
+# dropped connection. Partial uploads are kept in CHUNKED_UPLOAD_DIR (on the same disk as
+# MEDIA_ROOT) and removed after CHUNKED_UPLOAD_EXPIRY seconds without progress.
+CHUNKED_UPLOAD_DIR = os.path.join(MEDIA_ROOT, '.uploads')
+CHUNKED_UPLOAD_CHUNK_SIZE = 1024 * 1024
+CHUNKED_UPLOAD_MAX_SIZE = 200 * 1024 * 1024
+CHUNKED_UPLOAD_EXPIRY = 60 * 60 * 24
+
+# ONNX model inference
+# The model is loaded once per worker process and reloaded when the file changes on disk.
+
+INFERENCE_MODEL_PATH = os.environ.get('PULMOINSIGHT_MODEL_PATH',
+                                      os.path.join(BASE_DIR, 'static', 'model_data', 'resnet18-lite.onnx'))
+
+# One of 'fp32', 'int8-dynamic', 'int8-static' or 'fp16'. Variants other than fp32 are
+# built next to INFERENCE_MODEL_PATH by `python manage.py quantize_model`.
+INFERENCE_MODEL_VARIANT = 'fp32'
+
+# Models a request can pick by name (the `model` parameter of the prediction API and of the
+# analyze page). Every entry may set 'path' and 'variant' (default INFERENCE_MODEL_PATH and
+# INFERENCE_MODEL_VARIANT), 'version' (a prefix of the model's content hash it is pinned to;
+# a different file on disk is refused), 'image_size', 'mean'/'std' (normalization after
+# scaling to [0, 1]) and 'classes' (labels of the outputs, in order).
+INFERENCE_DEFAULT_MODEL = 'resnet18-lite'
+INFERENCE_MODELS = {
+    'resnet18-lite': {
+        'image_size': 224,
+        'classes': ('normal', 'pneumonia'),
+    },
+}
+
+# A candidate model from INFERENCE_MODELS can shadow the default model: it also predicts a
+# random INFERENCE_SHADOW_SAMPLE_RATE fraction of the images, on a background thread, and its
+# agreement with the default model is reported on /metrics. Comparisons beyond
+# INFERENCE_SHADOW_MAX_PENDING waiting ones are skipped.
+INFERENCE_SHADOW_MODEL = None
+INFERENCE_SHADOW_SAMPLE_RATE = 0.1
+INFERENCE_SHADOW_MAX_PENDING = 16
+
+# Feature store: the IMAGE_SIZE x IMAGE_SIZE uint8 array every MedicalRecord image is
+# preprocessed to is kept in memory-mapped .npy shards of FEATURE_STORE_SHARD_SIZE rows in
+# FEATURE_STORE_DIR (default MEDIA_ROOT/.features), indexed by the StoredFeatures table. It
+# is filled when a record is uploaded, and the diagnose page and `score_images --records`
+# read it instead of decoding the original again.
+FEATURE_STORE_ENABLED = True
+FEATURE_STORE_DIR = None
+FEATURE_STORE_SHARD_SIZE = 1024
+
+# Warm-up when a process starts (AppConfig.ready): load the default and shadow models and run
+# each once on a blank image, so the first request does not pay for the imports, the session
+# build and onnxruntime's first-run allocations. 'off', 'sync' (before the process serves
+# requests) or 'background' (on a thread, requests arriving meanwhile wait for the model load).
+# Set per process through the environment, e.g. PULMOINSIGHT_WARMUP=sync for the web workers
+# while management commands keep starting fast.
+INFERENCE_WARMUP = os.environ.get('PULMOINSIGHT_WARMUP', 'off')
+
+# onnxruntime SessionOptions, see https://onnxruntime.ai/docs/performance/tune-performance/
+# Thread counts of 0 let onnxruntime decide. graph_optimization_level is one of
+# 'disabled', 'basic', 'extended' or 'all'; execution_mode is 'sequential' or 'parallel'.
+INFERENCE_SESSION_OPTIONS = {
+    'intra_op_num_threads': 0,
+    'inter_op_num_threads': 0,
+    'graph_optimization_level': 'all',
+    'execution_mode': 'sequential',
+    'enable_cpu_mem_arena': True,
+    'enable_mem_pattern': True,
+}
+
+# The optimized graph is saved here on first load and reused by later worker processes.
+# Set to None (or PULMOINSIGHT_OPTIMIZED_MODEL_DIR to an empty string) to optimize on every load.
+INFERENCE_OPTIMIZED_MODEL_DIR = os.environ.get('PULMOINSIGHT_OPTIMIZED_MODEL_DIR',
+                                               os.path.join(BASE_DIR, 'cache', 'onnx')) or None
+
+# Bind inputs and preallocated output buffers with IOBinding instead of session.run.
+INFERENCE_IO_BINDING = False
+
+# Concurrent requests are collected for up to INFERENCE_BATCH_MAX_WAIT_MS milliseconds
+# (or until INFERENCE_BATCH_MAX_SIZE images are pending) and run as one batch.
+INFERENCE_BATCHING = True
+INFERENCE_BATCH_MAX_SIZE = 8
+INFERENCE_BATCH_MAX_WAIT_MS = 5
+
+# Predictions are cached by image content hash and model version, first in a per-process
+# LRU of INFERENCE_CACHE_SIZE entries and then in the INFERENCE_CACHE_ALIAS cache below.
+INFERENCE_CACHE_SIZE = 256
+INFERENCE_CACHE_ALIAS = 'predictions'
+
+# Uploaded medical records are scored in the background by a local pool of
+# INFERENCE_JOB_WORKERS threads. Failed jobs are retried INFERENCE_JOB_MAX_RETRIES times,
+# waiting INFERENCE_JOB_RETRY_DELAY seconds (doubled on every attempt) in between.
+INFERENCE_JOB_WORKERS = 2
+INFERENCE_JOB_MAX_RETRIES = 3
+INFERENCE_JOB_RETRY_DELAY = 5
+# Jobs left pending or running by a stopped or crashed process are queued again when a process
+# starts with INFERENCE_JOB_REQUEUE. Enable it for one process only (PULMOINSIGHT_REQUEUE_JOBS=1),
+# every process that starts with it runs the leftover jobs.
+INFERENCE_JOB_REQUEUE = os.environ.get('PULMOINSIGHT_REQUEUE_JOBS', '0') == '1'
+
+# Async views (doctor_analyze, diagnose_patient, the prediction API) run decoding and inference
+# on a pool of INFERENCE_ASYNC_WORKERS threads, so an ASGI worker keeps serving other requests
+# meanwhile. Once INFERENCE_ASYNC_MAX_PENDING calls are running or queued, further requests get
+# a 503 telling the client to retry after INFERENCE_ASYNC_RETRY_AFTER seconds.
+INFERENCE_ASYNC_WORKERS = 4
+INFERENCE_ASYNC_MAX_PENDING = 32
+INFERENCE_ASYNC_RETRY_AFTER = 2
+
+# The batch prediction API (api/predict/batch/) accepts at most INFERENCE_API_MAX_BATCH images
+# and INFERENCE_API_MAX_BODY_SIZE bytes of image data per request.
+INFERENCE_API_MAX_BATCH = 32
+INFERENCE_API_MAX_BODY_SIZE = 100 * 1024 * 1024
+# Clients of the prediction API send 'Authorization: Bearer <key>' with one of INFERENCE_API_KEYS
+# (comma separated in PULMOINSIGHT_API_KEYS) and need no CSRF token. Logged-in browser sessions
+# can call it too, with the CSRF token like any form post of the site.
+INFERENCE_API_KEYS = [key for key in os.environ.get('PULMOINSIGHT_API_KEYS', '').split(',') if key]
+
+# The doctor dashboard counters live in the DASHBOARD_CACHE_ALIAS cache. They are updated
+# as diagnosis records change and recounted from the database at least every
+# DASHBOARD_STATS_TIMEOUT seconds. Use a shared cache (e.g. Redis) when running several processes.
+DASHBOARD_CACHE_ALIAS = 'default'
+DASHBOARD_STATS_TIMEOUT = 300
+
+# Community board pages are cached in COMMUNITY_CACHE_ALIAS for up to COMMUNITY_FEED_TIMEOUT
+# seconds and dropped as soon as a post or comment of the board changes. The local-memory cache
+# only drops them in the process that made the change, other processes may show a page up to
+# COMMUNITY_FEED_TIMEOUT seconds old. Use a shared cache (e.g. Redis) when running several processes.
+COMMUNITY_CACHE_ALIAS = 'default'
+COMMUNITY_FEED_TIMEOUT = 600
+
+# Request, database and inference metrics are served in the Prometheus text format on
+# /metrics to the addresses in METRICS_ALLOWED_IPS. Metrics are kept per worker process.
+METRICS_ENABLED = True
+METRICS_ALLOWED_IPS = ('127.0.0.1', '::1')
+
+# Logging
+# https://docs.djangoproject.com/en/4.2/topics/logging/
+# Set PULMOINSIGHT_LOG_LEVEL=DEBUG to log every prediction; the inference path only logs at DEBUG.
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'default': {
+            'format': '{asctime} {levelname} {name} {message}',
+            'style': '{',
+        },
+    },
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+            'formatter': 'default',
+        },
+    },
+    'loggers': {
+        'pneumonia_app': {
+            'handlers': ['console'],
+            'level': os.environ.get('PULMOINSIGHT_LOG_LEVEL', 'INFO'),
+            'propagate': False,
+        },
+    },
+}
+
+# Cache
+# https://docs.djangoproject.com/en/4.2/topics/cache/
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'predictions': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(BASE_DIR, 'cache', 'predictions'),
+        'TIMEOUT': 60 * 60 * 24 * 30,
+        'OPTIONS': {
+            'MAX_ENTRIES': 100000,
+        },
+    },
+}
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/3.2/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 AUTH_USER_MODEL = "pneumonia_app.CustomUser"
+
+# The user of each request is loaded together with their patient/doctor profile
+AUTHENTICATION_BACKENDS = ['pneumonia_app.backends.ProfileBackend']
@@ -0,0 +1,280 @@
+import base64
+import binascii
+import io
+import json
+import os
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.http import JsonResponse
+from django.middleware.csrf import CsrfViewMiddleware
+from django.utils.crypto import constant_time_compare
+
+from .async_inference import InferenceQueueFull, busy_response, run_in_executor
+from .decoding import ImageTooLarge, InvalidImage
+from .models import UploadedImage
+
+# onnx_inference and prediction_cache load onnxruntime and OpenCV, they are imported on the first
+# API call rather than with the URLconf
+
+NDJSON_CONTENT_TYPES = ('application/x-ndjson', 'application/ndjson', 'application/jsonl')
+
+
+class BadRequest(Exception):
+    """
+    A request the API cannot read, with the HTTP status to answer it with.
+    """
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def _error(message, status):
+    return JsonResponse({'error': message}, status=status)
+
+
+def _csrf_exempt(view):
+    # django.views.decorators.csrf.csrf_exempt wraps async views in a sync function before Django 5.0
+    view.csrf_exempt = True
+    return view
+
+
+def _api_key(request):
+    scheme, _, key = request.headers.get('Authorization', '').partition(' ')
+    return key.strip() if scheme.lower() == 'bearer' else None
+
+
+async def _authenticate(request):
+    """
+    Returns the error response for a request that may not use the API, else None.
+
+    Requests with an 'Authorization: Bearer <key>' header need one of settings.INFERENCE_API_KEYS.
+    Others need a logged-in session and, like every form post of the site, the CSRF token.
+    """
+    key = _api_key(request)
+    if key is not None:
+        if any(constant_time_compare(key, allowed) for allowed in settings.INFERENCE_API_KEYS):
+            return None
+        return _error('Invalid API key.', 401)
+
+    if not await sync_to_async(lambda: request.user.is_authenticated)():
+        return _error('Authentication required.', 401)
+    # the views are exempt from the middleware's check for the key clients, sessions are checked here
+    if CsrfViewMiddleware(lambda request: None).process_view(request, None, (), {}) is not None:
+        return _error('CSRF verification failed.', 403)
+    return None
+
+
+def _probabilities(spec, inference_probabilities):
+    return dict(zip(spec.classes, (float(p) for p in inference_probabilities.reshape(-1))))
+
+
+def _get_spec(request):
+    from .onnx_inference import get_model_spec
+
+    # the model may be picked in the query string or the form
+    return get_model_spec(request.GET.get('model') or request.POST.get('model') or None)
+
+
+def _predict(image_file, spec):
+    # runs on the bounded executor: decode, model run and cache lookup all block
+    from .onnx_inference import get_model_version
+    from .prediction_cache import cached_inference
+
+    inference_time, inference_result, inference_probabilities = cached_inference(image_file, model=spec)
+    return {
+        'model': spec.name,
+        'model_version': get_model_version(spec),
+        'result': inference_result,
+        'probabilities': _probabilities(spec, inference_probabilities),
+        'inference_time': inference_time,
+    }
+
+
+@_csrf_exempt
+async def predict(request):
+    """
+    JSON prediction API.
+
+    POST a multipart 'image' file with an API key or as a logged-in user (see _authenticate),
+    optionally with the 'model' (a name in settings.INFERENCE_MODELS) to predict with. The
+    response is {"model", "model_version", "result", "probabilities": {"normal", "pneumonia"},
+    "inference_time"}.
+    Nothing is stored. Answers 503 with Retry-After when the inference executor is full.
+    """
+    if request.method != 'POST':
+        return _error('POST required.', 405)
+    error = await _authenticate(request)
+    if error is not None:
+        return error
+
+    image_file = request.FILES.get('image')
+    if image_file is None:
+        return _error('No image received.', 400)
+
+    from .onnx_inference import ModelVersionMismatch, UnknownModel
+
+    try:
+        spec = _get_spec(request)
+        return JsonResponse(await run_in_executor(_predict, image_file, spec))
+    except UnknownModel as e:
+        return _error(str(e), 400)
+    except ModelVersionMismatch as e:
+        return _error(str(e), 503)
+    except InferenceQueueFull:
+        return busy_response(as_json=True)
+    except ImageTooLarge as e:
+        return _error(str(e), 413)
+    except InvalidImage:
+        return _error(f'{image_file.name} is not a valid image.', 400)
+
+
+def _predict_batch(images, spec):
+    from .onnx_inference import get_model_version
+    from .prediction_cache import cached_inference_batch
+
+    return cached_inference_batch(images, model=spec), get_model_version(spec)
+
+
+def _check_batch_size(items):
+    if len(items) > settings.INFERENCE_API_MAX_BATCH:
+        raise BadRequest(f'At most {settings.INFERENCE_API_MAX_BATCH} images per request', status=413)
+
+
+def _read_ndjson(request):
+    # one {"id": ..., "image": "<base64>"} object per line, read from the stream line by line
+    items = []
+    size = 0
+    for number, line in enumerate(request, start=1):
+        size += len(line)
+        if size > settings.INFERENCE_API_MAX_BODY_SIZE:
+            raise BadRequest(f'The request body exceeds {settings.INFERENCE_API_MAX_BODY_SIZE} bytes', status=413)
+        if not line.strip():
+            continue
+        try:
+            item = json.loads(line)
+            data = base64.b64decode(item['image'], validate=True)
+        except (ValueError, TypeError, KeyError, binascii.Error):
+            raise BadRequest(f'Line {number} is not a JSON object with a base64 "image"')
+        items.append((str(item.get('id', len(items))), data))
+        _check_batch_size(items)
+    return items
+
+
+def _read_multipart(request):
+    files = request.FILES.getlist('image')
+    _check_batch_size(files)
+    if sum(f.size for f in files) > settings.INFERENCE_API_MAX_BODY_SIZE:
+        raise BadRequest(f'The images exceed {settings.INFERENCE_API_MAX_BODY_SIZE} bytes', status=413)
+    return [(f.name, f.read()) for f in files]
+
+
+def _read_request(request):
+    # the declared length rejects a body too large before any of it is read
+    try:
+        length = int(request.META.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+        length = 0
+    if length > settings.INFERENCE_API_MAX_BODY_SIZE:
+        raise BadRequest(f'The request body exceeds {settings.INFERENCE_API_MAX_BODY_SIZE} bytes', status=413)
+    if request.content_type in NDJSON_CONTENT_TYPES:
+        return _read_ndjson(request)
+    return _read_multipart(request)
+
+
+def _image_name(item_id, data):
+    # NDJSON ids are often bare indexes or study ids, the stored file takes the extension of the decoded type
+    from PIL import Image
+
+    name = os.path.basename(item_id) or 'image'
+    if os.path.splitext(name)[1]:
+        return name
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            image_format = image.format
+    except OSError:
+        image_format = None
+    return f'{name}.{(image_format or "png").lower()}'
+
+
+def _save_images(items):
+    # stored under their content hash, so pushing the same study twice keeps one file
+    saved = []
+    for item_id, data in items:
+        image = UploadedImage.objects.create(image=ContentFile(data, name=_image_name(item_id, data)))
+        saved.append({'image_id': image.id, 'name': image.image.name})
+    return saved
+
+
+def _prediction_json(spec, item_id, prediction):
+    if isinstance(prediction, ImageTooLarge):
+        return {'id': item_id, 'error': str(prediction), 'status': 413}
+    if isinstance(prediction, InvalidImage):
+        return {'id': item_id, 'error': 'Not a valid image.', 'status': 400}
+    return {
+        'id': item_id,
+        'result': prediction['result'],
+        'probabilities': _probabilities(spec, prediction['probabilities']),
+        'inference_time': prediction['inference_time'],
+        'decode_time': prediction['decode_time'],
+        'cached': prediction['cached'],
+    }
+
+
+@_csrf_exempt
+async def predict_batch(request):
+    """
+    Batch JSON prediction API.
+
+    POST up to INFERENCE_API_MAX_BATCH images with an API key or as a logged-in user, either as several multipart
+    'image' files or as an NDJSON body (Content-Type application/x-ndjson) with one
+    {"id": ..., "image": "<base64>"} object per line. Every image not predicted before goes
+    through one batched model run of the 'model' given in the query string (a name in
+    settings.INFERENCE_MODELS, the default model if absent). The response is
+    {"model", "model_version", "results": [...]} with,
+    per image in request order, {"id", "result", "probabilities", "inference_time",
+    "decode_time", "cached"} or {"id", "error", "status"} for an image that cannot be decoded.
+
+    Nothing is stored unless ?save=1 is given, which saves every valid image as an
+    UploadedImage and adds its "image_id" and "name" to the result.
+    Answers 503 with Retry-After when the inference executor is full.
+    """
+    if request.method != 'POST':
+        return _error('POST required.', 405)
+    error = await _authenticate(request)
+    if error is not None:
+        return error
+
+    try:
+        # reading the body blocks, multipart parsing may spool it to disk
+        items = await sync_to_async(_read_request)(request)
+    except BadRequest as e:
+        return _error(str(e), e.status)
+
+    if not items:
+        return _error('No image received.', 400)
+
+    from .onnx_inference import ModelVersionMismatch, UnknownModel
+
+    try:
+        spec = _get_spec(request)
+        predictions, version = await run_in_executor(_predict_batch, [data for _, data in items], spec)
+    except UnknownModel as e:
+        return _error(str(e), 400)
+    except ModelVersionMismatch as e:
+        return _error(str(e), 503)
+    except InferenceQueueFull:
+        return busy_response(as_json=True)
+
+    results = [_prediction_json(spec, item_id, prediction)
+               for (item_id, _), prediction in zip(items, predictions)]
+
+    if request.GET.get('save') in ('1', 'true'):
+        valid = [i for i, result in enumerate(results) if 'error' not in result]
+        saved = await sync_to_async(_save_images)([items[i] for i in valid])
+        for i, image in zip(valid, saved):
+            results[i].update(image)
+
+    return JsonResponse({'model': spec.name, 'model_version': version, 'results': results})
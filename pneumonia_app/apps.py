@@ -1,6 +1,47 @@
 from django.apps import AppConfig
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, post_save, pre_save
 
 
 class PneumoniaAppConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "pneumonia_app"
+
+    def ready(self):
+        from . import community, dashboard, db, jobs, middleware, warmup
+        from .models import (
+            DiagnosisRecord,
+            Doctor,
+            DoctorComment,
+            DoctorPost,
+            Patient,
+            PatientComment,
+            PatientPost,
+        )
+
+        # tune SQLite connections with the PRAGMAS of their database
+        connection_created.connect(db.configure_sqlite, dispatch_uid='configure_sqlite')
+        # count the queries of every request for the metrics
+        connection_created.connect(middleware.install_query_recorder, dispatch_uid='install_query_recorder')
+
+        # keep the doctor dashboard counters in step with the diagnosis records
+        pre_save.connect(dashboard.remember_counted, sender=DiagnosisRecord, dispatch_uid='dashboard_pre_save')
+        post_save.connect(dashboard.update_counted, sender=DiagnosisRecord, dispatch_uid='dashboard_post_save')
+        post_delete.connect(dashboard.remove_counted, sender=DiagnosisRecord, dispatch_uid='dashboard_post_delete')
+
+        # drop the cached community pages when a post, a comment or an author's name changes
+        for model in (PatientPost, PatientComment, Patient):
+            post_save.connect(community.invalidate_patient_board, sender=model,
+                              dispatch_uid=f'community_{model.__name__}_post_save')
+            post_delete.connect(community.invalidate_patient_board, sender=model,
+                                dispatch_uid=f'community_{model.__name__}_post_delete')
+        for model in (DoctorPost, DoctorComment, Doctor):
+            post_save.connect(community.invalidate_doctor_board, sender=model,
+                              dispatch_uid=f'community_{model.__name__}_post_save')
+            post_delete.connect(community.invalidate_doctor_board, sender=model,
+                                dispatch_uid=f'community_{model.__name__}_post_delete')
+
+        # load and run the models before the first request if this process asks for it
+        warmup.start_warmup()
+        # queue the jobs a stopped or crashed process left behind if this process asks for it
+        jobs.start_requeue()
@@ -0,0 +1,123 @@
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import threading
+
+from django.conf import settings
+from django.http import HttpResponse, JsonResponse
+
+from .metrics import callback
+
+
+class InferenceQueueFull(Exception):
+    """
+    More inference calls are in flight than settings.INFERENCE_ASYNC_MAX_PENDING allows.
+    """
+
+
+class BoundedExecutor:
+    """
+    Bounded Executor Class
+
+    Note:
+    A thread pool that accepts at most max_pending calls at a time (running plus queued).
+    submit() raises InferenceQueueFull instead of queueing more, so an overloaded process
+    answers 503 right away rather than letting every request wait behind a growing queue.
+    """
+
+    def __init__(self, max_workers, max_pending, thread_name_prefix='inference-async'):
+        self.max_workers = max_workers
+        self.max_pending = max(max_pending, max_workers)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=thread_name_prefix)
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._rejected = 0
+
+    def submit(self, fn, *args, **kwargs):
+        """
+        Schedules fn(*args, **kwargs) and returns its concurrent.futures.Future.
+
+        Raises:
+            InferenceQueueFull: max_pending calls are already in flight.
+        """
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self._rejected += 1
+            raise InferenceQueueFull(f'{self.max_pending} inference calls are already in flight')
+
+        with self._lock:
+            self._pending += 1
+        try:
+            return self._executor.submit(self._run, fn, args, kwargs)
+        except BaseException:
+            self._release()
+            raise
+
+    def _run(self, fn, args, kwargs):
+        # the slot is free by the time the caller sees the result
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            self._release()
+
+    def _release(self):
+        with self._lock:
+            self._pending -= 1
+        self._slots.release()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'workers': self.max_workers,
+                'max_pending': self.max_pending,
+                'pending': self._pending,
+                'rejected': self._rejected,
+            }
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    """
+    Returns the process-wide executor async views run inference on.
+    """
+    global _executor
+
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = BoundedExecutor(settings.INFERENCE_ASYNC_WORKERS, settings.INFERENCE_ASYNC_MAX_PENDING)
+    return _executor
+
+
+callback('pulmoinsight_async_executor_pending', 'Inference calls running or queued on the async executor.',
+         lambda: _executor.stats()['pending'] if _executor is not None else 0)
+callback('pulmoinsight_async_executor_rejected', 'Inference calls rejected with a 503 because the executor was full.',
+         lambda: _executor.stats()['rejected'] if _executor is not None else 0, type='counter')
+
+
+async def run_in_executor(fn, *args, **kwargs):
+    """
+    Runs the blocking call fn(*args, **kwargs) on the bounded executor and awaits its result.
+
+    The event loop keeps serving other requests while the call runs.
+
+    Raises:
+        InferenceQueueFull: The executor is saturated, see busy_response().
+    """
+    return await asyncio.wrap_future(get_executor().submit(fn, *args, **kwargs))
+
+
+def busy_response(as_json=False):
+    """
+    Returns the 503 response sent when the executor is saturated, telling the client when to retry.
+    """
+    message = 'The server is busy, please retry later.'
+    if as_json:
+        response = JsonResponse({'error': message}, status=503)
+    else:
+        response = HttpResponse(message, status=503)
+    response['Retry-After'] = str(settings.INFERENCE_ASYNC_RETRY_AFTER)
+    return response
@@ -0,0 +1,20 @@
+from django.contrib.auth import get_user_model
+from django.contrib.auth.backends import ModelBackend
+
+
+class ProfileBackend(ModelBackend):
+    """
+    Profile Backend Class
+
+    Note:
+    Loads the user of every request together with their Patient and Doctor profiles, so
+    get_patient()/get_doctor() (see profiles.py) find a linked profile without another query.
+    """
+
+    def get_user(self, user_id):
+        user_model = get_user_model()
+        try:
+            user = user_model._default_manager.select_related('patient_profile', 'doctor_profile').get(pk=user_id)
+        except user_model.DoesNotExist:
+            return None
+        return user if self.user_can_authenticate(user) else None
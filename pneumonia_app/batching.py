@@ -0,0 +1,129 @@
+from concurrent.futures import Future
+from time import time
+import queue
+import threading
+
+import numpy as np
+
+
+class InferenceBatcher:
+    """
+    Dynamic Micro-Batching Class
+
+    Note:
+    Requests submit one preprocessed tensor each (batch dimension 1). A background thread
+    collects pending tensors until either max_batch_size is reached or max_wait_ms has passed
+    since the first one arrived, runs them through run_fn as a single batch and hands every
+    request its own slice of the outputs.
+
+    run_fn receives a stacked (N, C, H, W) array and returns (outputs, run_time_ms), where
+    outputs is the list returned by InferenceSession.run.
+    """
+
+    def __init__(self, run_fn, max_batch_size=8, max_wait_ms=5.):
+        self.run_fn = run_fn
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait_ms = max(0., float(max_wait_ms))
+
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+
+        # statistics
+        self._started_at = None
+        self._batches = 0
+        self._items = 0
+        self._failed = 0
+        self._run_time = 0.
+        self._max_batch_seen = 0
+        self._max_queue_depth = 0
+
+    def _ensure_worker(self):
+        # threads do not survive a fork, so (re)start the worker lazily in the current process
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._started_at = self._started_at or time()
+                self._thread = threading.Thread(target=self._worker, name='inference-batcher', daemon=True)
+                self._thread.start()
+
+    def submit(self, tensor):
+        """
+        Queues a (1, C, H, W) tensor and returns a Future resolving to (outputs, run_time_ms).
+        """
+        self._ensure_worker()
+
+        future = Future()
+        self._queue.put((tensor, future))
+        self._max_queue_depth = max(self._max_queue_depth, self._queue.qsize())
+        return future
+
+    def run(self, tensor, timeout=None):
+        """
+        Queues a tensor and blocks until its batch has been run.
+        """
+        return self.submit(tensor).result(timeout=timeout)
+
+    def _collect(self):
+        # block for the first request, then wait at most max_wait_ms for the batch to fill up
+        pending = [self._queue.get()]
+        deadline = time() + self.max_wait_ms / 1000.
+
+        while len(pending) < self.max_batch_size:
+            remaining = deadline - time()
+            try:
+                if remaining > 0:
+                    pending.append(self._queue.get(timeout=remaining))
+                else:
+                    pending.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+
+        return pending
+
+    def _worker(self):
+        while True:
+            pending = self._collect()
+            # skip requests that were cancelled while waiting
+            batch = [(tensor, future) for tensor, future in pending if future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            futures = [future for _, future in batch]
+
+            try:
+                outs, run_time = self.run_fn(np.concatenate([tensor for tensor, _ in batch], axis=0))
+            except Exception as e:
+                self._failed += len(futures)
+                for future in futures:
+                    future.set_exception(e)
+                continue
+
+            self._batches += 1
+            self._items += len(futures)
+            self._run_time += run_time
+            self._max_batch_seen = max(self._max_batch_seen, len(futures))
+
+            # every request gets outputs shaped like a single-image run; copy them since
+            # run_fn may reuse its output buffers for the next batch
+            for i, future in enumerate(futures):
+                future.set_result(([out[i:i + 1].copy() for out in outs], run_time))
+
+    def stats(self):
+        """
+        Returns throughput, batch size and queue depth statistics.
+        """
+        elapsed = time() - self._started_at if self._started_at else 0.
+        return {
+            'max_batch_size': self.max_batch_size,
+            'max_wait_ms': self.max_wait_ms,
+            'batches': self._batches,
+            'items': self._items,
+            'failed': self._failed,
+            'average_batch_size': self._items / self._batches if self._batches else 0.,
+            'largest_batch': self._max_batch_seen,
+            'average_run_time': self._run_time / self._batches if self._batches else 0.,
+            'throughput': self._items / elapsed if elapsed else 0.,
+            'queue_depth': self._queue.qsize(),
+            'max_queue_depth': self._max_queue_depth,
+        }
@@ -0,0 +1,163 @@
+from time import perf_counter
+import os
+import platform
+import subprocess
+import tracemalloc
+
+from django.conf import settings
+
+import numpy as np
+
+SAMPLE_DIR = os.path.join(settings.BASE_DIR, 'sample')
+
+
+def sample_images():
+    """
+    Returns the paths of the images in the sample/ directory.
+    """
+    return [os.path.join(SAMPLE_DIR, name) for name in sorted(os.listdir(SAMPLE_DIR))]
+
+
+def timed(fn, repeat, warmup=1):
+    """
+    Calls fn warmup + repeat times and returns the durations of the last repeat calls in ms.
+    """
+    for _ in range(warmup):
+        fn()
+
+    durations = []
+    for _ in range(repeat):
+        start_time = perf_counter()
+        fn()
+        durations.append(1000. * (perf_counter() - start_time))
+    return durations
+
+
+def _proc_status_kb(field):
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(field + ':'):
+                return int(line.split()[1])
+    raise OSError(f'{field} not in /proc/self/status')
+
+
+def peak_memory(fn):
+    """
+    Calls fn once and returns how far it raised the peak memory of the process, in MB.
+
+    On Linux the resident set high-water mark is reset before the call, so allocations made by
+    native code (OpenCV, PIL, onnxruntime) are counted. Elsewhere it falls back to tracemalloc,
+    which only sees Python and NumPy allocations.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        baseline = _proc_status_kb('VmRSS')
+    except OSError:
+        tracemalloc.start()
+        try:
+            fn()
+            return tracemalloc.get_traced_memory()[1] / 1024 ** 2
+        finally:
+            tracemalloc.stop()
+
+    fn()
+    return max(0, _proc_status_kb('VmHWM') - baseline) / 1024
+
+
+def summarize_memory(peaks):
+    """
+    Summarizes a list of peak memory measurements (MB).
+    """
+    peaks = np.asarray(peaks, dtype=np.float64)
+    return {
+        'count': int(peaks.size),
+        'mean_peak_mb': float(peaks.mean()),
+        'max_peak_mb': float(peaks.max()),
+    }
+
+
+def summarize(durations, items=1):
+    """
+    Summarizes a list of durations (ms). items is the number of images handled per call.
+    """
+    durations = np.asarray(durations, dtype=np.float64)
+    mean = float(durations.mean())
+    return {
+        'count': int(durations.size),
+        'mean_ms': mean,
+        'median_ms': float(np.median(durations)),
+        'p95_ms': float(np.percentile(durations, 95)),
+        'min_ms': float(durations.min()),
+        'max_ms': float(durations.max()),
+        'images_per_second': 1000. * items / mean if mean else 0.,
+    }
+
+
+def build_synthetic_model(path, image_size=224, seed=0):
+    """
+    Writes a small random-weight CNN with the same input/output signature as resnet18-lite.onnx.
+
+    Input is a float32 (N, 1, image_size, image_size) tensor, output is (N, 2) logits.
+    Requires the optional onnx package.
+    """
+    import onnx
+    from onnx import TensorProto, helper, numpy_helper
+
+    rng = np.random.default_rng(seed)
+
+    def weight(name, *shape):
+        return numpy_helper.from_array((rng.standard_normal(shape) * 0.1).astype(np.float32), name)
+
+    initializers = [
+        weight('conv1_w', 16, 1, 3, 3), weight('conv1_b', 16),
+        weight('conv2_w', 32, 16, 3, 3), weight('conv2_b', 32),
+        weight('conv3_w', 64, 32, 3, 3), weight('conv3_b', 64),
+        weight('fc_w', 64, 2), weight('fc_b', 2),
+    ]
+    conv = dict(kernel_shape=[3, 3], strides=[2, 2], pads=[1, 1, 1, 1])
+    nodes = [
+        helper.make_node('Conv', ['input', 'conv1_w', 'conv1_b'], ['c1'], **conv),
+        helper.make_node('Relu', ['c1'], ['r1']),
+        helper.make_node('Conv', ['r1', 'conv2_w', 'conv2_b'], ['c2'], **conv),
+        helper.make_node('Relu', ['c2'], ['r2']),
+        helper.make_node('Conv', ['r2', 'conv3_w', 'conv3_b'], ['c3'], **conv),
+        helper.make_node('Relu', ['c3'], ['r3']),
+        helper.make_node('GlobalAveragePool', ['r3'], ['pool']),
+        helper.make_node('Flatten', ['pool'], ['flat']),
+        helper.make_node('Gemm', ['flat', 'fc_w', 'fc_b'], ['output']),
+    ]
+    graph = helper.make_graph(
+        nodes, 'synthetic-resnet18-lite',
+        [helper.make_tensor_value_info('input', TensorProto.FLOAT, ['batch', 1, image_size, image_size])],
+        [helper.make_tensor_value_info('output', TensorProto.FLOAT, ['batch', 2])],
+        initializers,
+    )
+    model = helper.make_model(graph, opset_imports=[helper.make_opsetid('', 13)])
+    model.ir_version = 8
+    onnx.save(model, path)
+    return path
+
+
+def environment_info():
+    """
+    Returns the versions and hardware details needed to compare reports across commits.
+    """
+    import onnxruntime
+    import cv2 as cv
+
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=settings.BASE_DIR, capture_output=True,
+                                text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        commit = None
+
+    return {
+        'commit': commit,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'numpy': np.__version__,
+        'opencv': cv.__version__,
+        'onnxruntime': onnxruntime.__version__,
+    }
@@ -0,0 +1,109 @@
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.db.models import Count, F, IntegerField, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+
+from .models import DoctorComment, DoctorPost, PatientComment, PatientPost
+
+# Number of posts shown per page of a community board
+FEED_PAGE_SIZE = 20
+
+# board -> (post model, comment model, author field)
+BOARDS = {
+    'patient': (PatientPost, PatientComment, 'patient'),
+    'doctor': (DoctorPost, DoctorComment, 'doctor'),
+}
+
+
+def _cache():
+    return caches[settings.COMMUNITY_CACHE_ALIAS]
+
+
+def _version_key(board):
+    return f'community:{board}:version'
+
+
+def _version(board):
+    # a lost version restarts from the clock, never from a number older pages were cached under
+    return _cache().get_or_set(_version_key(board), time.time_ns, timeout=None)
+
+
+def _query_page(board, before):
+    post_model, comment_model, author = BOARDS[board]
+
+    comment_count = (comment_model.objects.filter(post=OuterRef('pk')).order_by()
+                     .values('post').annotate(count=Count('pk')).values('count'))
+    posts = post_model.objects.annotate(
+        # the author's name is joined in, the comment count comes from the (post, created_at) index
+        author=F(f'{author}__name'),
+        comment_count=Coalesce(Subquery(comment_count, output_field=IntegerField()), Value(0)),
+    )
+    if before is not None:
+        posts = posts.filter(id__lt=before)
+
+    # posts are created in id order, so the primary key doubles as the feed cursor
+    return list(posts.order_by('-id').values('id', 'author', 'content', 'created_at',
+                                             'comment_count')[:FEED_PAGE_SIZE + 1])
+
+
+def get_feed_page(board, before=None):
+    """
+    Returns one page of a community board, newest first.
+
+    Args:
+        board: 'patient' or 'doctor'.
+        before: Only posts with an id lower than this are returned (the cursor of the previous page).
+
+    Returns:
+        (posts, next_before): a list of post dicts (id, author, content, created_at, comment_count)
+        and the cursor of the next page, or None on the last page.
+
+    Note:
+    Pages are cached under the board's version number, which is bumped whenever a post, comment
+    or author of the board changes. The bump only reaches the processes sharing the cache: with
+    the default per-process local-memory cache, other processes keep serving their pages for up
+    to settings.COMMUNITY_FEED_TIMEOUT seconds.
+    """
+    key = f'community:{board}:{_version(board)}:{before or ""}'
+    page = _cache().get(key)
+    if page is None:
+        page = _query_page(board, before)
+        _cache().set(key, page, timeout=settings.COMMUNITY_FEED_TIMEOUT)
+
+    if len(page) > FEED_PAGE_SIZE:
+        return page[:FEED_PAGE_SIZE], page[FEED_PAGE_SIZE - 1]['id']
+    return page, None
+
+
+def invalidate(board):
+    """
+    Drops every cached page of the board once the current transaction commits.
+    """
+    def bump():
+        try:
+            _cache().incr(_version_key(board))
+        except ValueError:
+            # no version yet: the next read starts a new one
+            pass
+
+    transaction.on_commit(bump)
+
+
+def invalidate_patient_board(sender, using=DEFAULT_DB_ALIAS, **kwargs):
+    """
+    post_save/post_delete handler for the patient board's posts, comments and authors.
+    """
+    # the cached pages come from the default database only
+    if using == DEFAULT_DB_ALIAS:
+        invalidate('patient')
+
+
+def invalidate_doctor_board(sender, using=DEFAULT_DB_ALIAS, **kwargs):
+    """
+    post_save/post_delete handler for the doctor board's posts, comments and authors.
+    """
+    if using == DEFAULT_DB_ALIAS:
+        invalidate('doctor')
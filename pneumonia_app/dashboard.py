@@ -0,0 +1,130 @@
+from django.conf import settings
+from django.core.cache import caches
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.db.models import Count, Q
+
+from .models import DiagnosisRecord
+
+# counter name -> condition a diagnosis record must meet to be counted
+COUNTERS = {
+    'total': Q(),
+    'pending': Q(diagnosis_status='No'),
+    'diagnosed': Q(diagnosis_status='Yes'),
+    'controversial': Q(controversy_status=True),
+    'pneumonia': Q(diagnosis_result='Pneumonia'),
+    'normal': Q(diagnosis_result='Normal'),
+}
+COUNTED_FIELDS = ('diagnosis_status', 'diagnosis_result', 'controversy_status')
+
+
+def _cache():
+    return caches[settings.DASHBOARD_CACHE_ALIAS]
+
+
+def _key(name):
+    return f'dashboard:{name}'
+
+
+def refresh_stats():
+    """
+    Recounts every dashboard counter with one aggregate query and stores them in the cache.
+    """
+    stats = DiagnosisRecord.objects.aggregate(**{
+        name: Count('pk', filter=condition) if condition else Count('pk')
+        for name, condition in COUNTERS.items()
+    })
+    _cache().set_many({_key(name): value for name, value in stats.items()},
+                      timeout=settings.DASHBOARD_STATS_TIMEOUT)
+    return stats
+
+
+def get_stats():
+    """
+    Returns the dashboard counters, recounting them only when they are missing from the cache.
+
+    Note:
+    The counters are kept up to date by the DiagnosisRecord signals below. Bulk updates and
+    deletes bypass the signals, so the counters also expire after
+    settings.DASHBOARD_STATS_TIMEOUT seconds and are recounted on the next read.
+    """
+    keys = {_key(name): name for name in COUNTERS}
+    cached = _cache().get_many(keys)
+    if len(cached) != len(keys):
+        return refresh_stats()
+    return {keys[key]: value for key, value in cached.items()}
+
+
+def _counted(values):
+    """
+    Returns the counters a diagnosis record with the given field values contributes to.
+    """
+    if values is None:
+        return set()
+
+    counted = {'total'}
+    if values['diagnosis_status'] == 'No':
+        counted.add('pending')
+    elif values['diagnosis_status'] == 'Yes':
+        counted.add('diagnosed')
+    if values['controversy_status']:
+        counted.add('controversial')
+    if values['diagnosis_result'] == 'Pneumonia':
+        counted.add('pneumonia')
+    elif values['diagnosis_result'] == 'Normal':
+        counted.add('normal')
+    return counted
+
+
+def _apply(added, removed):
+    cache = _cache()
+    for names, delta in ((added - removed, 1), (removed - added, -1)):
+        for name in names:
+            try:
+                if delta > 0:
+                    cache.incr(_key(name), delta)
+                else:
+                    cache.decr(_key(name), -delta)
+            except ValueError:
+                # not cached yet (or expired): the next read recounts everything
+                pass
+
+
+def _update_on_commit(added, removed):
+    if added != removed:
+        # only count changes that actually made it into the database
+        transaction.on_commit(lambda: _apply(added, removed))
+
+
+def _record_values(record):
+    return {field: getattr(record, field) for field in COUNTED_FIELDS}
+
+
+def remember_counted(sender, instance, raw=False, using=DEFAULT_DB_ALIAS, **kwargs):
+    """
+    pre_save handler: remembers which counters the stored version of the record was in.
+    """
+    # the counters describe the default database only
+    if raw or instance.pk is None or using != DEFAULT_DB_ALIAS:
+        instance._dashboard_counted = set()
+        return
+
+    previous = DiagnosisRecord.objects.using(using).filter(pk=instance.pk).values(*COUNTED_FIELDS).first()
+    instance._dashboard_counted = _counted(previous)
+
+
+def update_counted(sender, instance, raw=False, using=DEFAULT_DB_ALIAS, **kwargs):
+    """
+    post_save handler: moves the record between counters.
+    """
+    if raw or using != DEFAULT_DB_ALIAS:
+        return
+    _update_on_commit(_counted(_record_values(instance)), getattr(instance, '_dashboard_counted', set()))
+
+
+def remove_counted(sender, instance, using=DEFAULT_DB_ALIAS, **kwargs):
+    """
+    post_delete handler: takes the record out of its counters.
+    """
+    if using != DEFAULT_DB_ALIAS:
+        return
+    _update_on_commit(set(), _counted(_record_values(instance)))
@@ -0,0 +1,14 @@
+def configure_sqlite(sender, connection, **kwargs):
+    """
+    connection_created handler: applies the database's PRAGMAS setting to new SQLite connections.
+
+    Note:
+    journal_mode=WAL lets readers run while a writer commits, synchronous=NORMAL only syncs the
+    WAL at checkpoints (safe with WAL, a power loss may drop the last commits), and busy_timeout
+    makes writers wait for the lock instead of failing with 'database is locked'.
+    """
+    if connection.vendor != 'sqlite':
+        return
+
+    for name, value in connection.settings_dict.get('PRAGMAS', {}).items():
+        connection.connection.execute(f'PRAGMA {name} = {value}')
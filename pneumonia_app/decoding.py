@@ -0,0 +1,103 @@
+from django.conf import settings
+
+# JPEG scale-down factors of the decoders, largest first. OpenCV, NumPy and PIL are imported
+# by the functions decoding pixels: forms and uploads only need the size check below.
+REDUCTION_FACTORS = (8, 4, 2)
+
+
+class ImageTooLarge(ValueError):
+    """
+    The image has more pixels than settings.IMAGE_MAX_PIXELS allows.
+    """
+
+
+class InvalidImage(ValueError):
+    """
+    The file is not an image the decoders can read, or it is truncated or corrupt.
+    """
+
+
+def check_image_size(width, height, max_pixels=None):
+    """
+    Raises ImageTooLarge if a width x height image exceeds the pixel limit.
+    """
+    max_pixels = settings.IMAGE_MAX_PIXELS if max_pixels is None else max_pixels
+    if max_pixels and width * height > max_pixels:
+        raise ImageTooLarge(f'The image is {width}x{height} pixels, at most {max_pixels} pixels are allowed')
+
+
+def reduction_factor(width, height, min_side):
+    """
+    Returns the largest JPEG scale-down factor (8, 4, 2 or 1) keeping both sides at least min_side.
+    """
+    for factor in REDUCTION_FACTORS:
+        if min(width, height) // factor >= min_side:
+            return factor
+    return 1
+
+
+def _to_uint8(img):
+    import cv2 as cv
+    import numpy as np
+
+    if img.dtype == np.uint8:
+        return img
+    # 16-bit (or float) scans: stretch the used range over 8 bits
+    return cv.normalize(img, None, 0, 255, cv.NORM_MINMAX, dtype=cv.CV_8U)
+
+
+def decode_grayscale(image_file, min_side=None, max_pixels=None):
+    """
+    Decodes an image file (path or file-like object) into a grayscale uint8 array, bounding memory.
+
+    Args:
+        image_file: Path or file-like object.
+        min_side: Smallest side length the caller needs (default settings.IMAGE_DECODE_MIN_SIDE).
+            JPEGs at least twice as large are decoded at 1/2, 1/4 or 1/8 scale by the decoder
+            itself (DCT scaling), so the full-resolution pixels are never materialized.
+            0 decodes at full resolution.
+        max_pixels: Pixel limit checked from the header before decoding (default settings.IMAGE_MAX_PIXELS).
+
+    Returns:
+        HxW uint8 array.
+
+    Raises:
+        ImageTooLarge: The image exceeds the pixel limit.
+        InvalidImage: The file cannot be decoded.
+    """
+    import cv2 as cv
+    import numpy as np
+    from PIL import Image
+
+    min_side = settings.IMAGE_DECODE_MIN_SIDE if min_side is None else min_side
+
+    try:
+        # opening only reads the header
+        with Image.open(image_file) as image:
+            check_image_size(*image.size, max_pixels=max_pixels)
+            factor = reduction_factor(*image.size, min_side) if min_side and image.format == 'JPEG' else 1
+
+            if factor > 1 and isinstance(image_file, str):
+                # OpenCV would apply the EXIF orientation, PIL never does: decode the stored pixels
+                # on both paths, so a path and a file object of one image give the same array
+                flags = getattr(cv, f'IMREAD_REDUCED_GRAYSCALE_{factor}') | cv.IMREAD_IGNORE_ORIENTATION
+                img = cv.imread(image_file, flags)
+                if img is not None:
+                    return img
+
+            if factor > 1:
+                # the JPEG decoder scales down and converts to luma while decoding
+                image.draft('L', (image.width // factor, image.height // factor))
+                return np.asarray(image.convert('L'))
+
+            # small enough: decode as before, so predictions on these images do not change
+            img = np.array(image)
+    except FileNotFoundError:
+        raise
+    except OSError as e:
+        # PIL.UnidentifiedImageError is an OSError, so are truncated and corrupt files
+        raise InvalidImage(str(e)) from e
+
+    if img.ndim == 3:
+        img = cv.cvtColor(img, cv.COLOR_RGBA2GRAY if img.shape[2] == 4 else cv.COLOR_RGB2GRAY)
+    return _to_uint8(img)
@@ -0,0 +1,140 @@
+import io
+import os
+import tempfile
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+
+import cv2 as cv
+from PIL import Image
+
+from .onnx_inference import IMAGE_SIZE, read_image
+
+# Derivatives are stored in a 'derivatives' folder next to the original image
+DERIVATIVE_DIR = 'derivatives'
+
+# kind -> suffix appended to the original file name
+DERIVATIVES = {
+    'webp': '.thumb.webp',
+    'jpeg': '.thumb.jpg',
+    # IMAGE_SIZE x IMAGE_SIZE grayscale copy, lossless so inference on it matches the original
+    'model': '.model.png',
+}
+
+# Upload folders (MedicalRecord.pulmonary_image, UploadedImage.image) derivatives are served for
+SOURCE_DIRS = ('pulmonary_images', 'images')
+
+
+def derivative_path(path, kind):
+    """
+    Returns the path of the given kind of derivative of the image at path.
+    """
+    directory, name = os.path.split(path)
+    return os.path.join(directory, DERIVATIVE_DIR, name + DERIVATIVES[kind])
+
+
+def source_path(name):
+    """
+    Returns the absolute path of an uploaded image from its storage name.
+
+    Raises:
+        ValueError: The name is not an uploaded image a derivative can be made of.
+    """
+    parts = name.replace('\\', '/').split('/')
+    if len(parts) < 2 or parts[0] not in SOURCE_DIRS or DERIVATIVE_DIR in parts or '..' in parts:
+        raise ValueError(f'Not an uploaded image: {name}')
+    return default_storage.path(name)
+
+
+def _is_current(path, derivative):
+    # derivatives carry the modification time of the original they were made from
+    try:
+        return os.stat(derivative).st_mtime_ns == os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return False
+
+
+def _write_atomic(path, data, mtime_ns):
+    # concurrent requests may build the same derivative, readers never see a partial file
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.utime(tmp_path, ns=(mtime_ns, mtime_ns))
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def _thumbnail(img):
+    height, width = img.shape[:2]
+    scale = settings.IMAGE_THUMBNAIL_SIZE / max(height, width)
+    if scale < 1:
+        img = cv.resize(img, (max(1, round(width * scale)), max(1, round(height * scale))),
+                        interpolation=cv.INTER_AREA)
+    return Image.fromarray(img)
+
+
+def _encode(image, image_format):
+    buffer = io.BytesIO()
+    image.save(buffer, image_format, quality=settings.IMAGE_THUMBNAIL_QUALITY)
+    return buffer.getvalue()
+
+
+def create_derivatives(path):
+    """
+    Decodes the image at path once and writes all of its derivatives.
+
+    Returns:
+        The IMAGE_SIZE x IMAGE_SIZE grayscale array written as the model-ready copy.
+    """
+    mtime_ns = os.stat(path).st_mtime_ns
+    img = read_image(path)
+    # same resize preprocess() applies, so preprocessing the copy is a no-op resize
+    model_img = cv.resize(img, (IMAGE_SIZE, IMAGE_SIZE))
+
+    ok, png = cv.imencode('.png', model_img, [cv.IMWRITE_PNG_COMPRESSION, 1])
+    if not ok:
+        raise ValueError(f'Could not encode the model-ready copy of {path}')
+    _write_atomic(derivative_path(path, 'model'), png.tobytes(), mtime_ns)
+
+    thumbnail = _thumbnail(img)
+    _write_atomic(derivative_path(path, 'jpeg'), _encode(thumbnail, 'JPEG'), mtime_ns)
+    _write_atomic(derivative_path(path, 'webp'), _encode(thumbnail, 'WEBP'), mtime_ns)
+
+    return model_img
+
+
+def ensure_derivatives(path):
+    """
+    Creates the derivatives of the image at path unless they all exist and are up to date.
+    """
+    if not all(_is_current(path, derivative_path(path, kind)) for kind in DERIVATIVES):
+        create_derivatives(path)
+
+
+def get_derivative(path, kind):
+    """
+    Returns the path of a derivative of the image at path, (re)creating it if missing or stale.
+    """
+    derivative = derivative_path(path, kind)
+    if not _is_current(path, derivative):
+        create_derivatives(path)
+    return derivative
+
+
+def load_model_input(path):
+    """
+    Returns the image at path as the grayscale array inference runs on.
+
+    Reads the small model-ready copy when it is current, so the full-resolution image is
+    neither decoded nor resized; otherwise decodes the original and writes the derivatives.
+    """
+    model_path = derivative_path(path, 'model')
+    if _is_current(path, model_path):
+        img = cv.imread(model_path, cv.IMREAD_UNCHANGED)
+        if img is not None:
+            return img
+    return create_derivatives(path)
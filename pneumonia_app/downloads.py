@@ -0,0 +1,111 @@
+import mimetypes
+import os
+import re
+
+from django.http import FileResponse, Http404, HttpResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import content_disposition_header, http_date, quote_etag
+
+CHUNK_SIZE = 64 * 1024
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def _parse_range(header, size):
+    """
+    Parses a single-range 'Range: bytes=start-end' header.
+
+    Returns (start, end) with an inclusive end, None if the header should be ignored,
+    or False if the range cannot be satisfied.
+    """
+    match = RANGE_RE.match(header.strip())
+    if not match:
+        # multiple ranges or other units are not supported, send the whole file
+        return None
+
+    start, end = match.groups()
+    if not start and not end:
+        return None
+
+    if not start:
+        # suffix range: the last `end` bytes
+        length = int(end)
+        if length == 0:
+            return False
+        return max(size - length, 0), size - 1
+
+    start = int(start)
+    end = min(int(end), size - 1) if end else size - 1
+    if start >= size or start > end:
+        return False
+    return start, end
+
+
+def _read_range(path, start, length):
+    with open(path, 'rb') as f:
+        f.seek(start)
+        while length > 0:
+            chunk = f.read(min(CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+
+def serve_file(request, path, filename=None, as_attachment=False):
+    """
+    Streams a file from disk with ETag/Last-Modified validation and single byte-range support.
+
+    Args:
+        request: HttpRequest object.
+        path: Absolute path of the file.
+        filename: Download name, defaults to the file's base name.
+        as_attachment: Whether to send 'Content-Disposition: attachment'.
+
+    Returns:
+        200 with the file streamed in chunks, 206 for a satisfiable Range request,
+        304/412 from the conditional headers, or 416 for an unsatisfiable range.
+    """
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        raise Http404('File not found')
+
+    filename = filename or os.path.basename(path)
+    content_type = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    etag = quote_etag(f'{stat.st_size:x}-{stat.st_mtime_ns:x}')
+    last_modified = http_date(stat.st_mtime)
+
+    response = get_conditional_response(request, etag=etag, last_modified=int(stat.st_mtime))
+    if response is not None:
+        # a 304 must carry the validators the client stores with its copy
+        response['ETag'] = etag
+        response['Last-Modified'] = last_modified
+        return response
+
+    byte_range = None
+    range_header = request.headers.get('Range')
+    if range_header and request.method in ('GET', 'HEAD'):
+        # If-Range: only honour the range if the client's copy is still current
+        if_range = request.headers.get('If-Range')
+        if not if_range or if_range == etag or if_range == last_modified:
+            byte_range = _parse_range(range_header, stat.st_size)
+
+    if byte_range is False:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = f'bytes */{stat.st_size}'
+    elif byte_range is not None:
+        start, end = byte_range
+        response = StreamingHttpResponse(_read_range(path, start, end - start + 1), status=206,
+                                         content_type=content_type)
+        response['Content-Length'] = str(end - start + 1)
+        response['Content-Range'] = f'bytes {start}-{end}/{stat.st_size}'
+        response['Content-Disposition'] = content_disposition_header(as_attachment, filename)
+    else:
+        # FileResponse streams the file in chunks (or via wsgi.file_wrapper/sendfile)
+        response = FileResponse(open(path, 'rb'), content_type=content_type,
+                                as_attachment=as_attachment, filename=filename)
+
+    response['Accept-Ranges'] = 'bytes'
+    response['ETag'] = etag
+    response['Last-Modified'] = last_modified
+    return response
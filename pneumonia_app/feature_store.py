@@ -0,0 +1,176 @@
+import os
+import tempfile
+import threading
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+
+import numpy as np
+
+from .derivatives import load_model_input
+from .metrics import FEATURE_STORE
+from .models import StoredFeatures
+from .onnx_inference import IMAGE_SIZE
+
+# Rows are the IMAGE_SIZE x IMAGE_SIZE grayscale arrays preprocess() starts from, stored as
+# uint8 so a stored row gives exactly the tensor of the original (float16 would be twice the
+# size and lossy). Preprocessing with another image size starts a new folder.
+DTYPE = np.uint8
+STORE_NAME = f'uint8-{IMAGE_SIZE}'
+
+# concurrent writers racing for the same free row retry with the next one
+ALLOCATE_RETRIES = 5
+
+# (path, writable) -> memmap of a shard, shards are never truncated or replaced once created
+_shards = {}
+_shards_lock = threading.Lock()
+
+
+def store_dir():
+    """
+    Returns the folder holding the shards of the current image size.
+    """
+    return os.path.join(settings.FEATURE_STORE_DIR or os.path.join(settings.MEDIA_ROOT, '.features'), STORE_NAME)
+
+
+def shard_path(shard):
+    return os.path.join(store_dir(), f'shard-{shard:05d}.npy')
+
+
+def _create_shard(path):
+    # written under a temporary name and linked into place, linking fails if another
+    # process created the shard meanwhile, so rows it already wrote are never lost
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    os.close(fd)
+    try:
+        # the file is sparse until rows are written
+        np.lib.format.open_memmap(tmp_path, mode='w+', dtype=DTYPE,
+                                  shape=(settings.FEATURE_STORE_SHARD_SIZE, IMAGE_SIZE, IMAGE_SIZE)).flush()
+        os.link(tmp_path, path)
+    except FileExistsError:
+        pass
+    finally:
+        os.remove(tmp_path)
+
+
+def _open_shard(shard, writable=False):
+    path = shard_path(shard)
+    key = (path, writable)
+    shard_map = _shards.get(key)
+    if shard_map is None:
+        with _shards_lock:
+            shard_map = _shards.get(key)
+            if shard_map is None:
+                if writable and not os.path.exists(path):
+                    _create_shard(path)
+                shard_map = _shards[key] = np.load(path, mmap_mode='r+' if writable else 'r')
+    return shard_map
+
+
+def close_shards():
+    """
+    Drops the memory maps of this process, e.g. after the store folder was moved or removed.
+    """
+    with _shards_lock:
+        _shards.clear()
+
+
+def _next_slot():
+    last = StoredFeatures.objects.order_by('-shard', '-row').values_list('shard', 'row').first()
+    if last is None:
+        return 0, 0
+    return divmod(last[0] * settings.FEATURE_STORE_SHARD_SIZE + last[1] + 1, settings.FEATURE_STORE_SHARD_SIZE)
+
+
+def put_features(medical_record, img):
+    """
+    Stores the model-ready copy of a MedicalRecord's image, overwriting its row if it has one.
+
+    Args:
+        medical_record: The saved MedicalRecord.
+        img: IMAGE_SIZE x IMAGE_SIZE uint8 array, as returned by derivatives.load_model_input.
+
+    Returns:
+        The StoredFeatures index entry.
+    """
+    if img.shape != (IMAGE_SIZE, IMAGE_SIZE) or img.dtype != DTYPE:
+        raise ValueError(f'Expected a {IMAGE_SIZE}x{IMAGE_SIZE} uint8 image, got {img.shape} {img.dtype}')
+    name = medical_record.pulmonary_image.name
+
+    for _ in range(ALLOCATE_RETRIES):
+        entry = StoredFeatures.objects.filter(medical_record=medical_record).first()
+        try:
+            # the row is written before the entry is committed, readers never see an empty row
+            with transaction.atomic():
+                if entry is None:
+                    shard, row = _next_slot()
+                    entry = StoredFeatures.objects.create(medical_record=medical_record, image=name, shard=shard,
+                                                          row=row)
+                elif entry.image != name:
+                    entry.image = name
+                    entry.save(update_fields=['image'])
+
+                shard_map = _open_shard(entry.shard, writable=True)
+                shard_map[entry.row] = img
+                shard_map.flush()
+        except IntegrityError:
+            continue
+
+        medical_record.stored_features = entry
+        return entry
+
+    raise RuntimeError(f'Could not allocate a feature store row for record {medical_record.id}')
+
+
+def get_features(medical_record):
+    """
+    Returns the stored model-ready copy of a MedicalRecord's image, or None if it is not stored.
+
+    The array is a read-only view of the memory-mapped shard, nothing is copied. Fetch records
+    with select_related('stored_features') to save the index query.
+    """
+    if not settings.FEATURE_STORE_ENABLED:
+        return None
+
+    try:
+        entry = medical_record.stored_features
+    except StoredFeatures.DoesNotExist:
+        entry = None
+
+    features = None
+    if entry is not None and entry.image == medical_record.pulmonary_image.name:
+        try:
+            features = _open_shard(entry.shard)[entry.row]
+        except (OSError, ValueError, IndexError):
+            # the shard is gone or was made with other settings, the record is preprocessed again
+            features = None
+
+    FEATURE_STORE.inc(result='miss' if features is None else 'hit')
+    return features
+
+
+def ensure_features(medical_record):
+    """
+    Returns the model-ready copy of a MedicalRecord's image, storing it first if it is not stored yet.
+
+    Returns None if the feature store is disabled in settings.
+    """
+    if not settings.FEATURE_STORE_ENABLED:
+        return None
+
+    features = get_features(medical_record)
+    if features is None:
+        features = load_model_input(medical_record.pulmonary_image.path)
+        put_features(medical_record, features)
+    return features
+
+
+def record_inference(medical_record, model=None):
+    """
+    Runs cached_inference on a MedicalRecord's image, starting from its stored copy if there is one.
+    """
+    from .prediction_cache import cached_inference
+
+    return cached_inference(medical_record.pulmonary_image.path, model=model, features=get_features(medical_record))
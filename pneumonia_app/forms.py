@@ -1,4 +1,5 @@
 from django import forms
+from .decoding import ImageTooLarge, check_image_size
 from .models import UploadedImage
 
 from django.contrib.auth.forms import UserCreationForm, AuthenticationForm
@@ -14,6 +15,17 @@ class ImageUploadForm(forms.ModelForm):
             'image': 'Choose File:'
         }
 
+    def clean_image(self):
+        image = self.cleaned_data['image']
+        # ImageField has already read the header of new uploads into image.image
+        header = getattr(image, 'image', None)
+        if header is not None:
+            try:
+                check_image_size(*header.size)
+            except ImageTooLarge as e:
+                raise forms.ValidationError(str(e))
+        return image
+
 
 # Registration Form
 class CustomUserCreationForm(UserCreationForm):
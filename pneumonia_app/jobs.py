@@ -0,0 +1,163 @@
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import threading
+
+from django.conf import settings
+from django.db import DatabaseError, close_old_connections, connections, transaction
+
+from .decoding import ImageTooLarge, InvalidImage
+from .models import InferenceResult
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    """
+    Returns the process-wide worker pool that runs inference jobs.
+    """
+    global _executor
+
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=settings.INFERENCE_JOB_WORKERS,
+                                               thread_name_prefix='inference-job')
+    return _executor
+
+
+def enqueue_inference(medical_record):
+    """
+    Queues an inference job for the given MedicalRecord and returns its InferenceResult.
+
+    The job is submitted once the surrounding transaction commits, so the worker always
+    sees the saved record.
+    """
+    inference_result, _ = InferenceResult.objects.update_or_create(
+        medical_record=medical_record,
+        defaults={'status': InferenceResult.STATUS_PENDING, 'attempts': 0, 'error': ''},
+    )
+    transaction.on_commit(lambda: _submit(inference_result.id))
+    return inference_result
+
+
+def enqueue_pending():
+    """
+    Re-queues jobs left pending or running by a previous process, e.g. after a restart.
+    """
+    ids = list(InferenceResult.objects.filter(
+        status__in=[InferenceResult.STATUS_PENDING, InferenceResult.STATUS_RUNNING],
+    ).values_list('id', flat=True))
+    for result_id in ids:
+        _submit(result_id)
+    return len(ids)
+
+
+def _requeue():
+    try:
+        count = enqueue_pending()
+    except DatabaseError:
+        # e.g. the tables are not migrated yet
+        logger.exception('Could not re-queue the pending inference jobs')
+    else:
+        logger.info('Re-queued %s pending inference jobs', count)
+    finally:
+        connections.close_all()
+
+
+def start_requeue(enabled=None):
+    """
+    Re-queues the jobs left by a previous process on a background thread if settings.INFERENCE_JOB_REQUEUE,
+    called from AppConfig.ready().
+
+    Returns:
+        The thread, or None if re-queueing is disabled.
+    """
+    from .warmup import is_reloader_parent
+
+    enabled = settings.INFERENCE_JOB_REQUEUE if enabled is None else enabled
+    if not enabled or is_reloader_parent():
+        return None
+
+    thread = threading.Thread(target=_requeue, name='inference-requeue', daemon=True)
+    thread.start()
+    return thread
+
+
+def _submit(result_id, delay=0):
+    if delay:
+        timer = threading.Timer(delay, _submit, args=(result_id,))
+        timer.daemon = True
+        timer.start()
+    else:
+        get_executor().submit(run_inference_job, result_id)
+
+
+def _store_features(medical_record):
+    # the feature store saves later decodes, a failure to write it must not fail the prediction
+    from .feature_store import ensure_features
+
+    try:
+        return ensure_features(medical_record)
+    except Exception:
+        logger.exception('Could not store the features of record %s', medical_record.id)
+        return None
+
+
+def run_inference_job(result_id):
+    """
+    Runs one inference job, retrying with exponential backoff up to INFERENCE_JOB_MAX_RETRIES times.
+    """
+    # imported by the worker thread, so queueing a job from a view does not load the inference stack
+    from .derivatives import ensure_derivatives
+    from .onnx_inference import get_model_spec, model_registry
+    from .prediction_cache import cached_inference
+
+    close_old_connections()
+    try:
+        inference_result = InferenceResult.objects.select_related('medical_record').get(id=result_id)
+        if inference_result.status == InferenceResult.STATUS_DONE:
+            return
+
+        inference_result.status = InferenceResult.STATUS_RUNNING
+        inference_result.attempts += 1
+        inference_result.save(update_fields=['status', 'attempts', 'updated_at'])
+
+        try:
+            version = model_registry.get_version()
+            image_path = inference_result.medical_record.pulmonary_image.path
+            # thumbnails and the model-ready copy are made here, right after the upload
+            ensure_derivatives(image_path)
+            features = _store_features(inference_result.medical_record)
+            inference_time, inference_result.result, probabilities = cached_inference(image_path, features=features)
+        except Exception as e:
+            logger.exception('Inference job %s failed (attempt %s)', result_id, inference_result.attempts)
+            inference_result.error = str(e)
+
+            # an image over the pixel limit or one that cannot be decoded fails the same way on every attempt
+            retry = (not isinstance(e, (ImageTooLarge, InvalidImage))
+                     and inference_result.attempts <= settings.INFERENCE_JOB_MAX_RETRIES)
+            inference_result.status = InferenceResult.STATUS_PENDING if retry else InferenceResult.STATUS_FAILED
+            inference_result.save(update_fields=['status', 'error', 'updated_at'])
+            if retry:
+                # submitted once the row says pending, so the next attempt never loads this attempt's state
+                delay = settings.INFERENCE_JOB_RETRY_DELAY * 2 ** (inference_result.attempts - 1)
+                transaction.on_commit(lambda: _submit(result_id, delay=delay))
+            return
+
+        inference_result.status = InferenceResult.STATUS_DONE
+        inference_result.error = ''
+        # by label, the models may order their classes differently
+        labelled = dict(zip(get_model_spec().classes, probabilities.reshape(-1).tolist()))
+        inference_result.probability_normal = labelled.get('normal')
+        inference_result.probability_pneumonia = labelled.get('pneumonia')
+        inference_result.inference_time = inference_time
+        inference_result.model_version = version
+        inference_result.save()
+    except InferenceResult.DoesNotExist:
+        # the record was deleted before the job ran
+        pass
+    finally:
+        close_old_connections()
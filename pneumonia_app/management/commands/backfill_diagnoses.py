@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from pneumonia_app.dashboard import refresh_stats
+from pneumonia_app.models import DiagnosisRecord, Patient
+
+BATCH_SIZE = 500
+
+
+class Command(BaseCommand):
+    help = ('Creates the pending DiagnosisRecord of every patient who has none, which doctor_records '
+            'used to create while listing the patients.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Report how many would be created without saving.')
+
+    def handle(self, *args, **options):
+        patients = Patient.objects.filter(diagnosisrecord__isnull=True).values_list('id', flat=True)
+        if options['dry_run']:
+            self.stdout.write(f'{patients.count()} patients without a diagnosis record')
+            return
+
+        with transaction.atomic():
+            created = DiagnosisRecord.objects.bulk_create(
+                [DiagnosisRecord(patient_id=patient_id, diagnosis_status='No') for patient_id in patients.iterator()],
+                batch_size=BATCH_SIZE)
+
+        # bulk_create skips the signals keeping the dashboard counters current
+        if created:
+            refresh_stats()
+        self.stdout.write(f'{len(created)} pending diagnosis records created')
@@ -0,0 +1,163 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from time import perf_counter
+import copy
+import json
+import os
+import shutil
+import tempfile
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import OperationalError, connections, transaction
+from django.utils import timezone
+
+from pneumonia_app.benchmark import environment_info, summarize
+from pneumonia_app.models import DiagnosisRecord, MedicalRecord, Patient
+
+BENCH_ALIAS = 'benchmark'
+
+
+def _int_list(value):
+    return [int(v) for v in value.split(',') if v]
+
+
+def _profiles(tmp_dir):
+    """
+    Returns the database settings of every profile that can be benchmarked here.
+    """
+    default = connections.settings['default']
+
+    def sqlite(name, timeout, pragmas):
+        path = os.path.join(tmp_dir, f'{name}.sqlite3')
+        return dict(copy.deepcopy(default), ENGINE='django.db.backends.sqlite3', NAME=path,
+                    OPTIONS={'timeout': timeout}, PRAGMAS=pragmas, TEST=dict(default['TEST'], NAME=path),
+                    CONN_MAX_AGE=0, CONN_HEALTH_CHECKS=False)
+
+    profiles = {
+        # what settings.py used to ship: rollback journal, synchronous=FULL, 5 s lock timeout
+        'sqlite-default': sqlite('sqlite-default', 5, {}),
+        'sqlite-tuned': sqlite('sqlite-tuned', 20, settings.SQLITE_PRAGMAS),
+    }
+    if default['ENGINE'] != 'django.db.backends.sqlite3':
+        # runs against a throwaway test_<NAME> database on the configured server
+        profiles[settings.DATABASE_ENGINE] = copy.deepcopy(default)
+    return profiles
+
+
+class Command(BaseCommand):
+    help = 'Benchmarks concurrent upload/diagnosis writes against the SQLite and configured database profiles.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=_int_list, default=[1, 4, 8],
+                            help='Numbers of concurrent writers to run.')
+        parser.add_argument('--operations', type=int, default=100,
+                            help='Upload + diagnosis operations per writer.')
+        parser.add_argument('--profiles', help='Comma separated profiles to run (default: all available).')
+        parser.add_argument('--output', help='Write the JSON report to this file instead of stdout.')
+
+    def handle(self, *args, **options):
+        tmp_dir = tempfile.mkdtemp(prefix='pulmoinsight-db-bench-')
+        try:
+            profiles = _profiles(tmp_dir)
+            if options['profiles']:
+                names = [name for name in options['profiles'].split(',') if name]
+                unknown = [name for name in names if name not in profiles]
+                if unknown:
+                    raise CommandError(f'Unknown profiles: {", ".join(unknown)} (available: {", ".join(profiles)})')
+                profiles = {name: profiles[name] for name in names}
+
+            results = {}
+            for name, settings_dict in profiles.items():
+                self.stderr.write(f'profile {name}')
+                results[name] = self.run_profile(settings_dict, options)
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+        report = {
+            'created_at': datetime.now().isoformat(timespec='seconds'),
+            'environment': environment_info(),
+            'operations_per_writer': options['operations'],
+            'results': results,
+        }
+        text = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(text + '\n')
+            self.stderr.write(f'Report written to {options["output"]}')
+        else:
+            self.stdout.write(text)
+
+    def run_profile(self, settings_dict, options):
+        # build the tables straight from the models in a throwaway test database
+        settings_dict['TEST'] = dict(settings_dict['TEST'], MIGRATE=False)
+        connections.settings[BENCH_ALIAS] = settings_dict
+        connection = connections[BENCH_ALIAS]
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            return {f'threads={threads}': self.run_writers(threads, options['operations'])
+                    for threads in options['threads']}
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            del connections[BENCH_ALIAS]
+            del connections.settings[BENCH_ALIAS]
+
+    @staticmethod
+    def writer(patient_id, operations):
+        """
+        Uploads a medical record, checks the pending count and saves a diagnosis, `operations` times.
+        """
+        durations = []
+        failed = 0
+        try:
+            for _ in range(operations):
+                start_time = perf_counter()
+                try:
+                    with transaction.atomic(using=BENCH_ALIAS):
+                        MedicalRecord.objects.using(BENCH_ALIAS).create(
+                            patient_id=patient_id, pulmonary_image='pulmonary_images/benchmark.jpeg')
+                        record = DiagnosisRecord.objects.using(BENCH_ALIAS).create(
+                            patient_id=patient_id, diagnosis_status='No')
+
+                    DiagnosisRecord.objects.using(BENCH_ALIAS).filter(diagnosis_status='No').count()
+
+                    with transaction.atomic(using=BENCH_ALIAS):
+                        record.diagnosis_status = 'Yes'
+                        record.diagnosis_result = 'Normal'
+                        record.diagnosis_time = timezone.now()
+                        record.save(using=BENCH_ALIAS)
+                except OperationalError:
+                    # 'database is locked': the lock timeout ran out
+                    failed += 1
+                    continue
+                durations.append(1000. * (perf_counter() - start_time))
+        finally:
+            connections[BENCH_ALIAS].close()
+        return durations, failed
+
+    def run_writers(self, threads, operations):
+        patients = [Patient.objects.using(BENCH_ALIAS).create(name=f'benchmark{i}', gender='female', age=40,
+                                                              occupation='', phone_number='', address='')
+                    for i in range(threads)]
+
+        start_time = perf_counter()
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            outcomes = list(executor.map(lambda patient: self.writer(patient.id, operations), patients))
+        seconds = perf_counter() - start_time
+
+        durations = [d for writer_durations, _ in outcomes for d in writer_durations]
+        failed = sum(writer_failed for _, writer_failed in outcomes)
+        # every operation commits two write transactions
+        committed = 2 * len(durations)
+        result = {
+            'threads': threads,
+            'operations': len(durations),
+            'failed': failed,
+            'seconds': seconds,
+            'writes_per_second': committed / seconds if seconds else 0.,
+        }
+        if durations:
+            latency = summarize(durations)
+            del latency['images_per_second']
+            result['operation_latency'] = latency
+        return result
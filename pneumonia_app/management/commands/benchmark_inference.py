@@ -0,0 +1,198 @@
+from datetime import datetime
+import itertools
+import json
+import os
+import shutil
+import tempfile
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client
+from django.test.utils import override_settings, setup_test_environment, teardown_test_environment
+from django.urls import reverse
+
+import cv2 as cv
+import numpy as np
+import onnxruntime
+
+from pneumonia_app.benchmark import (
+    build_synthetic_model,
+    environment_info,
+    peak_memory,
+    sample_images,
+    summarize,
+    summarize_memory,
+    timed,
+)
+from pneumonia_app.decoding import decode_grayscale
+from pneumonia_app.onnx_inference import build_session_options, get_model_path, model_registry, preprocess, read_image
+
+
+def _int_list(value):
+    return [int(v) for v in value.split(',') if v]
+
+
+class Command(BaseCommand):
+    help = 'Benchmarks session creation, decode, preprocessing, model run and doctor_analyze requests.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repeat', type=int, default=20, help='Timed iterations per measurement.')
+        parser.add_argument('--batch-sizes', type=_int_list, default=[1, 4, 8, 16])
+        parser.add_argument('--threads', type=_int_list, default=[1, 2, 4],
+                            help='intra-op thread counts to run the model with.')
+        parser.add_argument('--synthetic', action='store_true',
+                            help='Use a synthetic model even if the real model file exists.')
+        parser.add_argument('--large-size', type=int, default=4096,
+                            help='Side length of the synthetic large images the decoders are compared on.')
+        parser.add_argument('--skip-requests', action='store_true',
+                            help='Skip the end-to-end doctor_analyze requests.')
+        parser.add_argument('--optimized-model-dir',
+                            help='Folder for the optimized graphs the model loads write (default: a temporary '
+                                 'folder removed afterwards, so INFERENCE_OPTIMIZED_MODEL_DIR is left alone).')
+        parser.add_argument('--output', help='Write the JSON report to this file instead of stdout.')
+
+    def handle(self, *args, **options):
+        tmp_dir = tempfile.mkdtemp(prefix='pulmoinsight-bench-')
+        try:
+            model_path = get_model_path()
+            variant = settings.INFERENCE_MODEL_VARIANT
+            synthetic = options['synthetic'] or not os.path.exists(model_path)
+
+            overrides = {
+                'INFERENCE_OPTIMIZED_MODEL_DIR': options['optimized_model_dir'] or os.path.join(tmp_dir, 'onnx'),
+            }
+            if synthetic:
+                model_path = build_synthetic_model(os.path.join(tmp_dir, 'synthetic.onnx'))
+                variant = 'fp32'
+                overrides.update(INFERENCE_MODEL_PATH=model_path, INFERENCE_MODEL_VARIANT=variant)
+
+            with override_settings(**overrides):
+                report = {
+                    'created_at': datetime.now().isoformat(timespec='seconds'),
+                    'environment': environment_info(),
+                    'model': {'path': model_path, 'variant': variant, 'synthetic': synthetic},
+                    'results': self.run_benchmarks(model_path, tmp_dir, options),
+                }
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+        text = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(text + '\n')
+            self.stderr.write(f'Report written to {options["output"]}')
+        else:
+            self.stdout.write(text)
+
+    def run_benchmarks(self, model_path, tmp_dir, options):
+        repeat = options['repeat']
+        paths = sample_images()
+        results = {}
+
+        self.stderr.write('session creation')
+        results['session_create'] = summarize(timed(
+            lambda: onnxruntime.InferenceSession(model_path, build_session_options(),
+                                                 providers=['CPUExecutionProvider']),
+            repeat=max(1, repeat // 4), warmup=0))
+
+        self.stderr.write('decode')
+        results['decode'] = summarize([d for path in paths for d in timed(lambda: read_image(path), repeat)])
+        results['decode_memory'] = summarize_memory([peak_memory(lambda: read_image(path)) for path in paths])
+
+        self.stderr.write('large image decode')
+        results['decode_large'] = self.benchmark_large_decode(tmp_dir, options['large_size'], max(1, repeat // 4))
+
+        self.stderr.write('preprocess')
+        images = [read_image(path) for path in paths]
+        results['preprocess'] = summarize([d for img in images for d in timed(lambda: preprocess(img), repeat)])
+
+        self.stderr.write('model run')
+        tensors = np.concatenate([preprocess(img) for img in images], axis=0)
+        results['run'] = {}
+        for threads in options['threads']:
+            session_options = build_session_options(intra_op_num_threads=threads)
+            session = onnxruntime.InferenceSession(model_path, session_options, providers=['CPUExecutionProvider'])
+            input_name = session.get_inputs()[0].name
+
+            for batch_size in options['batch_sizes']:
+                batch = np.resize(tensors, (batch_size,) + tensors.shape[1:])
+                durations = timed(lambda: session.run(None, {input_name: batch}), repeat)
+                results['run'][f'threads={threads},batch={batch_size}'] = dict(
+                    summarize(durations, items=batch_size), threads=threads, batch_size=batch_size)
+
+        if not options['skip_requests']:
+            self.stderr.write('doctor_analyze requests')
+            results.update(self.benchmark_requests(paths, tmp_dir, repeat))
+
+        return results
+
+    def benchmark_large_decode(self, tmp_dir, size, repeat):
+        # smooth gradient plus noise, so the JPEG is about as compressible as a real scan
+        rng = np.random.default_rng(0)
+        ramp = np.linspace(0, 1, size, dtype=np.float32)
+        img = np.add.outer(ramp, ramp) / 2 + rng.normal(0, 0.05, (size, size)).astype(np.float32)
+        img = np.clip(img, 0, 1)
+
+        images = {
+            'jpeg': os.path.join(tmp_dir, 'large.jpg'),
+            'png16': os.path.join(tmp_dir, 'large16.png'),
+        }
+        cv.imwrite(images['jpeg'], cv.cvtColor((img * 255).astype(np.uint8), cv.COLOR_GRAY2BGR))
+        cv.imwrite(images['png16'], (img * 65535).astype(np.uint16))
+
+        results = {}
+        for kind, path in images.items():
+            decoders = {
+                # min_side=0 decodes every pixel, like read_image did before reduced decoding
+                'full': lambda: decode_grayscale(path, min_side=0, max_pixels=0),
+                'reduced': lambda: read_image(path),
+            }
+            for name, decode in decoders.items():
+                results[f'{kind},{name}'] = dict(
+                    summarize(timed(decode, repeat)),
+                    **summarize_memory([peak_memory(decode) for _ in range(repeat)]),
+                    shape=list(decode().shape), width=size, height=size)
+        return results
+
+    def benchmark_requests(self, paths, tmp_dir, repeat):
+        from pneumonia_app.prediction_cache import prediction_cache
+
+        test_settings = override_settings(
+            MEDIA_ROOT=os.path.join(tmp_dir, 'media'),
+            CACHES={
+                'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+                settings.INFERENCE_CACHE_ALIAS: {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+            },
+            # build the tables straight from the models in a throwaway test database
+            MIGRATION_MODULES={'pneumonia_app': None},
+        )
+
+        results = {}
+        setup_test_environment()
+        test_settings.enable()
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            model_registry.get_session()
+            client = Client()
+            url = reverse('doctor_analyze')
+            next_path = itertools.cycle(paths).__next__
+
+            def request(cached):
+                if not cached:
+                    prediction_cache.clear()
+                with open(next_path(), 'rb') as f:
+                    response = client.post(url, {'image': f})
+                if response.status_code != 200:
+                    raise CommandError(f'doctor_analyze returned {response.status_code}')
+
+            results['request'] = summarize(timed(lambda: request(cached=False), repeat))
+            results['request_cached'] = summarize(timed(lambda: request(cached=True), repeat))
+            results['request_memory'] = summarize_memory(
+                [peak_memory(lambda: request(cached=False)) for _ in range(max(1, repeat // 4))])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            test_settings.disable()
+            teardown_test_environment()
+
+        return results
@@ -0,0 +1,149 @@
+from datetime import datetime
+from time import perf_counter
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from pneumonia_app.benchmark import build_synthetic_model, environment_info, sample_images, summarize
+from pneumonia_app.warmup import WARMUP_MODES
+
+HEAVY_MODULES = ('numpy', 'cv2', 'PIL.Image', 'onnxruntime', 'torch', 'torchvision')
+
+# Runs in a fresh interpreter per measurement and prints one JSON line. Times are ms from the
+# start of the script, so interpreter startup is left out and reported by the parent instead.
+PROBE = '''
+from time import perf_counter
+start = perf_counter()
+import io, json, sys
+
+import django
+django.setup()
+setup = perf_counter()
+
+from django.urls import get_resolver
+get_resolver().url_patterns
+urls = perf_counter()
+loaded = [name for name in HEAVY_MODULES if name in sys.modules]
+
+from django.test import Client
+from django.test.utils import setup_test_environment
+# lets the test client's 'testserver' host through ALLOWED_HOSTS
+setup_test_environment()
+response = Client().get('/')
+if response.status_code != 200:
+    sys.exit(f'The home page returned {response.status_code}')
+page = perf_counter()
+
+def predict():
+    from pneumonia_app.onnx_inference import inference_resnet18sam, read_image
+    with open(IMAGE, 'rb') as f:
+        inference_resnet18sam(read_image(io.BytesIO(f.read())))
+
+predict()
+first = perf_counter()
+predict()
+second = perf_counter()
+
+print(json.dumps({
+    'setup_ms': 1000. * (setup - start),
+    'urls_ms': 1000. * (urls - setup),
+    'heavy_modules_after_startup': loaded,
+    'first_page_ms': 1000. * (page - urls),
+    'first_inference_ms': 1000. * (first - page),
+    'second_inference_ms': 1000. * (second - first),
+    'ready_to_first_prediction_ms': 1000. * (first - start),
+}))
+'''
+
+TIMINGS = ('process_ms', 'setup_ms', 'urls_ms', 'first_page_ms', 'first_inference_ms', 'second_inference_ms',
+           'ready_to_first_prediction_ms')
+
+
+def _mode_list(value):
+    modes = [mode for mode in value.split(',') if mode]
+    unknown = [mode for mode in modes if mode not in WARMUP_MODES]
+    if unknown:
+        raise ValueError(f'unknown warm-up modes {unknown}')
+    return modes
+
+
+class Command(BaseCommand):
+    help = ('Benchmarks process startup: Django setup, the first page, the first and second inference '
+            'and the heavy modules imported at startup, for every warm-up mode.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repeat', type=int, default=5, help='Fresh processes started per warm-up mode.')
+        parser.add_argument('--modes', type=_mode_list, default=['off', 'sync'],
+                            help='Comma separated INFERENCE_WARMUP modes to compare.')
+        parser.add_argument('--synthetic', action='store_true',
+                            help='Use a synthetic model even if the real model file exists.')
+        parser.add_argument('--optimized-model-dir',
+                            help='Folder for the optimized graphs the probes write (default: a temporary '
+                                 'folder removed afterwards, so INFERENCE_OPTIMIZED_MODEL_DIR is left alone).')
+        parser.add_argument('--output', help='Write the JSON report to this file instead of stdout.')
+
+    def handle(self, *args, **options):
+        images = sample_images()
+        if not images:
+            raise CommandError('No images in sample/ to predict.')
+
+        tmp_dir = tempfile.mkdtemp(prefix='pulmoinsight-startup-bench-')
+        try:
+            model_path = settings.INFERENCE_MODEL_PATH
+            synthetic = options['synthetic'] or not os.path.exists(model_path)
+            if synthetic:
+                model_path = build_synthetic_model(os.path.join(tmp_dir, 'synthetic.onnx'))
+
+            # the probes write their optimized graphs into a folder of their own
+            optimized_dir = options['optimized_model_dir'] or os.path.join(tmp_dir, 'onnx')
+            env = dict(os.environ, DJANGO_SETTINGS_MODULE=os.environ.get('DJANGO_SETTINGS_MODULE',
+                                                                         'PulmoInsight.settings'),
+                       PULMOINSIGHT_MODEL_PATH=model_path, PULMOINSIGHT_OPTIMIZED_MODEL_DIR=optimized_dir)
+            script = f'HEAVY_MODULES = {HEAVY_MODULES!r}\nIMAGE = {images[0]!r}\n' + PROBE
+
+            # the first process writes the optimized graph the others reuse, keep it out of the numbers
+            self.run_probe(script, dict(env, PULMOINSIGHT_WARMUP='off'))
+
+            results = {}
+            for mode in options['modes']:
+                self.stderr.write(f'warm-up {mode}')
+                runs = [self.run_probe(script, dict(env, PULMOINSIGHT_WARMUP=mode))
+                        for _ in range(options['repeat'])]
+                results[mode] = {name: summarize([run[name] for run in runs]) for name in TIMINGS}
+                results[mode]['heavy_modules_after_startup'] = runs[-1]['heavy_modules_after_startup']
+
+            report = {
+                'created_at': datetime.now().isoformat(timespec='seconds'),
+                'environment': environment_info(),
+                'model': {'path': model_path, 'synthetic': synthetic},
+                'processes_per_mode': options['repeat'],
+                'results': results,
+            }
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+        text = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(text + '\n')
+            self.stderr.write(f'Report written to {options["output"]}')
+        else:
+            self.stdout.write(text)
+
+    def run_probe(self, script, env):
+        start_time = perf_counter()
+        process = subprocess.run([sys.executable, '-c', script], cwd=settings.BASE_DIR, env=env,
+                                 capture_output=True, text=True)
+        process_time = 1000. * (perf_counter() - start_time)
+        if process.returncode:
+            raise CommandError(f'Startup probe failed:\n{process.stderr}')
+
+        result = json.loads(process.stdout.strip().splitlines()[-1])
+        result['process_ms'] = process_time
+        return result
@@ -0,0 +1,66 @@
+from time import time
+import os
+
+from django.core.management.base import BaseCommand
+
+from pneumonia_app.derivatives import DERIVATIVES, SOURCE_DIRS, derivative_path
+from pneumonia_app.models import ChunkedUpload, MedicalRecord, UploadedImage
+from pneumonia_app.storage import content_addressed_storage
+
+
+def _is_referenced(name):
+    return (MedicalRecord.objects.filter(pulmonary_image=name).exists()
+            or UploadedImage.objects.filter(image=name).exists()
+            or ChunkedUpload.objects.filter(stored_name=name).exists())
+
+
+class Command(BaseCommand):
+    help = ('Deletes stored images (and their derivatives) that no MedicalRecord, UploadedImage or '
+            'completed chunked upload refers to any more.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--min-age', type=int, default=60 * 60,
+                            help='Keep files modified in the last MIN_AGE seconds, a request may be '
+                                 'about to save the record pointing to them.')
+        parser.add_argument('--dry-run', action='store_true', help='Report what would be deleted without deleting.')
+
+    def handle(self, *args, **options):
+        # ContentAddressedStorage never deletes: identical uploads share one file, so a file can
+        # only go once nothing refers to its name
+        referenced = set(MedicalRecord.objects.values_list('pulmonary_image', flat=True))
+        referenced.update(UploadedImage.objects.values_list('image', flat=True))
+        referenced.update(ChunkedUpload.objects.exclude(stored_name='').values_list('stored_name', flat=True))
+
+        cutoff = time() - options['min_age']
+        deleted = size = 0
+        for directory in SOURCE_DIRS:
+            try:
+                entries = list(os.scandir(content_addressed_storage.path(directory)))
+            except FileNotFoundError:
+                continue
+
+            for entry in entries:
+                # the derivatives folder is skipped here, derivatives go with their original
+                if not entry.is_file():
+                    continue
+                name = f'{directory}/{entry.name}'
+                stat = entry.stat()
+                if name in referenced or stat.st_mtime > cutoff:
+                    continue
+                # an upload of the same content may have reused the file since the names were read
+                if _is_referenced(name):
+                    continue
+
+                deleted += 1
+                size += stat.st_size
+                self.stdout.write(f'{"would delete" if options["dry_run"] else "deleted"} {name}')
+                if options['dry_run']:
+                    continue
+                for path in [entry.path] + [derivative_path(entry.path, kind) for kind in DERIVATIVES]:
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+
+        self.stdout.write(f'{deleted} unreferenced files, {size / 2 ** 20:.1f} MiB'
+                          f'{" (dry run)" if options["dry_run"] else ""}')
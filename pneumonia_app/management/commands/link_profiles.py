@@ -0,0 +1,36 @@
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from pneumonia_app.models import Doctor, Patient
+
+
+class Command(BaseCommand):
+    help = 'Links existing Patient/Doctor profiles to the user account whose username matches the profile name.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Report what would be linked without saving.')
+
+    def handle(self, *args, **options):
+        User = get_user_model()
+
+        for model, related_name, is_doctor in ((Patient, 'patient_profile', False), (Doctor, 'doctor_profile', True)):
+            linked = ambiguous = 0
+
+            # users that have no profile of this kind yet
+            users = User.objects.filter(is_doctor=is_doctor, **{f'{related_name}__isnull': True})
+            with transaction.atomic():
+                for user in users.iterator():
+                    profiles = list(model.objects.filter(name=user.username, user__isnull=True)[:2])
+                    if len(profiles) != 1:
+                        # several profiles share the name; leave them for manual review
+                        ambiguous += len(profiles) > 1
+                        continue
+
+                    linked += 1
+                    if not options['dry_run']:
+                        profiles[0].user = user
+                        profiles[0].save(update_fields=['user'])
+
+            unlinked = model.objects.filter(user__isnull=True).count()
+            self.stdout.write(f'{model.__name__}: {linked} linked, {ambiguous} ambiguous, {unlinked} without user')
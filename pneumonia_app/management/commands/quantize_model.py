@@ -0,0 +1,151 @@
+import json
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+import numpy as np
+import onnxruntime
+
+from pneumonia_app.benchmark import sample_images
+from pneumonia_app.onnx_inference import (
+    MODEL_VARIANTS,
+    UnknownModel,
+    build_session_options,
+    get_model_spec,
+    preprocess,
+    read_image,
+    sigmoid,
+    variant_path,
+)
+
+IMAGE_EXTENSIONS = ('.jpeg', '.jpg', '.png', '.bmp', '.tif', '.tiff')
+
+
+def _image_paths(paths):
+    if not paths:
+        return sample_images()
+
+    result = []
+    for path in paths:
+        if os.path.isdir(path):
+            result.extend(os.path.join(path, name) for name in sorted(os.listdir(path))
+                          if name.lower().endswith(IMAGE_EXTENSIONS))
+        else:
+            result.append(path)
+    return result
+
+
+def _predict(model_path, tensors):
+    session = onnxruntime.InferenceSession(model_path, build_session_options(), providers=['CPUExecutionProvider'])
+    model_input = session.get_inputs()[0]
+    outs = [session.run(None, {model_input.name: tensor})[0] for tensor in tensors]
+    return np.concatenate(outs, axis=0).astype(np.float32)
+
+
+class _CalibrationReader:
+    """
+    Feeds the preprocessed calibration images to quantize_static one at a time.
+    """
+
+    def __init__(self, input_name, tensors):
+        self._data = iter([{input_name: tensor} for tensor in tensors])
+
+    def get_next(self):
+        return next(self._data, None)
+
+
+class Command(BaseCommand):
+    help = 'Builds INT8/FP16 variants of the inference model and keeps those that agree with the FP32 model.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('images', nargs='*',
+                            help='Calibration/validation images or directories (defaults to sample/).')
+        parser.add_argument('--variants', default='int8-dynamic,int8-static,fp16',
+                            help='Comma separated variants to build.')
+        parser.add_argument('--min-agreement', type=float, default=1.0,
+                            help='Minimum fraction of images whose predicted class must match FP32.')
+        parser.add_argument('--max-probability-diff', type=float, default=0.05,
+                            help='Maximum absolute difference of any class probability from FP32.')
+        parser.add_argument('--keep-failed', action='store_true', help='Keep variants that fail the gate.')
+        parser.add_argument('--model', help='Name of the model in INFERENCE_MODELS to build variants of '
+                                            '(default: the default model).')
+
+    def handle(self, *args, **options):
+        try:
+            from onnxruntime import quantization
+        except ImportError as e:
+            raise CommandError(f'onnxruntime quantization tools are unavailable ({e}); pip install onnx') from e
+
+        try:
+            spec = get_model_spec(options['model'])
+        except UnknownModel as e:
+            raise CommandError(str(e))
+
+        # variants are always built from the FP32 model, whatever variant is deployed
+        model_path = spec.fp32_path
+        if not os.path.exists(model_path):
+            raise CommandError(f'Model not found: {model_path}')
+
+        variants = [v for v in options['variants'].split(',') if v]
+        unknown = [v for v in variants if v not in MODEL_VARIANTS]
+        if unknown:
+            raise CommandError(f'Unknown variants: {", ".join(unknown)}')
+
+        paths = _image_paths(options['images'])
+        if not paths:
+            raise CommandError('No calibration images found.')
+        tensors = [preprocess(read_image(path), spec.image_size, mean=spec.mean, std=spec.std) for path in paths]
+
+        reference = _predict(model_path, tensors)
+        reference_probabilities = sigmoid(reference)
+
+        report = {}
+        for variant in variants:
+            output_path = variant_path(model_path, variant)
+            self.stderr.write(f'building {variant} -> {output_path}')
+            try:
+                self.build_variant(quantization, variant, model_path, output_path, tensors)
+            except Exception as e:
+                report[variant] = {'built': False, 'error': str(e)}
+                continue
+
+            outs = _predict(output_path, tensors)
+            agreement = float(np.mean(np.argmax(outs, axis=1) == np.argmax(reference, axis=1)))
+            probability_diff = float(np.abs(sigmoid(outs) - reference_probabilities).max())
+            passed = (agreement >= options['min_agreement']
+                      and probability_diff <= options['max_probability_diff'])
+
+            report[variant] = {
+                'built': True,
+                'path': output_path,
+                'images': len(paths),
+                'agreement': agreement,
+                'max_probability_diff': probability_diff,
+                'size': os.path.getsize(output_path),
+                'passed': passed,
+            }
+            if not passed and not options['keep_failed']:
+                os.remove(output_path)
+                report[variant]['path'] = None
+
+        report['fp32'] = {'path': model_path, 'size': os.path.getsize(model_path)}
+        self.stdout.write(json.dumps(report, indent=2))
+
+    @staticmethod
+    def build_variant(quantization, variant, model_path, output_path, tensors):
+        if variant == 'int8-dynamic':
+            quantization.quantize_dynamic(model_path, output_path, weight_type=quantization.QuantType.QUInt8)
+        elif variant == 'int8-static':
+            session = onnxruntime.InferenceSession(model_path, providers=['CPUExecutionProvider'])
+            reader = _CalibrationReader(session.get_inputs()[0].name, tensors)
+            quantization.quantize_static(model_path, output_path, reader,
+                                         quant_format=quantization.QuantFormat.QDQ,
+                                         activation_type=quantization.QuantType.QUInt8,
+                                         weight_type=quantization.QuantType.QInt8,
+                                         per_channel=True)
+        elif variant == 'fp16':
+            import onnx
+            from onnxconverter_common import float16
+
+            model = float16.convert_float_to_float16(onnx.load(model_path), keep_io_types=True)
+            onnx.save(model, output_path)
@@ -0,0 +1,234 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+import csv
+import json
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+import cv2 as cv
+import numpy as np
+
+from pneumonia_app.feature_store import get_features, put_features
+from pneumonia_app.models import InferenceResult, MedicalRecord
+from pneumonia_app.onnx_inference import (
+    IMAGE_SIZE,
+    UnknownModel,
+    get_model_spec,
+    get_model_version,
+    preprocess,
+    read_image,
+    run_model,
+    sigmoid,
+)
+
+IMAGE_EXTENSIONS = ('.jpeg', '.jpg', '.png', '.bmp', '.tif', '.tiff')
+OUTPUT_FIELDS = ['key', 'model', 'result', 'probability_normal', 'probability_pneumonia', 'model_version']
+
+
+def _load(path, spec, features=None, keep=False):
+    # returns the tensor and, if keep, the model-ready copy to put into the feature store
+    if features is not None:
+        # stored copy: no decode, the row is read straight from the memory-mapped shard
+        return preprocess(features, spec.image_size, mean=spec.mean, std=spec.std), None
+
+    img = read_image(path)
+    if keep:
+        # same resize preprocess() applies, so the tensor does not change
+        img = cv.resize(img, (IMAGE_SIZE, IMAGE_SIZE))
+    return preprocess(img, spec.image_size, mean=spec.mean, std=spec.std), img if keep else None
+
+
+class Command(BaseCommand):
+    help = 'Scores images from directories/files and/or all MedicalRecord rows in batches.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('paths', nargs='*', help='Image files or directories to score.')
+        parser.add_argument('--records', action='store_true',
+                            help='Score MedicalRecord images and store the results of the default model as '
+                                 'InferenceResult rows. Images are read from the feature store, and added to '
+                                 'it when missing.')
+        parser.add_argument('--model', help='Name of the model in INFERENCE_MODELS to score with (default: the '
+                                            'default model). Other models only write to --output.')
+        parser.add_argument('--output', help='Write results to this .csv or .jsonl file.')
+        parser.add_argument('--resume', action='store_true',
+                            help='Skip images already present in --output or already scored by the current model.')
+        parser.add_argument('--batch-size', type=int, default=32)
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                            help='Number of decode/preprocess threads.')
+
+    def handle(self, *args, **options):
+        if not options['paths'] and not options['records']:
+            raise CommandError('Give at least one path or --records.')
+
+        output = options['output']
+        if output and not output.endswith(('.csv', '.jsonl')):
+            raise CommandError('--output must end with .csv or .jsonl')
+
+        try:
+            self.spec = get_model_spec(options['model'])
+        except UnknownModel as e:
+            raise CommandError(str(e))
+        # InferenceResult rows hold the prediction shown to doctors, only the default model writes them
+        self.save_records = self.spec.name == settings.INFERENCE_DEFAULT_MODEL
+        if options['records'] and not self.save_records and not output:
+            raise CommandError(f'--records with {self.spec.name}, which is not the default model, needs --output')
+        # the feature store holds IMAGE_SIZE copies
+        self.use_store = settings.FEATURE_STORE_ENABLED and self.spec.image_size == IMAGE_SIZE
+
+        self.version = get_model_version(self.spec)
+        done = self._read_done(output) if options['resume'] and output else set()
+
+        items = self._iter_items(options['paths'], options['records'], options['resume'], done)
+        output_file, write = self._open_output(output, append=options['resume'])
+
+        scored = 0
+        self.failed = 0
+        self.from_store = 0
+        start_time = time()
+        try:
+            for batch in self._batches(self._decode(items, options['workers'], options['batch_size']),
+                                       options['batch_size']):
+                outs, run_time = run_model(np.concatenate([tensor for _, _, tensor, _ in batch], axis=0), self.spec)
+                probabilities = sigmoid(outs[0])
+
+                for (key, record, _, model_img), logits, probs in zip(batch, outs[0], probabilities):
+                    # by label, the models may order their classes differently
+                    labelled = dict(zip(self.spec.classes, probs.tolist()))
+                    row = {
+                        'key': key,
+                        'model': self.spec.name,
+                        'result': self.spec.classes[int(np.argmax(logits))],
+                        'probability_normal': labelled.get('normal'),
+                        'probability_pneumonia': labelled.get('pneumonia'),
+                        'model_version': self.version,
+                    }
+                    if record is not None and self.save_records:
+                        self._save_record(record, row, run_time)
+                    if model_img is not None:
+                        put_features(record, model_img)
+                    if write is not None:
+                        write(row)
+
+                # flush every batch so an interrupted run can be resumed
+                if output_file is not None:
+                    output_file.flush()
+
+                scored += len(batch)
+                elapsed = time() - start_time
+                self.stdout.write(f'{scored} images scored, {scored / elapsed:.1f} images/s')
+        finally:
+            if output_file is not None:
+                output_file.close()
+
+        elapsed = time() - start_time
+        self.stdout.write(self.style.SUCCESS(
+            f'Scored {scored} images ({self.failed} failed, {self.from_store} from the feature store) '
+            f'in {elapsed:.1f}s, '
+            f'{scored / elapsed if elapsed else 0.:.1f} images/s'))
+
+    def _iter_items(self, paths, records, resume, done):
+        # yields (key, MedicalRecord or None, image path)
+        for path in paths:
+            if os.path.isdir(path):
+                for root, _, files in os.walk(path):
+                    for name in sorted(files):
+                        if name.lower().endswith(IMAGE_EXTENSIONS):
+                            file_path = os.path.join(root, name)
+                            if file_path not in done:
+                                yield file_path, None, file_path
+            elif path not in done:
+                yield path, None, path
+
+        if records:
+            queryset = (MedicalRecord.objects.exclude(pulmonary_image='').select_related('stored_features')
+                        .order_by('id'))
+            if resume and self.save_records:
+                queryset = queryset.exclude(inference_result__status=InferenceResult.STATUS_DONE,
+                                            inference_result__model_version=self.version)
+            for record in queryset.iterator():
+                key = f'record:{record.id}'
+                if key not in done:
+                    yield key, record, record.pulmonary_image.path
+
+    def _decode(self, items, workers, batch_size):
+        # decode and preprocess in parallel, keeping a bounded number of images in flight
+        window = max(workers, batch_size) * 2
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = deque()
+            for key, record, path in items:
+                features = get_features(record) if record is not None and self.use_store else None
+                keep = record is not None and features is None and self.use_store
+                self.from_store += features is not None
+                pending.append((key, record, executor.submit(_load, path, self.spec, features, keep)))
+                if len(pending) >= window:
+                    yield from self._finish(pending.popleft())
+            while pending:
+                yield from self._finish(pending.popleft())
+
+    def _finish(self, item):
+        key, record, future = item
+        try:
+            yield (key, record) + future.result()
+        except Exception as e:
+            self.failed += 1
+            self.stderr.write(f'{key}: {e}')
+
+    @staticmethod
+    def _batches(stream, batch_size):
+        batch = []
+        for item in stream:
+            batch.append(item)
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    @staticmethod
+    def _save_record(record, row, run_time):
+        InferenceResult.objects.update_or_create(
+            medical_record=record,
+            defaults={
+                'status': InferenceResult.STATUS_DONE,
+                'error': '',
+                'result': row['result'],
+                'probability_normal': row['probability_normal'],
+                'probability_pneumonia': row['probability_pneumonia'],
+                'model_version': row['model_version'],
+                # ms of the batch run, as cached_inference_batch reports it
+                'inference_time': run_time,
+            },
+        )
+
+    def _read_done(self, output):
+        # keys already written by a previous run with the current model
+        if not os.path.exists(output):
+            return set()
+
+        with open(output, newline='') as f:
+            if output.endswith('.csv'):
+                rows = csv.DictReader(f)
+            else:
+                rows = (json.loads(line) for line in f if line.strip())
+            return {row['key'] for row in rows
+                    if row.get('model_version') == self.version and row.get('model', self.spec.name) == self.spec.name}
+
+    @staticmethod
+    def _open_output(output, append):
+        # returns the open file and a function writing one row to it
+        if not output:
+            return None, None
+
+        exists = append and os.path.exists(output) and os.path.getsize(output) > 0
+        f = open(output, 'a' if append else 'w', newline='')
+
+        if output.endswith('.csv'):
+            csv_writer = csv.DictWriter(f, fieldnames=OUTPUT_FIELDS)
+            if not exists:
+                csv_writer.writeheader()
+            return f, csv_writer.writerow
+
+        return f, lambda row: f.write(json.dumps(row) + '\n')
@@ -0,0 +1,207 @@
+from contextlib import contextmanager
+from time import perf_counter
+import bisect
+import math
+import threading
+
+# seconds, from a cached lookup to a slow full-resolution decode
+DEFAULT_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1., 2.5, 5., 10.)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _format_labels(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value))
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f'{self.name} takes the labels {self.labelnames}, got {tuple(labels)}')
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self):
+        raise NotImplementedError
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        for suffix, labels, extra, value in self.samples():
+            lines.append(f'{self.name}{suffix}{_format_labels(self.labelnames, labels, extra)} {_format_value(value)}')
+        return lines
+
+
+class Counter(_Metric):
+    """
+    A monotonically increasing count, e.g. cache hits.
+    """
+    type = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return [('_total', key, (), value) for key, value in self._values.items()]
+
+
+class Histogram(_Metric):
+    """
+    Observations (e.g. durations in seconds) counted into cumulative buckets, plus their sum and count.
+    """
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._values = {}
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # one count per bucket, the +Inf bucket, then the sum
+                counts = self._values[key] = [0] * (len(self.buckets) + 1) + [0.]
+            counts[index] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """
+        Observes the duration of the with block in seconds.
+        """
+        start_time = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(perf_counter() - start_time, **labels)
+
+    def samples(self):
+        with self._lock:
+            values = {key: list(counts) for key, counts in self._values.items()}
+
+        samples = []
+        for key, counts in values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                samples.append(('_bucket', key, (('le', _format_value(bound)),), cumulative))
+            samples.append(('_sum', key, (), counts[-1]))
+            samples.append(('_count', key, (), cumulative))
+        return samples
+
+
+class CallbackMetric(_Metric):
+    """
+    A gauge or counter read from existing statistics when the metrics are scraped.
+
+    fn returns a number, or a {label values tuple: number} dict when labelnames are given.
+    """
+
+    def __init__(self, name, documentation, fn, labelnames=(), type='gauge'):
+        super().__init__(name, documentation, labelnames)
+        self.fn = fn
+        self.type = type
+
+    def samples(self):
+        suffix = '_total' if self.type == 'counter' else ''
+        values = self.fn()
+        if not self.labelnames:
+            values = {(): values}
+        return [(suffix, key, (), value) for key, value in values.items() if value is not None]
+
+
+class Registry:
+    """
+    The metrics of this process, rendered in the Prometheus text format.
+
+    Note:
+    Metrics are kept per process. With several worker processes every process serves its own
+    values on /metrics, so scrape each of them (or run a single process per port).
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            # modules reloaded by the autoreloader register their metrics again
+            self._metrics[metric.name] = metric
+        return metric
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+
+        lines = []
+        for metric in metrics:
+            try:
+                lines.extend(metric.render())
+            except Exception:
+                # a failing callback must not take the other metrics down with it
+                continue
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+
+def counter(name, documentation, labelnames=()):
+    return registry.register(Counter(name, documentation, labelnames))
+
+
+def histogram(name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+    return registry.register(Histogram(name, documentation, labelnames, buckets))
+
+
+def callback(name, documentation, fn, labelnames=(), type='gauge'):
+    return registry.register(CallbackMetric(name, documentation, fn, labelnames, type))
+
+
+# inference path
+DECODE_SECONDS = histogram('pulmoinsight_decode_seconds', 'Time spent decoding uploaded images.')
+PREPROCESS_SECONDS = histogram('pulmoinsight_preprocess_seconds', 'Time spent turning decoded images into tensors.')
+MODEL_RUN_SECONDS = histogram('pulmoinsight_model_run_seconds', 'Time spent in InferenceSession.run per batch.',
+                              ('model',))
+MODEL_BATCH_SIZE = histogram('pulmoinsight_model_batch_size', 'Images per model run.', ('model',),
+                             buckets=(1, 2, 4, 8, 16, 32, 64))
+SESSION_CACHE = counter('pulmoinsight_session_cache', 'Model session lookups, by hit or (re)load.', ('result',))
+FEATURE_STORE = counter('pulmoinsight_feature_store', 'Feature store lookups of preprocessed record images, '
+                        'by hit or miss.', ('result',))
+
+# requests
+REQUEST_SECONDS = histogram('pulmoinsight_request_seconds', 'Time spent handling requests.',
+                            ('view', 'method', 'status'))
+TEMPLATE_RENDER_SECONDS = histogram('pulmoinsight_template_render_seconds', 'Time spent rendering templates.',
+                                    ('template',))
+DB_QUERIES = histogram('pulmoinsight_db_queries', 'Database queries per request.', ('view',),
+                       buckets=QUERY_COUNT_BUCKETS)
+DB_QUERY_SECONDS = histogram('pulmoinsight_db_query_seconds', 'Time spent in database queries per request.',
+                             ('view',))
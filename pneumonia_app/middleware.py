@@ -0,0 +1,98 @@
+from contextvars import ContextVar
+from time import perf_counter
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+
+from .metrics import DB_QUERIES, DB_QUERY_SECONDS, REQUEST_SECONDS
+
+
+class _QueryStats:
+    __slots__ = ('count', 'duration')
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.
+
+
+# queries of the request being handled; sync_to_async copies the context, so the ORM calls of
+# async views made in the sync thread are counted too
+_query_stats = ContextVar('query_stats', default=None)
+
+
+def record_queries(execute, sql, params, many, context):
+    """
+    Database execute wrapper counting the queries (and their time) of the current request.
+    """
+    stats = _query_stats.get()
+    if stats is None:
+        return execute(sql, params, many, context)
+
+    start_time = perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        stats.count += 1
+        stats.duration += perf_counter() - start_time
+
+
+def install_query_recorder(sender, connection, **kwargs):
+    """
+    connection_created receiver adding record_queries to every new database connection.
+    """
+    if settings.METRICS_ENABLED and record_queries not in connection.execute_wrappers:
+        connection.execute_wrappers.insert(0, record_queries)
+
+
+class MetricsMiddleware:
+    """
+    Metrics Middleware Class
+
+    Note:
+    Records the duration, database query count and database time of every request by view,
+    see metrics.py. Works for sync and async views alike.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not settings.METRICS_ENABLED:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+
+        token = _query_stats.set(_QueryStats())
+        start_time = perf_counter()
+        try:
+            response = self.get_response(request)
+            self._record(request, response, perf_counter() - start_time)
+        finally:
+            _query_stats.reset(token)
+        return response
+
+    async def __acall__(self, request):
+        token = _query_stats.set(_QueryStats())
+        start_time = perf_counter()
+        try:
+            response = await self.get_response(request)
+            self._record(request, response, perf_counter() - start_time)
+        finally:
+            _query_stats.reset(token)
+        return response
+
+    @staticmethod
+    def _record(request, response, duration):
+        match = request.resolver_match
+        view = match.view_name if match is not None else 'unmatched'
+        stats = _query_stats.get()
+
+        REQUEST_SECONDS.observe(duration, view=view, method=request.method, status=response.status_code)
+        DB_QUERIES.observe(stats.count, view=view)
+        DB_QUERY_SECONDS.observe(stats.duration, view=view)
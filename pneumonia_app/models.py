@@ -3,6 +3,9 @@ from django.contrib.auth.models import AbstractUser
 
 from django.utils import timezone
 from os.path import basename
+import uuid
+
+from .storage import get_content_addressed_storage
 
 
 class UploadedImage(models.Model):
@@ -12,7 +15,7 @@ class UploadedImage(models.Model):
     Note:
     This class defines a model for storing uploaded images.
     """
-    image = models.ImageField(upload_to='images/')
+    image = models.ImageField(upload_to='images/', storage=get_content_addressed_storage)
 
 
 class CustomUser(AbstractUser):
@@ -31,6 +34,10 @@ class Patient(models.Model):
     Patient Information Class
     """
 
+    # link to the user account owning this profile
+    user = models.OneToOneField(CustomUser, on_delete=models.SET_NULL, null=True, blank=True,
+                                related_name='patient_profile')
+
     # Basic Information
     name = models.CharField(max_length=100)
     gender = models.CharField(max_length=10)
@@ -52,6 +59,11 @@ class Patient(models.Model):
 
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            # profiles are looked up by the user name on every patient page
+            models.Index(fields=['name'], name='patient_name_idx'),
+            models.Index(fields=['-created_at'], name='patient_created_idx'),
+        ]
 
 
 class Doctor(models.Model):
@@ -59,6 +71,10 @@ class Doctor(models.Model):
     Medical Information Class
     """
 
+    # link to the user account owning this profile
+    user = models.OneToOneField(CustomUser, on_delete=models.SET_NULL, null=True, blank=True,
+                                related_name='doctor_profile')
+
     # Basic Information
     name = models.CharField(max_length=100)
     gender = models.CharField(max_length=10)
@@ -74,6 +90,9 @@ class Doctor(models.Model):
 
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['name'], name='doctor_name_idx'),
+        ]
 
 
 class MedicalRecord(models.Model):
@@ -88,7 +107,8 @@ class MedicalRecord(models.Model):
 
     patient = models.ForeignKey(Patient, on_delete=models.CASCADE, related_name='medical_records')
     image_name = models.CharField(max_length=255, blank=True, null=False, default='')  # 图像名称
-    pulmonary_image = models.ImageField(upload_to='pulmonary_images/', blank=True, null=False, default='')
+    pulmonary_image = models.ImageField(upload_to='pulmonary_images/', storage=get_content_addressed_storage,
+                                        blank=True, null=False, default='')
     medical_history = models.TextField(blank=True, null=False, default='')
     symptoms = models.TextField(blank=True, null=False, default='')
     other = models.TextField(blank=True, null=False, default='')
@@ -111,6 +131,86 @@ class MedicalRecord(models.Model):
     def get_patient_medical_image_name(self):
         return basename(self.pulmonary_image.name)
 
+    class Meta:
+        indexes = [
+            # latest record of a patient
+            models.Index(fields=['patient', '-upload_time'], name='record_patient_upload_idx'),
+        ]
+
+
+class InferenceResult(models.Model):
+    """
+    Inference Result Class
+
+    Note:
+    Holds the model prediction for a MedicalRecord. The job is queued when the record is
+    uploaded and run by the local worker pool in jobs.py, so the doctor's diagnose page
+    can show the stored result instead of running the model.
+    """
+    STATUS_PENDING = 'pending'
+    STATUS_RUNNING = 'running'
+    STATUS_DONE = 'done'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_PENDING, 'Pending'),
+        (STATUS_RUNNING, 'Running'),
+        (STATUS_DONE, 'Done'),
+        (STATUS_FAILED, 'Failed'),
+    ]
+
+    medical_record = models.OneToOneField(MedicalRecord, on_delete=models.CASCADE, related_name='inference_result')
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=STATUS_PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    error = models.TextField(blank=True, null=False, default='')
+
+    # Prediction
+    result = models.CharField(max_length=20, blank=True, null=False, default='')
+    probability_normal = models.FloatField(null=True, blank=True)
+    probability_pneumonia = models.FloatField(null=True, blank=True)
+    inference_time = models.FloatField(null=True, blank=True)
+    model_version = models.CharField(max_length=64, blank=True, null=False, default='')
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f'Inference for record {self.medical_record_id} - {self.status}'
+
+    def get_probabilities(self):
+        # same nesting as the probabilities returned by inference_resnet18sam
+        return [[[self.probability_normal, self.probability_pneumonia]]]
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status'], name='inference_status_idx'),
+        ]
+
+
+class StoredFeatures(models.Model):
+    """
+    Stored Features Class
+
+    Note:
+    Index of the feature store (see feature_store.py): the shard file and row holding the
+    preprocessed, model-ready copy of a MedicalRecord's image. The row is only valid for the
+    image it was made from, a record whose image changed is preprocessed again.
+    """
+
+    medical_record = models.OneToOneField(MedicalRecord, on_delete=models.CASCADE, related_name='stored_features')
+    image = models.CharField(max_length=255)  # pulmonary_image name the row was made from
+    shard = models.PositiveIntegerField()
+    row = models.PositiveIntegerField()
+
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f'Features of record {self.medical_record_id} - shard {self.shard} row {self.row}'
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['shard', 'row'], name='stored_features_slot_unique'),
+        ]
+
 
 class DiagnosisRecord(models.Model):
     """
@@ -139,6 +239,12 @@ class DiagnosisRecord(models.Model):
 
     class Meta:
         ordering = ['-created_at']  #
+        indexes = [
+            # latest diagnosis of a patient
+            models.Index(fields=['patient', '-created_at'], name='diagnosis_patient_created_idx'),
+            # pending diagnoses on the doctor's home page
+            models.Index(fields=['diagnosis_status'], name='diagnosis_status_idx'),
+        ]
 
 
 class PatientPost(models.Model):
@@ -152,6 +258,11 @@ class PatientPost(models.Model):
     def __str__(self):
         return f'{self.patient.name} - {self.created_at}'
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['-created_at'], name='patient_post_created_idx'),
+        ]
+
 
 class PatientComment(models.Model):
     """
@@ -165,6 +276,11 @@ class PatientComment(models.Model):
     def __str__(self):
         return f'{self.patient.name} - {self.created_at}'
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['post', '-created_at'], name='patient_comment_post_idx'),
+        ]
+
 
 class DoctorPost(models.Model):
     """
@@ -177,6 +293,11 @@ class DoctorPost(models.Model):
     def __str__(self):
         return f'{self.doctor.name} - {self.created_at}'
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['-created_at'], name='doctor_post_created_idx'),
+        ]
+
 
 class DoctorComment(models.Model):
     """
@@ -189,3 +310,51 @@ class DoctorComment(models.Model):
 
     def __str__(self):
         return f'{self.doctor.name} - {self.created_at}'
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['post', '-created_at'], name='doctor_comment_post_idx'),
+        ]
+
+
+class ChunkedUpload(models.Model):
+    """
+    Chunked Upload Class
+
+    Note:
+    A resumable upload in progress. The client sends the file in chunks (see uploads.py),
+    the bytes received so far are kept in a temporary file and `offset` tells the client
+    where to resume after a dropped connection. Once complete, the file is moved to its
+    content-addressed name in `stored_name`.
+    """
+    TARGET_MEDICAL_RECORD = 'medical_record'
+    TARGET_IMAGE = 'image'
+    TARGET_CHOICES = [
+        (TARGET_MEDICAL_RECORD, 'Medical record image'),
+        (TARGET_IMAGE, 'Analyzed image'),
+    ]
+
+    STATUS_UPLOADING = 'uploading'
+    STATUS_COMPLETE = 'complete'
+    STATUS_CHOICES = [
+        (STATUS_UPLOADING, 'Uploading'),
+        (STATUS_COMPLETE, 'Complete'),
+    ]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name='chunked_uploads')
+    target = models.CharField(max_length=20, choices=TARGET_CHOICES, default=TARGET_MEDICAL_RECORD)
+    filename = models.CharField(max_length=255)
+    size = models.BigIntegerField()
+    offset = models.BigIntegerField(default=0)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=STATUS_UPLOADING)
+
+    # Set once the upload is complete
+    sha256 = models.CharField(max_length=64, blank=True, null=False, default='')
+    stored_name = models.CharField(max_length=255, blank=True, null=False, default='')
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f'{self.filename} - {self.offset}/{self.size}'
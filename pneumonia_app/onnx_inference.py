@@ -1,12 +1,28 @@
 from django.conf import settings
 
 from time import time
+import hashlib
+import logging
+import threading
 import cv2 as cv
 import numpy as np
 import os
 
 import onnxruntime
 
+from .batching import InferenceBatcher
+from .decoding import decode_grayscale
+from .metrics import (
+    DECODE_SECONDS,
+    MODEL_BATCH_SIZE,
+    MODEL_RUN_SECONDS,
+    PREPROCESS_SECONDS,
+    SESSION_CACHE,
+    callback,
+)
+
+logger = logging.getLogger(__name__)
+
 classes = ('normal', 'pneumonia')
 IMAGE_SIZE = 224
 
@@ -16,44 +32,437 @@ def sigmoid(x):
     return 1 / (1 + np.exp(-np.array(x)))
 
 
-def to_numpy(tensor):
-    return tensor.detach().cpu().numpy() if tensor.requires_grad else tensor.cpu().numpy()
+def read_image(image_file):
+    """
+    Reads an image file (path or file-like object) into a grayscale uint8 array.
 
+    Large JPEGs are decoded at a reduced resolution and images above settings.IMAGE_MAX_PIXELS
+    raise ImageTooLarge, see decoding.decode_grayscale.
+    """
+    with DECODE_SECONDS.time():
+        return decode_grayscale(image_file)
 
-def get_test_transform():
-    from torchvision import transforms
 
-    return transforms.Compose([
-        transforms.ToTensor(),  # convert image to tensor
-        transforms.Resize([IMAGE_SIZE, IMAGE_SIZE]),  # resize image
-    ])
+def preprocess(img, image_size=IMAGE_SIZE, out=None, mean=0., std=1.):
+    """
+    Converts an HxW (grayscale) or HxWxC uint8 image into a float32 (1, C, H, W) tensor.
 
+    Args:
+        img: Image array as returned by PIL/OpenCV.
+        image_size: Side length the image is resized to.
+        out: Optional preallocated float32 array of shape (1, C, image_size, image_size)
+            the tensor is written into.
+        mean, std: Normalization applied after scaling, a number or one value per channel
+            (like torchvision's Normalize).
 
-def inference_resnet18sam(img, image_size=224):
-    model_path = os.path.join(settings.STATICFILES_DIRS[0], 'model_data', 'resnet18-lite.onnx')
+    Returns:
+        The filled tensor, scaled to [0, 1] the same way as torchvision's ToTensor.
+    """
+    resized_img = cv.resize(img, (image_size, image_size))
+    if resized_img.ndim == 2:
+        resized_img = resized_img[:, :, np.newaxis]
 
-    # initialize session
-    session = onnxruntime.InferenceSession(model_path)
-    session.set_providers(['CPUExecutionProvider'])
+    channels = resized_img.shape[2]
+    if out is None:
+        out = np.empty((1, channels, image_size, image_size), dtype=np.float32)
 
-    # read image
-    src = img
+    # HWC -> CHW is a view; the division writes straight into the output buffer
+    np.divide(resized_img.transpose(2, 0, 1), np.float32(255.), out=out[0], dtype=np.float32, casting='unsafe')
 
-    # pre-process
-    resized_img = cv.resize(src, (image_size, image_size))
-    img = get_test_transform()(resized_img)
-    img = img.unsqueeze_(0)
+    if np.any(np.asarray(mean) != 0.) or np.any(np.asarray(std) != 1.):
+        np.subtract(out[0], np.asarray(mean, dtype=np.float32).reshape(-1, 1, 1), out=out[0])
+        np.divide(out[0], np.asarray(std, dtype=np.float32).reshape(-1, 1, 1), out=out[0])
+    return out
+
+
+_buffers = threading.local()
+
+
+def _get_input_buffer(shape):
+    # every request thread reuses its own input buffer instead of allocating a new one
+    buffer = getattr(_buffers, 'input', None)
+    if buffer is None or buffer.shape != shape:
+        buffer = _buffers.input = np.empty(shape, dtype=np.float32)
+    return buffer
+
+
+# quantized variants built by `manage.py quantize_model`, stored next to the FP32 model
+MODEL_VARIANTS = ('int8-dynamic', 'int8-static', 'fp16')
+
+
+def variant_path(model_path, variant):
+    """
+    Returns the file path of a model variant, e.g. resnet18-lite-int8-dynamic.onnx.
+    """
+    if variant == 'fp32':
+        return model_path
+    if variant not in MODEL_VARIANTS:
+        raise ValueError(f'Unknown model variant: {variant}')
+
+    base, ext = os.path.splitext(model_path)
+    return f'{base}-{variant}{ext}'
+
+
+class UnknownModel(ValueError):
+    """
+    The requested model is not one of settings.INFERENCE_MODELS.
+    """
+
+
+class ModelVersionMismatch(RuntimeError):
+    """
+    The model file on disk is not the version its entry in settings.INFERENCE_MODELS is pinned to.
+    """
+
+
+class ModelSpec:
+    """
+    An entry of settings.INFERENCE_MODELS: where the model is and how its inputs and outputs are handled.
+    """
+
+    def __init__(self, name, path=None, variant=None, version=None, image_size=IMAGE_SIZE, mean=0., std=1.,
+                 classes=classes):
+        self.name = name
+        # the default model follows INFERENCE_MODEL_PATH and INFERENCE_MODEL_VARIANT
+        self.fp32_path = path or settings.INFERENCE_MODEL_PATH
+        self.path = variant_path(self.fp32_path, variant or settings.INFERENCE_MODEL_VARIANT)
+        # prefix of the content hash (see ModelRegistry.get_version) the model must have, if any
+        self.version = version
+        self.image_size = image_size
+        self.mean = mean
+        self.std = std
+        self.classes = tuple(classes)
+        # predictions also depend on the preprocessing and the labels, so entries sharing a
+        # model file but not these never share cached predictions
+        self.config_hash = hashlib.sha256(
+            repr((self.image_size, self.mean, self.std, self.classes)).encode()).hexdigest()[:8]
+
+
+def get_model_spec(name=None):
+    """
+    Returns the ModelSpec of the named model, or of settings.INFERENCE_DEFAULT_MODEL.
+
+    Raises:
+        UnknownModel: No such model in settings.INFERENCE_MODELS.
+    """
+    if isinstance(name, ModelSpec):
+        return name
+    name = name or settings.INFERENCE_DEFAULT_MODEL
+    try:
+        config = settings.INFERENCE_MODELS[name]
+    except KeyError:
+        raise UnknownModel(f'Unknown model: {name}, expected one of {", ".join(settings.INFERENCE_MODELS)}')
+    return ModelSpec(name, **config)
+
+
+def get_model_path():
+    """
+    Returns the path of the default ONNX model used for inference, honouring its variant.
+    """
+    return get_model_spec().path
+
+
+GRAPH_OPTIMIZATION_LEVELS = {
+    'disabled': onnxruntime.GraphOptimizationLevel.ORT_DISABLE_ALL,
+    'basic': onnxruntime.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+    'extended': onnxruntime.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+    'all': onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL,
+}
+
+EXECUTION_MODES = {
+    'sequential': onnxruntime.ExecutionMode.ORT_SEQUENTIAL,
+    'parallel': onnxruntime.ExecutionMode.ORT_PARALLEL,
+}
+
+
+def build_session_options(**overrides):
+    """
+    Builds SessionOptions from settings.INFERENCE_SESSION_OPTIONS, updated with overrides.
+    """
+    config = dict(settings.INFERENCE_SESSION_OPTIONS, **overrides)
+
+    session_options = onnxruntime.SessionOptions()
+    session_options.intra_op_num_threads = config.get('intra_op_num_threads', 0)
+    session_options.inter_op_num_threads = config.get('inter_op_num_threads', 0)
+    session_options.graph_optimization_level = GRAPH_OPTIMIZATION_LEVELS[config.get('graph_optimization_level', 'all')]
+    session_options.execution_mode = EXECUTION_MODES[config.get('execution_mode', 'sequential')]
+    session_options.enable_cpu_mem_arena = config.get('enable_cpu_mem_arena', True)
+    session_options.enable_mem_pattern = config.get('enable_mem_pattern', True)
+    return session_options
+
+
+def _optimized_model_path(model_path, version):
+    # the optimized graph depends on the optimization level and the hardware it was built on
+    cache_dir = settings.INFERENCE_OPTIMIZED_MODEL_DIR
+    if not cache_dir:
+        return None
+
+    level = settings.INFERENCE_SESSION_OPTIONS.get('graph_optimization_level', 'all')
+    name = os.path.splitext(os.path.basename(model_path))[0]
+    return os.path.join(cache_dir, f'{name}-{version}-{level}.onnx')
+
+
+def _current_rss():
+    """
+    Returns the resident set size of the current process in bytes, or None if unavailable.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+
+class _ModelEntry:
+    """
+    A loaded model together with the metadata used for reloading and reporting.
+    """
+
+    def __init__(self, session, mtime, version, load_time, memory):
+        self.session = session
+        self.mtime = mtime
+        self.version = version
+        self.load_time = load_time
+        self.memory = memory
+        self.loads = 1
+
+
+class ModelRegistry:
+    """
+    Model Registry Class
+
+    Note:
+    Each model file is loaded into an InferenceSession once per process and shared by all
+    requests (InferenceSession.run is thread-safe). The file modification time is checked on
+    every lookup, so replacing the .onnx file on disk reloads the model on the next request.
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def _load(self, model_path, mtime):
+        rss_before = _current_rss()
+        start_time = time()
+        with open(model_path, 'rb') as f:
+            model_bytes = f.read()
+
+        # the version is derived from the bytes actually loaded, so it always matches the session
+        version = hashlib.sha256(model_bytes).hexdigest()[:16]
+
+        optimized_path = _optimized_model_path(model_path, version)
+        if optimized_path and os.path.exists(optimized_path):
+            # reuse the graph optimized by an earlier load instead of optimizing again
+            session_options = build_session_options(graph_optimization_level='disabled')
+            session = onnxruntime.InferenceSession(optimized_path, session_options, providers=['CPUExecutionProvider'])
+        else:
+            session_options = build_session_options()
+            if optimized_path:
+                os.makedirs(os.path.dirname(optimized_path), exist_ok=True)
+                session_options.optimized_model_filepath = optimized_path
+            session = onnxruntime.InferenceSession(model_bytes, session_options, providers=['CPUExecutionProvider'])
+
+        load_time = 1000. * (time() - start_time)
+        rss_after = _current_rss()
+        memory = rss_after - rss_before if rss_before is not None and rss_after is not None else None
+        return _ModelEntry(session, mtime, version, load_time, memory)
+
+    def _get_entry(self, model_path):
+        mtime = os.stat(model_path).st_mtime_ns
+
+        entry = self._entries.get(model_path)
+        if entry is not None and entry.mtime == mtime:
+            SESSION_CACHE.inc(result='hit')
+            return entry
+
+        SESSION_CACHE.inc(result='miss')
+        with self._lock:
+            # another thread may have loaded the model while we were waiting
+            entry = self._entries.get(model_path)
+            if entry is None or entry.mtime != mtime:
+                loads = entry.loads + 1 if entry is not None else 1
+                entry = self._load(model_path, mtime)
+                entry.loads = loads
+                self._entries[model_path] = entry
+
+        return entry
+
+    def get_session(self, model_path=None):
+        """
+        Returns the shared InferenceSession for model_path, loading or reloading it if needed.
+        """
+        return self._get_entry(model_path or get_model_path()).session
+
+    def get_version(self, model_path=None):
+        """
+        Returns a short content hash identifying the currently loaded version of model_path.
+        """
+        return self._get_entry(model_path or get_model_path()).version
+
+    def unload(self, model_path=None):
+        """
+        Drops the cached session for model_path, or every cached session if no path is given.
+        """
+        with self._lock:
+            if model_path is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(model_path, None)
+
+    def stats(self):
+        """
+        Returns load time (ms), memory use (bytes) and load count for every cached model.
+        """
+        return {
+            path: {
+                'load_time': entry.load_time,
+                'memory': entry.memory,
+                'loads': entry.loads,
+                'mtime': entry.mtime,
+                'version': entry.version,
+            }
+            for path, entry in list(self._entries.items())
+        }
+
+
+# process-wide registry shared by every request handled in this worker
+model_registry = ModelRegistry()
+
+
+def get_model_version(model=None):
+    """
+    Returns the version of a model (name or ModelSpec, default model if None) as loaded.
+
+    Raises:
+        ModelVersionMismatch: The model is pinned to another version.
+    """
+    spec = get_model_spec(model)
+    version = model_registry.get_version(spec.path)
+    if spec.version and not version.startswith(spec.version):
+        raise ModelVersionMismatch(f'{spec.name} is pinned to version {spec.version}, but {spec.path} is {version}')
+    return version
+
+
+def run_model(batch, model=None):
+    """
+    Runs a preprocessed (N, C, H, W) batch through the shared session of a model (default model if None).
+
+    Returns the session outputs and the run time in milliseconds. Models exported with a
+    fixed batch dimension of 1 are run one image at a time. With INFERENCE_IO_BINDING the
+    outputs are per-thread buffers that the next run in the same thread overwrites.
+    """
+    spec = get_model_spec(model)
+    session = model_registry.get_session(spec.path)
+    model_input = session.get_inputs()[0]
 
-    # prepare inputs and get prediction
-    inputs = {session.get_inputs()[0].name: to_numpy(img)}
     start_time = time()
-    outs = session.run(None, inputs)
+    if len(batch) > 1 and model_input.shape[0] == 1:
+        runs = [session.run(None, {model_input.name: batch[i:i + 1]}) for i in range(len(batch))]
+        outs = [np.concatenate(out, axis=0) for out in zip(*runs)]
+    elif settings.INFERENCE_IO_BINDING:
+        outs = _run_with_io_binding(session, model_input.name, batch)
+    else:
+        outs = session.run(None, {model_input.name: batch})
     end_time = time()
 
+    MODEL_RUN_SECONDS.observe(end_time - start_time, model=spec.name)
+    MODEL_BATCH_SIZE.observe(len(batch), model=spec.name)
+    return outs, 1000. * (end_time - start_time)
+
+
+def _get_output_buffer(name, shape):
+    buffers = getattr(_buffers, 'outputs', None)
+    if buffers is None:
+        buffers = _buffers.outputs = {}
+
+    buffer = buffers.get(name)
+    if buffer is None or buffer.shape != shape:
+        buffer = buffers[name] = np.empty(shape, dtype=np.float32)
+    return buffer
+
+
+def _run_with_io_binding(session, input_name, batch):
+    # bind the input in place and write outputs into preallocated buffers, avoiding the
+    # allocations session.run makes for every call
+    binding = session.io_binding()
+    binding.bind_cpu_input(input_name, np.ascontiguousarray(batch))
+
+    outs = []
+    for output in session.get_outputs():
+        shape = (len(batch),) + tuple(output.shape[1:])
+        if all(isinstance(dim, int) for dim in shape) and output.type == 'tensor(float)':
+            buffer = _get_output_buffer(output.name, shape)
+            binding.bind_output(output.name, 'cpu', element_type=np.float32, shape=shape,
+                                buffer_ptr=buffer.ctypes.data)
+            outs.append(buffer)
+        else:
+            binding.bind_output(output.name, 'cpu')
+            outs.append(None)
+
+    session.run_with_iobinding(binding)
+
+    # outputs with dynamic shapes were allocated by onnxruntime
+    allocated = binding.copy_outputs_to_cpu()
+    return [out if out is not None else allocated[i] for i, out in enumerate(outs)]
+
+
+# model name -> InferenceBatcher, images of different models are never batched together
+_batchers = {}
+_batcher_lock = threading.Lock()
+
+
+def get_batcher(model=None):
+    """
+    Returns the process-wide InferenceBatcher of a model, or None if batching is disabled in settings.
+    """
+    if not settings.INFERENCE_BATCHING:
+        return None
+
+    name = get_model_spec(model).name
+    batcher = _batchers.get(name)
+    if batcher is None:
+        with _batcher_lock:
+            batcher = _batchers.get(name)
+            if batcher is None:
+                # the spec is looked up on every run, so changed settings apply right away
+                batcher = _batchers[name] = InferenceBatcher(lambda batch: run_model(batch, name),
+                                                             max_batch_size=settings.INFERENCE_BATCH_MAX_SIZE,
+                                                             max_wait_ms=settings.INFERENCE_BATCH_MAX_WAIT_MS)
+    return batcher
+
+
+callback('pulmoinsight_batcher_queue_depth', 'Images waiting for the inference batcher.',
+         lambda: {(name,): batcher.stats()['queue_depth'] for name, batcher in list(_batchers.items())},
+         labelnames=('model',))
+
+
+def inference_resnet18sam(img, image_size=None, model=None):
+    """
+    Predicts a decoded image with a model of settings.INFERENCE_MODELS (default model if None).
+
+    Returns:
+        (run time in ms, label, probabilities of every class nested as (1, 1, classes)).
+    """
+    spec = get_model_spec(model)
+    image_size = image_size or spec.image_size
+
+    # pre-process
+    channels = 1 if img.ndim == 2 else img.shape[2]
+    with PREPROCESS_SECONDS.time():
+        tensor = preprocess(img, image_size, out=_get_input_buffer((1, channels, image_size, image_size)),
+                            mean=spec.mean, std=spec.std)
+
+    # get prediction, batched together with concurrent requests if enabled
+    batcher = get_batcher(spec)
+    if batcher is not None:
+        outs, run_time = batcher.run(tensor)
+    else:
+        outs, run_time = run_model(tensor, spec)
+
     probabilities = sigmoid(outs)
-    print("probabilities:", outs)
+    logger.debug('probabilities: %s', outs)
 
     # post-process
-    res = classes[np.argmax(outs).item()]
+    res = spec.classes[np.argmax(outs).item()]
 
-    return 1000. * (end_time - start_time), res, probabilities
+    return run_time, res, probabilities
@@ -0,0 +1,252 @@
+from collections import OrderedDict
+from time import time
+import hashlib
+import io
+import threading
+
+from django.conf import settings
+from django.core.cache import caches
+
+import numpy as np
+
+from .decoding import ImageTooLarge, InvalidImage
+from .derivatives import load_model_input
+from .metrics import PREPROCESS_SECONDS, callback
+from .onnx_inference import (
+    IMAGE_SIZE,
+    get_model_spec,
+    get_model_version,
+    inference_resnet18sam,
+    preprocess,
+    read_image,
+    run_model,
+    sigmoid,
+)
+from .shadow import maybe_compare
+
+
+def content_hash(data):
+    """
+    Returns the SHA-256 hex digest of the given image bytes.
+    """
+    return hashlib.sha256(data).hexdigest()
+
+
+class PredictionCache:
+    """
+    Prediction Cache Class
+
+    Note:
+    Predictions are keyed by image content hash plus model version and the hash of the model's
+    preprocessing and labels (ModelSpec.config_hash), so a re-uploaded copy of the same X-ray
+    hits the cache while a new model file, or another entry of settings.INFERENCE_MODELS using
+    the same file, never sees those results. Every model has its own current version. Lookups go
+    through an in-process LRU first and then the persistent Django cache named by
+    settings.INFERENCE_CACHE_ALIAS.
+    """
+
+    def __init__(self, max_size=256):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        # model name -> version
+        self._versions = {}
+
+        self.hits = 0
+        self.persistent_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _persistent():
+        return caches[settings.INFERENCE_CACHE_ALIAS]
+
+    def _check_version(self, version, model):
+        # results of an older version of a model can never be hit again, so free the memory right away
+        if version != self._versions.get(model):
+            with self._lock:
+                old_version = self._versions.get(model)
+                if version != old_version:
+                    if old_version is not None:
+                        prefix = f'prediction:{old_version}:'
+                        for key in [key for key in self._entries if key.startswith(prefix)]:
+                            del self._entries[key]
+                    self._versions[model] = version
+
+    def get(self, digest, version, model=None, config=''):
+        self._check_version(version, model)
+        key = f'prediction:{version}:{config}:{digest}'
+
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return value
+
+        value = self._persistent().get(key)
+        if value is not None:
+            self.persistent_hits += 1
+            self._remember(key, value)
+            return value
+
+        self.misses += 1
+        return None
+
+    def set(self, digest, version, value, model=None, config=''):
+        self._check_version(version, model)
+        key = f'prediction:{version}:{config}:{digest}'
+
+        self._persistent().set(key, value)
+        self._remember(key, value)
+
+    def _remember(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+        self._persistent().clear()
+
+    def stats(self):
+        return {
+            'size': len(self._entries),
+            'max_size': self.max_size,
+            'versions': dict(self._versions),
+            'hits': self.hits,
+            'persistent_hits': self.persistent_hits,
+            'misses': self.misses,
+        }
+
+
+prediction_cache = PredictionCache(max_size=settings.INFERENCE_CACHE_SIZE)
+
+callback('pulmoinsight_prediction_cache', 'Prediction cache lookups, by in-process hit, persistent hit or miss.',
+         lambda: {('memory',): prediction_cache.hits, ('persistent',): prediction_cache.persistent_hits,
+                  ('miss',): prediction_cache.misses},
+         labelnames=('result',), type='counter')
+
+
+def cached_inference(image_file, model=None, shadow=True, features=None):
+    """
+    Runs inference_resnet18sam on an image file, reusing earlier predictions for identical images.
+
+    Args:
+        image_file: Path or file-like object of the uploaded image. The derivatives of an
+            image given by path are created if missing (see derivatives.py).
+        model: Name of the model in settings.INFERENCE_MODELS, the default model if None.
+        shadow: Let settings.INFERENCE_SHADOW_MODEL predict a sample of the images not found
+            in the cache in the background and compare (see shadow.py).
+        features: The IMAGE_SIZE x IMAGE_SIZE grayscale copy of the image if the caller has
+            it, e.g. from the feature store (see feature_store.py), used instead of decoding.
+
+    Returns:
+        The (inference_time, inference_result, inference_probabilities) tuple of
+        inference_resnet18sam. On a cache hit the stored model run time is returned.
+    """
+    if hasattr(image_file, 'read'):
+        data = image_file.read()
+    else:
+        with open(image_file, 'rb') as f:
+            data = f.read()
+
+    spec = get_model_spec(model)
+    digest = content_hash(data)
+    version = get_model_version(spec)
+
+    cached = prediction_cache.get(digest, version, spec.name, spec.config_hash)
+    if cached is not None:
+        inference_time, inference_result = cached['inference_time'], cached['result']
+        inference_probabilities = np.array(cached['probabilities'], dtype=np.float32)
+    else:
+        if features is not None and spec.image_size == IMAGE_SIZE:
+            img = features
+        elif hasattr(image_file, 'read') or spec.image_size != IMAGE_SIZE:
+            img = read_image(io.BytesIO(data))
+        else:
+            # uploaded images have a small model-ready copy, saving the full decode and resize
+            img = load_model_input(image_file)
+
+        inference_time, inference_result, inference_probabilities = inference_resnet18sam(img, model=spec)
+        prediction_cache.set(digest, version, {
+            'inference_time': inference_time,
+            'result': inference_result,
+            'probabilities': inference_probabilities.tolist(),
+        }, spec.name, spec.config_hash)
+        # only fresh runs are compared, a hit would count the same primary prediction again
+        if shadow:
+            maybe_compare(data, spec, inference_result, inference_probabilities, inference_time)
+
+    return inference_time, inference_result, inference_probabilities
+
+
+def cached_inference_batch(images, model=None):
+    """
+    Predicts a list of images (bytes) with a single model run for every image not cached yet.
+
+    Args:
+        images: Encoded image files, e.g. the bodies of uploaded files.
+        model: Name of the model in settings.INFERENCE_MODELS, the default model if None.
+
+    Returns:
+        A list with, for every image in order, either a dict with 'result', 'probabilities'
+        (as returned by inference_resnet18sam), 'inference_time' (ms of the model run the
+        image was part of), 'decode_time' (ms) and 'cached', or the ImageTooLarge or
+        InvalidImage raised while decoding it.
+    """
+    spec = get_model_spec(model)
+    version = get_model_version(spec)
+    predictions = [None] * len(images)
+    digests = [content_hash(data) for data in images]
+
+    # decode and preprocess the misses straight into one (N, 1, H, W) batch
+    misses = []
+    tensors = []
+    for i, data in enumerate(images):
+        cached = prediction_cache.get(digests[i], version, spec.name, spec.config_hash)
+        if cached is not None:
+            predictions[i] = {
+                'result': cached['result'],
+                'probabilities': np.array(cached['probabilities'], dtype=np.float32),
+                'inference_time': cached['inference_time'],
+                'decode_time': 0.,
+                'cached': True,
+            }
+            continue
+
+        start_time = time()
+        try:
+            img = read_image(io.BytesIO(data))
+        except (ImageTooLarge, InvalidImage) as e:
+            predictions[i] = e
+            continue
+        with PREPROCESS_SECONDS.time():
+            tensors.append(preprocess(img, spec.image_size, mean=spec.mean, std=spec.std))
+        misses.append((i, 1000. * (time() - start_time)))
+
+    if misses:
+        outs, run_time = run_model(np.concatenate(tensors, axis=0), spec)
+    for row, (i, decode_time) in enumerate(misses):
+        logits = [out[row:row + 1] for out in outs]
+        probabilities = sigmoid(logits)
+        result = spec.classes[np.argmax(logits).item()]
+        prediction_cache.set(digests[i], version, {
+            'inference_time': run_time,
+            'result': result,
+            'probabilities': probabilities.tolist(),
+        }, spec.name, spec.config_hash)
+        predictions[i] = {
+            'result': result,
+            'probabilities': probabilities,
+            'inference_time': run_time,
+            'decode_time': decode_time,
+            'cached': False,
+        }
+
+    for data, prediction in zip(images, predictions):
+        if isinstance(prediction, dict) and not prediction['cached']:
+            maybe_compare(data, spec, prediction['result'], prediction['probabilities'], prediction['inference_time'])
+    return predictions
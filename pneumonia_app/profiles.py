@@ -0,0 +1,32 @@
+from .models import Doctor, Patient
+
+
+def _get_profile(request, model, related_name):
+    user = request.user
+    if not user.is_authenticated:
+        return None
+
+    try:
+        return getattr(user, related_name)
+    except model.DoesNotExist:
+        # profiles created before the user link existed are matched by name
+        # until `python manage.py link_profiles` has been run
+        return model.objects.filter(name=user.username, user__isnull=True).first()
+
+
+def get_patient(request):
+    """
+    Returns the Patient profile of the logged-in user, or None. The result is cached on the request.
+    """
+    if not hasattr(request, '_patient'):
+        request._patient = _get_profile(request, Patient, 'patient_profile')
+    return request._patient
+
+
+def get_doctor(request):
+    """
+    Returns the Doctor profile of the logged-in user, or None. The result is cached on the request.
+    """
+    if not hasattr(request, '_doctor'):
+        request._doctor = _get_profile(request, Doctor, 'doctor_profile')
+    return request._doctor
@@ -0,0 +1,179 @@
+import io
+import logging
+import random
+import threading
+
+from django.conf import settings
+
+from .async_inference import BoundedExecutor, InferenceQueueFull
+from .metrics import callback, counter, histogram
+from .onnx_inference import get_model_spec
+
+logger = logging.getLogger(__name__)
+
+SHADOW_COMPARISONS = counter('pulmoinsight_shadow_comparisons',
+                             'Shadow predictions of a candidate model, by agreement with production.',
+                             ('model', 'result'))
+SHADOW_PROBABILITY_DIFFERENCE = histogram('pulmoinsight_shadow_probability_difference',
+                                          'Largest absolute difference between the class probabilities '
+                                          'of the candidate and the production model.',
+                                          ('model',), buckets=(.01, .02, .05, .1, .2, .5, 1.))
+
+
+class ShadowStats:
+    """
+    Shadow Statistics Class
+
+    Note:
+    Agreement of a candidate model with the production model on the images it was shadowing:
+    counts per (production label, candidate label) pair, the mean largest probability
+    difference and the mean model run times of both.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.comparisons = 0
+        self.agreements = 0
+        self.errors = 0
+        self.dropped = 0
+        self.confusion = {}
+        self._difference = 0.
+        self._production_time = 0.
+        self._candidate_time = 0.
+
+    def record(self, production_result, candidate_result, difference, production_time, candidate_time):
+        with self._lock:
+            self.comparisons += 1
+            self.agreements += production_result == candidate_result
+            pair = (production_result, candidate_result)
+            self.confusion[pair] = self.confusion.get(pair, 0) + 1
+            self._difference += difference
+            self._production_time += production_time
+            self._candidate_time += candidate_time
+
+    def record_error(self):
+        with self._lock:
+            self.errors += 1
+
+    def record_dropped(self):
+        with self._lock:
+            self.dropped += 1
+
+    def as_dict(self):
+        with self._lock:
+            n = self.comparisons
+            return {
+                'comparisons': n,
+                'agreements': self.agreements,
+                'agreement_rate': self.agreements / n if n else None,
+                'mean_probability_difference': self._difference / n if n else None,
+                'mean_production_time': self._production_time / n if n else None,
+                'mean_candidate_time': self._candidate_time / n if n else None,
+                'confusion': {f'{production}->{candidate}': count
+                              for (production, candidate), count in self.confusion.items()},
+                'errors': self.errors,
+                'dropped': self.dropped,
+            }
+
+
+# candidate model name -> ShadowStats
+_stats = {}
+_stats_lock = threading.Lock()
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_stats(model):
+    stats = _stats.get(model)
+    if stats is None:
+        with _stats_lock:
+            stats = _stats.setdefault(model, ShadowStats())
+    return stats
+
+
+def shadow_stats():
+    """
+    Returns the agreement statistics of every candidate model shadowed in this process.
+    """
+    return {model: stats.as_dict() for model, stats in list(_stats.items())}
+
+
+def reset_stats():
+    with _stats_lock:
+        _stats.clear()
+
+
+def get_executor():
+    """
+    Returns the single-thread executor candidate models run on, away from the request threads.
+    """
+    global _executor
+
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = BoundedExecutor(1, settings.INFERENCE_SHADOW_MAX_PENDING,
+                                            thread_name_prefix='inference-shadow')
+    return _executor
+
+
+def maybe_compare(data, spec, result, probabilities, inference_time):
+    """
+    Lets settings.INFERENCE_SHADOW_MODEL predict the image too, for a sampled fraction of predictions.
+
+    The candidate runs in the background and never delays or changes the production answer;
+    images arriving while INFERENCE_SHADOW_MAX_PENDING comparisons are waiting are skipped.
+
+    Args:
+        data: The encoded image.
+        spec: ModelSpec of the production model that made the prediction.
+        result, probabilities, inference_time: Its prediction, as returned by inference_resnet18sam.
+
+    Returns:
+        The Future of the comparison, or None if the image is not shadowed.
+    """
+    candidate = settings.INFERENCE_SHADOW_MODEL
+    if not candidate or candidate == spec.name or spec.name != settings.INFERENCE_DEFAULT_MODEL:
+        return None
+    if random.random() >= settings.INFERENCE_SHADOW_SAMPLE_RATE:
+        return None
+
+    try:
+        return get_executor().submit(_compare, data, spec, result, probabilities, inference_time, candidate)
+    except InferenceQueueFull:
+        get_stats(candidate).record_dropped()
+        SHADOW_COMPARISONS.inc(model=candidate, result='dropped')
+        return None
+
+
+def _compare(data, spec, result, probabilities, inference_time, candidate):
+    # imported here, prediction_cache hands every prediction to maybe_compare
+    from .prediction_cache import cached_inference
+
+    try:
+        candidate_spec = get_model_spec(candidate)
+        candidate_time, candidate_result, candidate_probabilities = cached_inference(
+            io.BytesIO(data), model=candidate_spec, shadow=False)
+    except Exception:
+        logger.exception('Shadow model %s failed', candidate)
+        get_stats(candidate).record_error()
+        SHADOW_COMPARISONS.inc(model=candidate, result='error')
+        return
+
+    # compare class by class, the models may list their classes in a different order
+    production = dict(zip(spec.classes, probabilities.reshape(-1).tolist()))
+    shadowed = dict(zip(candidate_spec.classes, candidate_probabilities.reshape(-1).tolist()))
+    difference = max((abs(production[label] - shadowed[label]) for label in production.keys() & shadowed.keys()),
+                     default=1.)
+
+    get_stats(candidate).record(result, candidate_result, difference, inference_time, candidate_time)
+    SHADOW_COMPARISONS.inc(model=candidate, result='agree' if candidate_result == result else 'disagree')
+    SHADOW_PROBABILITY_DIFFERENCE.observe(difference, model=candidate)
+    if candidate_result != result:
+        logger.debug('Shadow model %s predicted %s where production predicted %s', candidate, candidate_result,
+                     result)
+
+
+callback('pulmoinsight_shadow_pending', 'Shadow comparisons running or waiting.',
+         lambda: _executor.stats()['pending'] if _executor is not None else 0)
@@ -0,0 +1,95 @@
+import hashlib
+import os
+import tempfile
+
+from django.core.files.storage import FileSystemStorage
+from django.utils.deconstruct import deconstructible
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def content_addressed_name(directory, digest, filename):
+    """
+    Returns the storage name of a file by its SHA-256 digest, keeping the (lower-cased) extension.
+    """
+    return f'{directory}/{digest}{os.path.splitext(filename)[1].lower()}'
+
+
+def hash_file(path, hasher=None, length=None):
+    """
+    Feeds the first `length` bytes (default: all) of the file at path into hasher (default: a new SHA-256).
+    """
+    hasher = hasher or hashlib.sha256()
+    with open(path, 'rb') as f:
+        while length is None or length > 0:
+            chunk = f.read(HASH_CHUNK_SIZE if length is None else min(HASH_CHUNK_SIZE, length))
+            if not chunk:
+                break
+            hasher.update(chunk)
+            if length is not None:
+                length -= len(chunk)
+    return hasher
+
+
+@deconstructible
+class ContentAddressedStorage(FileSystemStorage):
+    """
+    Content Addressed Storage Class
+
+    Note:
+    Files are stored as <upload_to>/<sha256><ext>, so identical uploads share one file and a new
+    upload never overwrites a different image that happened to have the same name. Files are
+    never deleted through this storage since several records may point to the same one, the
+    collect_blobs command removes the files nothing refers to any more.
+    """
+
+    def get_available_name(self, name, max_length=None):
+        # the final name is only known once the content has been hashed in _save
+        return name
+
+    def _save(self, name, content):
+        directory = os.path.dirname(name)
+        full_directory = self.path(directory)
+        os.makedirs(full_directory, exist_ok=True)
+
+        # hash while copying into a temporary file next to the final location
+        hasher = hashlib.sha256()
+        fd, tmp_path = tempfile.mkstemp(dir=full_directory, suffix='.part')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in content.chunks():
+                    hasher.update(chunk)
+                    f.write(chunk)
+            return self.store(tmp_path, hasher.hexdigest(), directory, name)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def store(self, tmp_path, digest, directory, filename):
+        """
+        Moves a fully written temporary file to its content-addressed name and returns that name.
+
+        If a file with the same content is already stored, the temporary file is dropped instead.
+        """
+        name = content_addressed_name(directory, digest, filename)
+        path = self.path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if os.path.exists(path):
+            os.remove(tmp_path)
+        else:
+            if self.file_permissions_mode is not None:
+                os.chmod(tmp_path, self.file_permissions_mode)
+            os.replace(tmp_path, path)
+        return name
+
+    def delete(self, name):
+        # shared by every record with the same content, see the collect_blobs command
+        pass
+
+
+content_addressed_storage = ContentAddressedStorage()
+
+
+def get_content_addressed_storage():
+    return content_addressed_storage
@@ -0,0 +1,31 @@
+from django.template.backends.django import DjangoTemplates as BaseDjangoTemplates
+
+from .metrics import TEMPLATE_RENDER_SECONDS
+
+
+class TimedTemplate:
+    """
+    Wraps a backend template to observe its render time in TEMPLATE_RENDER_SECONDS.
+    """
+
+    def __init__(self, template):
+        self._template = template
+
+    def __getattr__(self, name):
+        return getattr(self._template, name)
+
+    def render(self, context=None, request=None):
+        with TEMPLATE_RENDER_SECONDS.time(template=self._template.origin.template_name or 'string'):
+            return self._template.render(context, request)
+
+
+class DjangoTemplates(BaseDjangoTemplates):
+    """
+    The Django template backend, timing every template it renders.
+    """
+
+    def from_string(self, template_code):
+        return TimedTemplate(super().from_string(template_code))
+
+    def get_template(self, template_name):
+        return TimedTemplate(super().get_template(template_name))
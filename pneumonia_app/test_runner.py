@@ -0,0 +1,17 @@
+from django.test import override_settings
+from django.test.runner import DiscoverRunner
+
+
+class TestRunner(DiscoverRunner):
+    """
+    Test Runner Class
+
+    Note:
+    The app's migrations are generated locally and not committed, so the test database is
+    built straight from the models. The suite then runs the same on a fresh checkout as on a
+    machine with (possibly outdated) local migrations.
+    """
+
+    def setup_databases(self, **kwargs):
+        with override_settings(MIGRATION_MODULES={'pneumonia_app': None}):
+            return super().setup_databases(**kwargs)
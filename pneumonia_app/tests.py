@@ -1,3 +1,2028 @@
-from django.test import TestCase
+import os
+import unittest
 
-# Create your tests here.
+from django.conf import settings
+from django.test import SimpleTestCase, TestCase
+
+import cv2 as cv
+import numpy as np
+from PIL import Image
+
+from .onnx_inference import IMAGE_SIZE, preprocess
+
+try:
+    from torchvision import transforms
+except ImportError:
+    transforms = None
+
+SAMPLE_DIR = os.path.join(settings.BASE_DIR, 'sample')
+
+
+@unittest.skipIf(transforms is None, 'torchvision is not installed')
+class PreprocessEquivalenceTest(SimpleTestCase):
+    """
+    Checks the NumPy/OpenCV preprocessing against the former torchvision pipeline.
+    """
+
+    @staticmethod
+    def torchvision_preprocess(img):
+        import cv2 as cv
+
+        transform = transforms.Compose([
+            transforms.ToTensor(),
+            transforms.Resize([IMAGE_SIZE, IMAGE_SIZE]),
+        ])
+        resized_img = cv.resize(img, (IMAGE_SIZE, IMAGE_SIZE))
+        return transform(resized_img).unsqueeze_(0).numpy()
+
+    def test_sample_images(self):
+        for name in sorted(os.listdir(SAMPLE_DIR)):
+            for mode in ('L', 'RGB'):
+                with self.subTest(image=name, mode=mode):
+                    img = np.array(Image.open(os.path.join(SAMPLE_DIR, name)).convert(mode))
+                    expected = self.torchvision_preprocess(img)
+                    actual = preprocess(img)
+
+                    self.assertEqual(actual.dtype, np.float32)
+                    self.assertEqual(actual.shape, expected.shape)
+                    np.testing.assert_allclose(actual, expected, rtol=0, atol=1e-7)
+
+    def test_preallocated_buffer(self):
+        img = np.array(Image.open(os.path.join(SAMPLE_DIR, 'normal1.jpeg')).convert('L'))
+        buffer = np.zeros((1, 1, IMAGE_SIZE, IMAGE_SIZE), dtype=np.float32)
+
+        self.assertIs(preprocess(img, out=buffer), buffer)
+        np.testing.assert_allclose(buffer, self.torchvision_preprocess(img), rtol=0, atol=1e-7)
+
+
+class DecodingTest(SimpleTestCase):
+    """
+    Large JPEGs are decoded at reduced resolution and oversized images are rejected from their header.
+    """
+
+    def setUp(self):
+        import shutil
+        import tempfile
+
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+
+    def write_image(self, name, img):
+        path = os.path.join(self.tmp_dir, name)
+        Image.fromarray(img).save(path)
+        return path
+
+    def test_reduced_jpeg(self):
+        from .decoding import decode_grayscale
+
+        ramp = np.tile(np.linspace(0, 255, 2048).astype(np.uint8), (2048, 1))
+        path = self.write_image('large.jpg', np.dstack([ramp] * 3))
+
+        # the shorter side stays at least min_side
+        img = decode_grayscale(path, min_side=512, max_pixels=0)
+        self.assertEqual(img.shape, (512, 512))
+        self.assertEqual(img.dtype, np.uint8)
+
+        with open(path, 'rb') as f:
+            self.assertEqual(decode_grayscale(f, min_side=512, max_pixels=0).shape, (512, 512))
+
+        # close to the full decode scaled down
+        full = decode_grayscale(path, min_side=0, max_pixels=0)
+        self.assertEqual(full.shape, (2048, 2048))
+        expected = full.reshape(512, 4, 512, 4).mean(axis=(1, 3))
+        self.assertLess(np.abs(img - expected).mean(), 2)
+
+    def test_exif_orientation(self):
+        from .decoding import decode_grayscale
+
+        # a landscape scan whose EXIF orientation says "rotate 90 degrees to display"
+        ramp = np.tile(np.linspace(0, 255, 1024).astype(np.uint8), (600, 1))
+        path = os.path.join(self.tmp_dir, 'rotated.jpg')
+        exif = Image.Exif()
+        exif[0x0112] = 6
+        Image.fromarray(ramp).save(path, exif=exif)
+
+        from_path = decode_grayscale(path, min_side=128, max_pixels=0)
+        with open(path, 'rb') as f:
+            from_file = decode_grayscale(f, min_side=128, max_pixels=0)
+        self.assertEqual(from_path.shape, from_file.shape)
+        self.assertGreater(from_path.shape[1], from_path.shape[0])
+        self.assertLess(np.abs(from_path.astype(np.int16) - from_file).mean(), 2)
+
+    def test_small_images_unchanged(self):
+        from .decoding import decode_grayscale
+
+        path = os.path.join(SAMPLE_DIR, 'person1_bacteria_1.jpeg')
+        expected = np.array(Image.open(path))
+        if expected.ndim == 3:
+            expected = cv.cvtColor(expected, cv.COLOR_RGB2GRAY)
+        np.testing.assert_array_equal(decode_grayscale(path, min_side=512), expected)
+
+    def test_16bit(self):
+        from .decoding import decode_grayscale
+
+        path = self.write_image('scan.png', np.linspace(1000, 3000, 64 * 64).astype(np.uint16).reshape(64, 64))
+        img = decode_grayscale(path)
+        self.assertEqual(img.dtype, np.uint8)
+        self.assertEqual((img.min(), img.max()), (0, 255))
+
+    def test_pixel_limit(self):
+        from .decoding import ImageTooLarge, decode_grayscale
+        from .forms import ImageUploadForm
+        from django.core.files.uploadedfile import SimpleUploadedFile
+        from django.test import override_settings
+
+        path = self.write_image('scan.png', np.zeros((100, 100), dtype=np.uint8))
+        with self.assertRaises(ImageTooLarge):
+            decode_grayscale(path, max_pixels=100 * 99)
+
+        with open(path, 'rb') as f:
+            image = SimpleUploadedFile('scan.png', f.read(), content_type='image/png')
+        with override_settings(IMAGE_MAX_PIXELS=100 * 99):
+            form = ImageUploadForm(files={'image': image})
+            self.assertFalse(form.is_valid())
+            self.assertIn('image', form.errors)
+
+    def test_invalid_image(self):
+        import io
+
+        from .decoding import InvalidImage, decode_grayscale
+
+        with open(os.path.join(SAMPLE_DIR, 'normal1.jpeg'), 'rb') as f:
+            data = f.read()
+        for broken in (b'not an image', data[:len(data) // 2]):
+            with self.assertRaises(InvalidImage):
+                decode_grayscale(io.BytesIO(broken), min_side=0)
+        with self.assertRaises(FileNotFoundError):
+            decode_grayscale(os.path.join(SAMPLE_DIR, 'missing.jpeg'))
+
+
+class MetricsFormatTest(SimpleTestCase):
+    """
+    Checks the Prometheus text format of the metric types.
+    """
+
+    def test_histogram(self):
+        from .metrics import Histogram
+
+        histogram = Histogram('test_seconds', 'Test durations.', ('view',), buckets=(.1, 1.))
+        for value in (.05, .5, .5, 5.):
+            histogram.observe(value, view='home')
+
+        self.assertEqual(histogram.render(), [
+            '# HELP test_seconds Test durations.',
+            '# TYPE test_seconds histogram',
+            'test_seconds_bucket{view="home",le="0.1"} 1.0',
+            'test_seconds_bucket{view="home",le="1.0"} 3.0',
+            'test_seconds_bucket{view="home",le="+Inf"} 4.0',
+            'test_seconds_sum{view="home"} 6.05',
+            'test_seconds_count{view="home"} 4.0',
+        ])
+        with self.assertRaises(ValueError):
+            histogram.observe(1., page='home')
+
+    def test_counter(self):
+        from .metrics import CallbackMetric, Counter
+
+        counter = Counter('test_hits', 'Test hits.', ('result',))
+        counter.inc(result='hit')
+        counter.inc(2, result='hit')
+        self.assertEqual(counter.render()[2:], ['test_hits_total{result="hit"} 3.0'])
+
+        gauge = CallbackMetric('test_depth', 'Test depth.', lambda: 7)
+        self.assertEqual(gauge.render()[1:], ['# TYPE test_depth gauge', 'test_depth 7.0'])
+
+
+class DerivativesTest(SimpleTestCase):
+    """
+    Checks the thumbnails and model-ready copies made of uploaded images.
+    """
+
+    def setUp(self):
+        import shutil
+        import tempfile
+
+        from django.test import override_settings
+
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        media_settings = override_settings(MEDIA_ROOT=media_root)
+        media_settings.enable()
+        self.addCleanup(media_settings.disable)
+
+        os.makedirs(os.path.join(media_root, 'pulmonary_images'))
+        self.name = 'pulmonary_images/person1_bacteria_1.jpeg'
+        self.path = os.path.join(media_root, self.name)
+        shutil.copy(os.path.join(SAMPLE_DIR, 'person1_bacteria_1.jpeg'), self.path)
+
+    def test_create_derivatives(self):
+        from .derivatives import DERIVATIVES, create_derivatives, derivative_path, load_model_input
+        from .onnx_inference import read_image
+
+        create_derivatives(self.path)
+        for kind in DERIVATIVES:
+            self.assertTrue(os.path.exists(derivative_path(self.path, kind)), kind)
+
+        with Image.open(derivative_path(self.path, 'webp')) as thumbnail:
+            self.assertLessEqual(max(thumbnail.size), settings.IMAGE_THUMBNAIL_SIZE)
+
+        # inference on the model-ready copy sees exactly the same tensor as on the original
+        np.testing.assert_array_equal(preprocess(load_model_input(self.path)), preprocess(read_image(self.path)))
+
+    def test_lazy_regeneration(self):
+        from .derivatives import derivative_path, get_derivative
+
+        thumbnail = get_derivative(self.path, 'jpeg')
+        self.assertEqual(thumbnail, derivative_path(self.path, 'jpeg'))
+
+        # a replaced original makes its derivatives stale
+        stat = os.stat(thumbnail)
+        os.utime(self.path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        get_derivative(self.path, 'jpeg')
+        self.assertEqual(os.stat(thumbnail).st_mtime_ns, os.stat(self.path).st_mtime_ns)
+
+    def test_view(self):
+        response = self.client.get(f'/derivatives/webp/{self.name}')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'image/webp')
+
+        self.assertEqual(self.client.get('/derivatives/webp/pulmonary_images/missing.jpeg').status_code, 404)
+        self.assertEqual(self.client.get('/derivatives/webp/other/person1_bacteria_1.jpeg').status_code, 404)
+        self.assertEqual(self.client.get('/derivatives/model/../../manage.py').status_code, 404)
+        self.assertEqual(self.client.get(f'/derivatives/original/{self.name}').status_code, 404)
+
+
+def use_synthetic_model(test_case, **overrides):
+    """
+    Points the default model of a test at a synthetic model in a temporary MEDIA_ROOT, which is returned.
+
+    Note:
+    The prediction cache is emptied before and after the test: the synthetic models of all tests
+    have the same weights, so predictions cached by another test would hide the model runs.
+    """
+    import shutil
+    import tempfile
+
+    from django.test import override_settings
+
+    from .benchmark import build_synthetic_model
+    from .prediction_cache import prediction_cache
+
+    try:
+        import onnx  # noqa: F401
+    except ImportError:
+        test_case.skipTest('the synthetic model requires the onnx package')
+
+    tmp_dir = tempfile.mkdtemp()
+    test_case.addCleanup(shutil.rmtree, tmp_dir)
+    test_settings = override_settings(**dict({
+        'MEDIA_ROOT': tmp_dir,
+        'INFERENCE_MODEL_PATH': build_synthetic_model(os.path.join(tmp_dir, 'synthetic.onnx')),
+        'INFERENCE_MODEL_VARIANT': 'fp32',
+        'INFERENCE_OPTIMIZED_MODEL_DIR': None,
+        'INFERENCE_CACHE_ALIAS': 'default',
+    }, **overrides))
+    test_settings.enable()
+    test_case.addCleanup(test_settings.disable)
+
+    prediction_cache.clear()
+    test_case.addCleanup(prediction_cache.clear)
+    return tmp_dir
+
+
+def replace_model_file(path, seed):
+    """
+    Overwrites a synthetic model with one of other weights and a later modification time.
+    """
+    from .benchmark import build_synthetic_model
+
+    mtime_ns = os.stat(path).st_mtime_ns
+    build_synthetic_model(path, seed=seed)
+    os.utime(path, ns=(mtime_ns + 10 ** 9, mtime_ns + 10 ** 9))
+
+
+def seed_database(patients=300, records_per_patient=3):
+    """
+    Creates a realistic number of patients, medical records, diagnoses, posts and comments.
+    """
+    from django.contrib.auth import get_user_model
+    from django.utils import timezone
+
+    from .models import (
+        DiagnosisRecord,
+        Doctor,
+        DoctorComment,
+        DoctorPost,
+        MedicalRecord,
+        Patient,
+        PatientComment,
+        PatientPost,
+    )
+
+    now = timezone.now()
+    patient_user = get_user_model().objects.create_user(username='patient1', password='password')
+    doctor_user = get_user_model().objects.create_user(username='doctor1', password='password', is_doctor=True)
+
+    Patient.objects.bulk_create([
+        Patient(name=f'patient{i}', gender='male', age=30 + i % 50, occupation='teacher', phone_number='123',
+                address='street', user=patient_user if i == 1 else None) for i in range(patients)
+    ])
+    doctor = Doctor.objects.create(name='doctor1', gender='female', age=40, phone_number='123', address='street',
+                                   user=doctor_user)
+    patient_list = list(Patient.objects.all())
+
+    MedicalRecord.objects.bulk_create([
+        MedicalRecord(patient=patient, pulmonary_image=f'pulmonary_images/{patient.id}_{j}.jpeg',
+                      upload_time=now - timezone.timedelta(days=j))
+        for patient in patient_list for j in range(records_per_patient)
+    ])
+    DiagnosisRecord.objects.bulk_create([
+        DiagnosisRecord(patient=patient, diagnosis_status='Yes' if i % 3 else 'No',
+                        diagnosis_result='Pneumonia' if i % 2 else 'Normal', controversy_status=i % 5 == 0)
+        for i, patient in enumerate(patient_list)
+    ])
+
+    patient_posts = PatientPost.objects.bulk_create([
+        PatientPost(patient=patient, content='post') for patient in patient_list[:50]
+    ])
+    PatientComment.objects.bulk_create([
+        PatientComment(patient=patient_list[j], post=post, comment='comment')
+        for post in patient_posts for j in range(5)
+    ])
+    doctor_posts = DoctorPost.objects.bulk_create([DoctorPost(doctor=doctor, content='post') for _ in range(50)])
+    DoctorComment.objects.bulk_create([
+        DoctorComment(doctor=doctor, post=post, comment='comment') for post in doctor_posts for _ in range(5)
+    ])
+
+
+class QueryPlanTest(TestCase):
+    """
+    Checks that the hot lookups are served by an index rather than a full table scan.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        seed_database()
+
+    def assertUsesIndex(self, queryset, index_name, sorted_by_index=False):
+        from django.db import connection
+
+        if connection.vendor != 'sqlite':
+            self.skipTest('query plans are only checked on SQLite')
+
+        plan = queryset.explain()
+        self.assertIn(f'USING INDEX {index_name}', plan.replace('COVERING INDEX', 'INDEX'))
+        if sorted_by_index:
+            self.assertNotIn('TEMP B-TREE', plan)
+
+    def test_patient_by_name(self):
+        from .models import Patient
+
+        self.assertUsesIndex(Patient.objects.filter(name='patient1'), 'patient_name_idx')
+
+    def test_doctor_by_name(self):
+        from .models import Doctor
+
+        self.assertUsesIndex(Doctor.objects.filter(name='doctor1'), 'doctor_name_idx')
+
+    def test_diagnosis_by_patient_name(self):
+        from .models import DiagnosisRecord
+
+        self.assertUsesIndex(DiagnosisRecord.objects.filter(patient__name='patient1'), 'patient_name_idx')
+
+    def test_pending_diagnoses(self):
+        from .models import DiagnosisRecord
+
+        self.assertUsesIndex(DiagnosisRecord.objects.filter(diagnosis_status='No'), 'diagnosis_status_idx')
+
+    def test_latest_medical_record(self):
+        from .models import MedicalRecord, Patient
+
+        patient = Patient.objects.first()
+        self.assertUsesIndex(MedicalRecord.objects.filter(patient=patient).order_by('-upload_time'),
+                             'record_patient_upload_idx', sorted_by_index=True)
+
+    def test_latest_diagnosis(self):
+        from .models import DiagnosisRecord, Patient
+
+        patient = Patient.objects.first()
+        self.assertUsesIndex(DiagnosisRecord.objects.filter(patient=patient).order_by('-created_at'),
+                             'diagnosis_patient_created_idx', sorted_by_index=True)
+
+    def test_post_comments(self):
+        from .models import DoctorComment, PatientComment
+
+        self.assertUsesIndex(PatientComment.objects.filter(post_id=1).order_by('-created_at'),
+                             'patient_comment_post_idx', sorted_by_index=True)
+        self.assertUsesIndex(DoctorComment.objects.filter(post_id=1).order_by('-created_at'),
+                             'doctor_comment_post_idx', sorted_by_index=True)
+
+
+class ViewQueryCountTest(TestCase):
+    """
+    Checks that the number of queries per view does not grow with the size of the tables.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        seed_database()
+
+    def test_doctor_records(self):
+        self.client.login(username='doctor1', password='password')
+        # session, user, annotated patient page
+        with self.assertNumQueries(3):
+            response = self.client.get('/doctor_home/records/')
+        self.assertEqual(response.status_code, 200)
+
+        with self.assertNumQueries(3):
+            self.client.get('/doctor_home/records/', {'search_diagnosis_status': 'Yes',
+                                                      'search_diagnosis_result': 'Pneumonia',
+                                                      'search_controversy_status': 'True'})
+
+    def test_patient_history(self):
+        self.client.login(username='patient1', password='password')
+        # session, user with their profile, diagnosis status, medical records with their patient
+        with self.assertNumQueries(4):
+            response = self.client.get('/patient_home/history')
+        self.assertEqual(response.status_code, 200)
+
+    def test_patient_detailed_info(self):
+        self.client.login(username='patient1', password='password')
+        # session, user with their profile, latest medical record, diagnosis records
+        with self.assertNumQueries(4):
+            response = self.client.get('/patient_home/history/detailed_info/')
+        self.assertEqual(response.status_code, 200)
+
+    def test_doctor_home(self):
+        from django.core.cache import cache
+
+        cache.clear()
+        self.client.login(username='doctor1', password='password')
+        # session, user, dashboard counters (recounted once, then served from the cache)
+        with self.assertNumQueries(3):
+            self.client.get('/doctor_home/')
+        with self.assertNumQueries(2):
+            response = self.client.get('/doctor_home/')
+        self.assertEqual(response.context['num_patients'], response.context['stats']['pending'])
+
+    def test_community_boards(self):
+        from django.core.cache import caches
+
+        caches[settings.COMMUNITY_CACHE_ALIAS].clear()
+        for username, url in (('patient1', '/patient_home/community/'), ('doctor1', '/doctor_home/community/')):
+            with self.subTest(url=url):
+                self.client.login(username=username, password='password')
+                # session, user with their profile, page of posts with authors and comment counts
+                with self.assertNumQueries(3):
+                    response = self.client.get(url)
+                self.assertEqual(response.status_code, 200)
+                # the page is cached now
+                with self.assertNumQueries(2):
+                    self.client.get(url)
+
+    def test_post_comments(self):
+        from .models import PatientPost
+
+        self.client.login(username='patient1', password='password')
+        post = PatientPost.objects.first()
+        # session, user with their profile, post with its author, comments with their authors
+        with self.assertNumQueries(4):
+            response = self.client.get(f'/view_patient_comments/{post.id}/')
+        self.assertEqual(response.status_code, 200)
+
+
+class ProfileLinkTest(TestCase):
+    """
+    Checks which existing profile the basic information forms link to the logged-in user.
+    """
+
+    def setUp(self):
+        from django.contrib.auth import get_user_model
+
+        from .models import Doctor, Patient
+
+        get_user_model().objects.create_user(username='alice', password='password')
+        get_user_model().objects.create_user(username='mallory', password='password', is_doctor=True)
+        for name in ('alice', 'victim'):
+            Patient.objects.create(name=name, gender='female', age=40, occupation='teacher', phone_number='123',
+                                   address='street')
+            Doctor.objects.create(name=name, gender='female', age=40, phone_number='123', address='street')
+
+    def post_profile(self, url, name):
+        self.client.post(url, {'name': name, 'gender': 'female', 'age': 41, 'marital_status': 'single',
+                               'occupation': 'teacher', 'phone_number': '456', 'address': 'road'})
+
+    def test_unlinked_profile_of_the_username_is_adopted(self):
+        from .models import Patient
+
+        self.client.login(username='alice', password='password')
+        self.post_profile('/save_patient_profile/', 'Alice Smith')
+        profile = Patient.objects.get(user__username='alice')
+        self.assertEqual((profile.name, profile.age), ('Alice Smith', 41))
+        self.assertEqual(Patient.objects.count(), 2)
+
+    def test_other_profiles_are_not_taken_over(self):
+        from .models import Doctor, Patient
+
+        self.client.login(username='mallory', password='password')
+        for model, url in ((Patient, '/save_patient_profile/'), (Doctor, '/save_doctor_profile/')):
+            with self.subTest(model=model.__name__):
+                self.post_profile(url, 'victim')
+                victim = model.objects.get(name='victim', user__isnull=True)
+                self.assertEqual(victim.age, 40)
+                self.assertEqual(model.objects.get(user__username='mallory').name, 'victim')
+
+
+class CommunityFeedTest(TestCase):
+    """
+    Checks the cursor pagination of the community boards and the invalidation of cached pages.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        seed_database(patients=60)
+
+    def setUp(self):
+        from django.core.cache import caches
+
+        caches[settings.COMMUNITY_CACHE_ALIAS].clear()
+
+    def test_pagination(self):
+        from .community import FEED_PAGE_SIZE, get_feed_page
+        from .models import PatientPost
+
+        seen = []
+        posts, before = get_feed_page('patient')
+        while True:
+            self.assertLessEqual(len(posts), FEED_PAGE_SIZE)
+            seen.extend(post['id'] for post in posts)
+            if before is None:
+                break
+            posts, before = get_feed_page('patient', before)
+
+        self.assertEqual(seen, list(PatientPost.objects.order_by('-id').values_list('id', flat=True)))
+        first = PatientPost.objects.get(id=seen[0])
+        self.assertEqual(get_feed_page('patient')[0][0]['comment_count'], first.comments.count())
+
+    def test_invalidation(self):
+        from .community import get_feed_page
+        from .models import Patient, PatientComment, PatientPost
+
+        get_feed_page('patient')
+        with self.assertNumQueries(0):
+            get_feed_page('patient')
+
+        patient = Patient.objects.get(name='patient1')
+        with self.captureOnCommitCallbacks(execute=True):
+            post = PatientPost.objects.create(patient=patient, content='new post')
+        posts, _ = get_feed_page('patient')
+        self.assertEqual((posts[0]['id'], posts[0]['comment_count']), (post.id, 0))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            PatientComment.objects.create(patient=patient, post=post, comment='new comment')
+        self.assertEqual(get_feed_page('patient')[0][0]['comment_count'], 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            post.delete()
+        self.assertNotEqual(get_feed_page('patient')[0][0]['id'], post.id)
+
+
+class DashboardStatsTest(TestCase):
+    """
+    Checks that the cached dashboard counters follow the diagnosis records.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        seed_database(patients=30)
+
+    def setUp(self):
+        from django.core.cache import caches
+
+        caches[settings.DASHBOARD_CACHE_ALIAS].clear()
+
+    def assertStatsCurrent(self):
+        from .dashboard import get_stats, refresh_stats
+
+        cached = get_stats()
+        self.assertEqual(cached, refresh_stats())
+        return cached
+
+    def test_counts(self):
+        from .models import DiagnosisRecord
+
+        stats = self.assertStatsCurrent()
+        self.assertEqual(stats['total'], DiagnosisRecord.objects.count())
+        self.assertEqual(stats['pending'], DiagnosisRecord.objects.filter(diagnosis_status='No').count())
+
+    def test_incremental_updates(self):
+        from .dashboard import get_stats
+        from .models import DiagnosisRecord, Patient
+
+        before = get_stats()
+        patient = Patient.objects.first()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            record = DiagnosisRecord.objects.create(patient=patient, diagnosis_status='No')
+        with self.assertNumQueries(0):
+            stats = get_stats()
+        self.assertEqual(stats['pending'], before['pending'] + 1)
+        self.assertEqual(stats['total'], before['total'] + 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            record.diagnosis_status = 'Yes'
+            record.diagnosis_result = 'Pneumonia'
+            record.controversy_status = True
+            record.save()
+        stats = self.assertStatsCurrent()
+        self.assertEqual(stats['pending'], before['pending'])
+        self.assertEqual(stats['diagnosed'], before['diagnosed'] + 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            patient.delete()
+        self.assertStatsCurrent()
+
+    def test_signal_counters(self):
+        from .dashboard import get_stats
+        from .models import DiagnosisRecord, Patient
+
+        def changes(before):
+            stats = get_stats()
+            return {name: stats[name] - before[name] for name in stats if stats[name] != before[name]}
+
+        # create
+        before = get_stats()
+        with self.captureOnCommitCallbacks(execute=True):
+            record = DiagnosisRecord.objects.create(patient=Patient.objects.first(), diagnosis_status='No')
+        self.assertEqual(changes(before), {'total': 1, 'pending': 1})
+
+        # update: moved from pending to diagnosed and controversial, then to another result
+        before = get_stats()
+        with self.captureOnCommitCallbacks(execute=True):
+            record.diagnosis_status = 'Yes'
+            record.diagnosis_result = 'Normal'
+            record.controversy_status = True
+            record.save()
+        self.assertEqual(changes(before), {'pending': -1, 'diagnosed': 1, 'normal': 1, 'controversial': 1})
+
+        before = get_stats()
+        with self.captureOnCommitCallbacks(execute=True):
+            record.diagnosis_result = 'Pneumonia'
+            record.save()
+        self.assertEqual(changes(before), {'normal': -1, 'pneumonia': 1})
+
+        # saving without a counted change touches nothing
+        before = get_stats()
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            record.diagnostician = 'doctor1'
+            record.save()
+        self.assertEqual(callbacks, [])
+        self.assertEqual(changes(before), {})
+
+        # delete
+        before = get_stats()
+        with self.captureOnCommitCallbacks(execute=True):
+            record.delete()
+        self.assertEqual(changes(before), {'total': -1, 'diagnosed': -1, 'pneumonia': -1, 'controversial': -1})
+        self.assertStatsCurrent()
+
+    def test_rolled_back_changes_are_not_counted(self):
+        from django.db import transaction
+
+        from .dashboard import get_stats
+        from .models import DiagnosisRecord, Patient
+
+        before = get_stats()
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            with self.assertRaises(RuntimeError), transaction.atomic():
+                DiagnosisRecord.objects.create(patient=Patient.objects.first(), diagnosis_status='No')
+                raise RuntimeError('rolled back')
+        self.assertEqual(callbacks, [])
+        self.assertEqual(get_stats(), before)
+
+    def test_changes_while_not_cached(self):
+        from django.core.cache import caches
+
+        from .dashboard import get_stats
+        from .models import DiagnosisRecord, Patient
+
+        before = get_stats()
+        # expired counters are not incremented from nothing, the next read recounts them all
+        caches[settings.DASHBOARD_CACHE_ALIAS].clear()
+        with self.captureOnCommitCallbacks(execute=True):
+            DiagnosisRecord.objects.create(patient=Patient.objects.first(), diagnosis_status='No')
+        stats = self.assertStatsCurrent()
+        self.assertEqual((stats['total'], stats['pending']), (before['total'] + 1, before['pending'] + 1))
+
+    def test_backfill(self):
+        import io
+
+        from django.core.management import call_command
+
+        from .dashboard import get_stats
+        from .models import DiagnosisRecord, Patient
+
+        legacy = [Patient.objects.create(name=f'legacy{i}', gender='female', age=50, occupation='',
+                                         phone_number='', address='') for i in range(3)]
+        before = get_stats()
+
+        output = io.StringIO()
+        call_command('backfill_diagnoses', '--dry-run', stdout=output)
+        self.assertIn('3 patients without a diagnosis record', output.getvalue())
+        self.assertFalse(DiagnosisRecord.objects.filter(patient__in=legacy).exists())
+
+        call_command('backfill_diagnoses', stdout=io.StringIO())
+        self.assertEqual(list(DiagnosisRecord.objects.filter(patient__in=legacy)
+                              .values_list('diagnosis_status', flat=True)), ['No'] * 3)
+        self.assertFalse(Patient.objects.filter(diagnosisrecord__isnull=True).exists())
+        # the pending count on the doctor's home page includes them again
+        stats = self.assertStatsCurrent()
+        self.assertEqual(stats['pending'], before['pending'] + 3)
+
+        output = io.StringIO()
+        call_command('backfill_diagnoses', stdout=output)
+        self.assertIn('0 pending diagnosis records created', output.getvalue())
+
+
+class ChunkedUploadTest(TestCase):
+    """
+    Checks the resumable upload protocol, incremental hashing and content-addressed deduplication.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        seed_database(patients=5)
+
+    def setUp(self):
+        import shutil
+        import tempfile
+
+        from django.test import override_settings
+
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        media_settings = override_settings(MEDIA_ROOT=media_root,
+                                           CHUNKED_UPLOAD_DIR=os.path.join(media_root, '.uploads'))
+        media_settings.enable()
+        self.addCleanup(media_settings.disable)
+        self.media_root = media_root
+
+        with open(os.path.join(SAMPLE_DIR, 'normal1.jpeg'), 'rb') as f:
+            self.data = f.read()
+        self.client.login(username='patient1', password='password')
+
+    def start(self, filename='normal1.jpeg', target='medical_record'):
+        response = self.client.post('/upload/chunked/', {'filename': filename, 'size': len(self.data),
+                                                          'target': target})
+        self.assertEqual(response.status_code, 201)
+        return response.json()
+
+    def put(self, upload, first, last):
+        return self.client.put(f'/upload/chunked/{upload["upload_id"]}/', self.data[first:last + 1],
+                               content_type='application/octet-stream',
+                               headers={'Content-Range': f'bytes {first}-{last}/{len(self.data)}'})
+
+    def upload(self, chunk_size=1000, **kwargs):
+        upload = self.start(**kwargs)
+        for first in range(0, len(self.data), chunk_size):
+            upload = self.put(upload, first, min(first + chunk_size, len(self.data)) - 1).json()
+        return upload
+
+    def test_resume(self):
+        import hashlib
+
+        from . import uploads
+
+        upload = self.start()
+        half = len(self.data) // 2
+        self.assertEqual(self.put(upload, 0, half - 1).json()['offset'], half)
+
+        # a chunk sent twice (lost response) is rejected with the offset to resume from
+        response = self.put(upload, 0, half - 1)
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json()['offset'], half)
+
+        # another worker process picks the upload up without the in-memory hash state
+        uploads._hashers.clear()
+        status = self.client.get(f'/upload/chunked/{upload["upload_id"]}/').json()
+        upload = self.put(upload, status['offset'], len(self.data) - 1).json()
+
+        digest = hashlib.sha256(self.data).hexdigest()
+        self.assertEqual(upload['status'], 'complete')
+        self.assertEqual(upload['sha256'], digest)
+        self.assertEqual(upload['name'], f'pulmonary_images/{digest}.jpeg')
+        with open(os.path.join(self.media_root, upload['name']), 'rb') as f:
+            self.assertEqual(f.read(), self.data)
+
+    def test_deduplication(self):
+        first = self.upload()
+        second = self.upload(chunk_size=700, filename='copy.JPEG')
+
+        self.assertEqual(first['name'], second['name'])
+        self.assertEqual(os.listdir(os.path.join(self.media_root, 'pulmonary_images')),
+                         [os.path.basename(first['name'])])
+        self.assertEqual(os.listdir(os.path.join(self.media_root, '.uploads')), [])
+
+    def test_medical_record_from_upload(self):
+        from .models import MedicalRecord
+
+        upload = self.upload()
+        response = self.client.post('/patient_home/upload', {'upload_id': upload['upload_id'],
+                                                              'medical_history': 'none', 'symptoms': 'cough',
+                                                              'other': 'none'})
+        self.assertEqual(response.status_code, 200)
+
+        record = MedicalRecord.objects.latest('id')
+        self.assertEqual(record.pulmonary_image.name, upload['name'])
+        self.assertEqual(record.image_name, 'normal1.jpeg')
+
+        # downloaded under the uploaded name, not the content hash it is stored under
+        response = self.client.get(f'/download/{os.path.basename(upload["name"])}/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="normal1.jpeg"')
+        response.close()
+
+    def test_rejects_invalid_uploads(self):
+        response = self.client.post('/upload/chunked/', {'filename': 'notes.txt', 'size': 10})
+        self.assertEqual(response.status_code, 400)
+
+        upload = self.start()
+        self.data = b'not an image'.ljust(len(self.data), b'.')
+        response = self.put(upload, 0, len(self.data) - 1)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.client.get(f'/upload/chunked/{upload["upload_id"]}/').status_code, 404)
+
+    def test_expired_uploads(self):
+        import uuid
+
+        from django.utils import timezone
+
+        from . import uploads
+        from .models import ChunkedUpload
+
+        upload = self.start()
+        self.put(upload, 0, 999)
+        upload_id = uuid.UUID(upload['upload_id'])
+        self.assertIn(upload_id, uploads._hashers)
+
+        ChunkedUpload.objects.filter(id=upload_id).update(
+            updated_at=timezone.now() - timezone.timedelta(seconds=settings.CHUNKED_UPLOAD_EXPIRY + 1))
+        uploads.clear_expired_uploads()
+        self.assertFalse(ChunkedUpload.objects.filter(id=upload_id).exists())
+        self.assertNotIn(upload_id, uploads._hashers)
+        self.assertEqual(os.listdir(os.path.join(self.media_root, '.uploads')), [])
+
+    def test_anonymous_upload_id(self):
+        upload = self.upload(target='image')
+        self.client.logout()
+        response = self.client.post('/doctor_home/analyze/', {'upload_id': upload['upload_id']})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('upload_success', response.context)
+
+    def test_collect_blobs(self):
+        import io
+        import time
+
+        from django.core.management import call_command
+
+        from .derivatives import DERIVATIVES, derivative_path
+        from .models import ChunkedUpload, MedicalRecord, Patient
+
+        kept = self.upload()['name']
+        MedicalRecord.objects.create(patient=Patient.objects.first(), pulmonary_image=kept)
+        ChunkedUpload.objects.all().delete()
+
+        # an image whose record was deleted, with its derivatives, and one stored a moment ago
+        orphan = os.path.join(self.media_root, 'pulmonary_images', 'a' * 64 + '.jpeg')
+        recent = os.path.join(self.media_root, 'pulmonary_images', 'b' * 64 + '.jpeg')
+        derivatives = [derivative_path(orphan, kind) for kind in DERIVATIVES]
+        os.makedirs(os.path.dirname(derivatives[0]))
+        for path in [orphan, recent] + derivatives:
+            with open(path, 'wb') as f:
+                f.write(self.data)
+        hour_ago = time.time() - 2 * 60 * 60
+        for path in [orphan, os.path.join(self.media_root, kept)]:
+            os.utime(path, (hour_ago, hour_ago))
+
+        output = io.StringIO()
+        call_command('collect_blobs', '--dry-run', stdout=output)
+        self.assertIn('1 unreferenced files', output.getvalue())
+        self.assertTrue(os.path.exists(orphan))
+
+        call_command('collect_blobs', stdout=io.StringIO())
+        self.assertFalse(any(os.path.exists(path) for path in [orphan] + derivatives))
+        self.assertTrue(os.path.exists(recent))
+        self.assertTrue(os.path.exists(os.path.join(self.media_root, kept)))
+
+        call_command('collect_blobs', '--min-age', '0', stdout=io.StringIO())
+        self.assertFalse(os.path.exists(recent))
+        self.assertTrue(os.path.exists(os.path.join(self.media_root, kept)))
+
+
+class AsyncInferenceTest(TestCase):
+    """
+    Checks the async inference views, the JSON prediction API and the 503 sent when the executor is full.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        seed_database(patients=5)
+
+    def setUp(self):
+        use_synthetic_model(self)
+        self.image_path = os.path.join(SAMPLE_DIR, 'normal1.jpeg')
+        self.client.login(username='doctor1', password='password')
+
+    def post_image(self, url):
+        with open(self.image_path, 'rb') as f:
+            return self.client.post(url, {'image': f})
+
+    def test_predict(self):
+        from .onnx_inference import classes
+
+        response = self.post_image('/api/predict/')
+        self.assertEqual(response.status_code, 200)
+        prediction = response.json()
+        self.assertIn(prediction['result'], classes)
+        self.assertEqual(set(prediction['probabilities']), set(classes))
+        self.assertTrue(prediction['model_version'])
+
+        self.client.logout()
+        self.assertEqual(self.post_image('/api/predict/').status_code, 401)
+
+    def test_invalid_image(self):
+        from django.core.files.uploadedfile import SimpleUploadedFile
+
+        response = self.client.post('/api/predict/', {'image': SimpleUploadedFile('scan.png', b'not an image')})
+        self.assertEqual(response.status_code, 400)
+
+    def test_authentication(self):
+        from django.test import Client
+
+        client = Client(enforce_csrf_checks=True)
+        with open(self.image_path, 'rb') as f:
+            image = f.read()
+
+        def post(client, **headers):
+            from django.core.files.uploadedfile import SimpleUploadedFile
+
+            return client.post('/api/predict/', {'image': SimpleUploadedFile('scan.jpeg', image)}, headers=headers)
+
+        with self.settings(INFERENCE_API_KEYS=['secret-key']):
+            # key clients need no session and no CSRF token
+            self.assertEqual(post(client, Authorization='Bearer secret-key').status_code, 200)
+            self.assertEqual(post(client, Authorization='Bearer wrong-key').status_code, 401)
+            self.assertEqual(post(client, Authorization='Bearer ').status_code, 401)
+            self.assertEqual(post(client).status_code, 401)
+
+            # sessions still need the CSRF token
+            client.login(username='doctor1', password='password')
+            self.assertEqual(post(client).status_code, 403)
+            token = 'x' * 32
+            client.cookies[settings.CSRF_COOKIE_NAME] = token
+            self.assertEqual(post(client).status_code, 403)
+            self.assertEqual(post(client, **{'X-CSRFToken': token}).status_code, 200)
+
+    def test_unexpected_error(self):
+        from unittest import mock
+
+        # only decoding errors are answered as invalid images
+        with mock.patch('pneumonia_app.prediction_cache.cached_inference', side_effect=ValueError('bug')), \
+                self.assertRaisesMessage(ValueError, 'bug'):
+            self.post_image('/api/predict/')
+
+    def test_doctor_analyze(self):
+        response = self.post_image('/doctor_home/analyze/')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.context['upload_success'])
+
+    def test_busy(self):
+        import threading
+        from unittest import mock
+
+        from .async_inference import BoundedExecutor, InferenceQueueFull
+
+        executor = BoundedExecutor(max_workers=1, max_pending=1)
+        release = threading.Event()
+        self.addCleanup(release.set)
+        running = executor.submit(release.wait)
+        with self.assertRaises(InferenceQueueFull):
+            executor.submit(release.wait)
+
+        with mock.patch('pneumonia_app.async_inference._executor', executor):
+            for url in ('/api/predict/', '/doctor_home/analyze/'):
+                response = self.post_image(url)
+                self.assertEqual(response.status_code, 503, url)
+                self.assertEqual(response['Retry-After'], str(settings.INFERENCE_ASYNC_RETRY_AFTER))
+
+        # the slot is free again once the running call is done
+        release.set()
+        running.result(timeout=5)
+        executor.submit(lambda: None).result(timeout=5)
+        self.assertEqual(executor.stats()['rejected'], 3)
+
+    def test_predict_batch(self):
+        from django.core.files.uploadedfile import SimpleUploadedFile
+
+        from .models import UploadedImage
+
+        names = ['normal1.jpeg', 'person1_bacteria_1.jpeg']
+        files = [open(os.path.join(SAMPLE_DIR, name), 'rb') for name in names]
+        try:
+            response = self.client.post('/api/predict/batch/', {
+                'image': files + [SimpleUploadedFile('broken.png', b'not an image')],
+            })
+        finally:
+            for f in files:
+                f.close()
+        self.assertEqual(response.status_code, 200)
+        results = response.json()['results']
+        self.assertEqual([result['id'] for result in results], names + ['broken.png'])
+        self.assertEqual([result.get('cached') for result in results], [False, False, None])
+        self.assertEqual(results[2]['status'], 400)
+        # nothing is stored unless asked
+        self.assertFalse(UploadedImage.objects.exists())
+
+        # the same predictions as one image at a time
+        for name, result in zip(names, results):
+            self.image_path = os.path.join(SAMPLE_DIR, name)
+            single = self.post_image('/api/predict/').json()
+            self.assertEqual(single['result'], result['result'])
+            for label, probability in single['probabilities'].items():
+                self.assertAlmostEqual(probability, result['probabilities'][label], places=5)
+
+    def test_predict_batch_ndjson(self):
+        import base64
+        import json
+
+        from .models import UploadedImage
+
+        with open(self.image_path, 'rb') as f:
+            image = base64.b64encode(f.read()).decode()
+        body = '\n'.join(json.dumps({'id': f'study-{i}', 'image': image}) for i in range(3))
+
+        response = self.client.post('/api/predict/batch/?save=1', body, content_type='application/x-ndjson')
+        self.assertEqual(response.status_code, 200)
+        results = response.json()['results']
+        self.assertEqual([result['id'] for result in results], ['study-0', 'study-1', 'study-2'])
+        self.assertEqual(len({result['result'] for result in results}), 1)
+        # identical images share one stored file
+        self.assertEqual(UploadedImage.objects.count(), 3)
+        self.assertEqual(len({result['name'] for result in results}), 1)
+        # ids without an extension are stored with the one of the decoded image
+        self.assertTrue(results[0]['name'].endswith('.jpeg'), results[0]['name'])
+
+        # a line without an id is named by its index
+        response = self.client.post('/api/predict/batch/?save=1', json.dumps({'image': image}),
+                                    content_type='application/x-ndjson')
+        self.assertEqual(response.json()['results'][0]['id'], '0')
+        self.assertEqual(UploadedImage.objects.latest('id').image.name, results[0]['name'])
+
+        response = self.client.post('/api/predict/batch/', 'not json', content_type='application/x-ndjson')
+        self.assertEqual(response.status_code, 400)
+
+        with self.settings(INFERENCE_API_MAX_BATCH=2):
+            response = self.client.post('/api/predict/batch/', body, content_type='application/x-ndjson')
+        self.assertEqual(response.status_code, 413)
+
+    def test_predict_batch_too_large(self):
+        from unittest import mock
+
+        # a body declared too large is refused before the multipart parser reads it
+        with self.settings(INFERENCE_API_MAX_BODY_SIZE=1024), \
+                mock.patch('pneumonia_app.api._read_multipart') as read_multipart:
+            response = self.post_image('/api/predict/batch/')
+        self.assertEqual(response.status_code, 413)
+        read_multipart.assert_not_called()
+
+
+class MetricsTest(TestCase):
+    """
+    Checks the per-view request, query and template metrics served on /metrics.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        seed_database(patients=5)
+
+    def sample(self, text, name):
+        for line in text.splitlines():
+            if line.startswith(name + ' '):
+                return float(line.split()[-1])
+        self.fail(f'{name} not in the metrics')
+
+    def test_metrics(self):
+        self.client.login(username='doctor1', password='password')
+        before = self.client.get('/metrics').content.decode()
+        self.assertEqual(self.client.get('/doctor_home/').status_code, 200)
+
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain'))
+        text = response.content.decode()
+
+        name = 'pulmoinsight_request_seconds_count{view="doctor_home",method="GET",status="200"}'
+        previous = self.sample(before, name) if name in before else 0
+        self.assertEqual(self.sample(text, name), previous + 1)
+        self.assertGreater(self.sample(text, 'pulmoinsight_db_queries_sum{view="doctor_home"}'), 0)
+        self.assertIn('pulmoinsight_template_render_seconds_count{template="doctor/doctor_home.html"}', text)
+        self.assertIn('pulmoinsight_async_executor_pending', text)
+
+        self.assertEqual(self.client.get('/metrics', REMOTE_ADDR='10.0.0.1').status_code, 403)
+
+
+class ModelSelectionTest(TestCase):
+    """
+    Checks picking a model by name, version pinning and shadowing a candidate model.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        seed_database(patients=5)
+
+    def setUp(self):
+        from django.test import override_settings
+
+        from .benchmark import build_synthetic_model
+        from .shadow import reset_stats
+
+        tmp_dir = use_synthetic_model(self)
+        # the default model is the synthetic one, the candidate has its own input size and normalization
+        models = override_settings(
+            INFERENCE_MODELS={
+                'production': {'classes': ('normal', 'pneumonia')},
+                'candidate': {
+                    'path': build_synthetic_model(os.path.join(tmp_dir, 'candidate.onnx'), image_size=160, seed=1),
+                    'image_size': 160,
+                    'mean': 0.5,
+                    'std': 0.25,
+                    'classes': ('normal', 'pneumonia'),
+                },
+            },
+            INFERENCE_DEFAULT_MODEL='production',
+        )
+        models.enable()
+        self.addCleanup(models.disable)
+
+        reset_stats()
+        self.addCleanup(reset_stats)
+
+        self.image_path = os.path.join(SAMPLE_DIR, 'normal1.jpeg')
+        self.client.login(username='doctor1', password='password')
+
+    def predict(self, model=None):
+        data = {} if model is None else {'model': model}
+        with open(self.image_path, 'rb') as f:
+            return self.client.post('/api/predict/', dict(data, image=f))
+
+    def test_pick_model(self):
+        from .onnx_inference import get_model_version
+
+        production = self.predict().json()
+        candidate = self.predict('candidate').json()
+        self.assertEqual((production['model'], candidate['model']), ('production', 'candidate'))
+        self.assertEqual(candidate['model_version'], get_model_version('candidate'))
+        self.assertNotEqual(production['model_version'], candidate['model_version'])
+        self.assertNotEqual(production['probabilities'], candidate['probabilities'])
+
+        self.assertEqual(self.predict('missing').status_code, 400)
+
+    def test_version_pinning(self):
+        from .onnx_inference import ModelVersionMismatch, get_model_version
+
+        version = get_model_version('candidate')
+        models = dict(settings.INFERENCE_MODELS)
+        models['candidate'] = dict(models['candidate'], version=version[:8])
+        with self.settings(INFERENCE_MODELS=models):
+            self.assertEqual(self.predict('candidate').status_code, 200)
+
+        models['candidate'] = dict(models['candidate'], version='0' * 16)
+        with self.settings(INFERENCE_MODELS=models):
+            with self.assertRaises(ModelVersionMismatch):
+                get_model_version('candidate')
+            self.assertEqual(self.predict('candidate').status_code, 503)
+
+    def test_models_sharing_a_file(self):
+        from .onnx_inference import get_model_spec
+
+        models = dict(settings.INFERENCE_MODELS)
+        models['normalized'] = {'mean': 0.5, 'std': 0.25, 'classes': ('normal', 'pneumonia')}
+        with self.settings(INFERENCE_MODELS=models):
+            self.assertEqual(get_model_spec('normalized').path, get_model_spec('production').path)
+            production = self.predict('production').json()
+            normalized = self.predict('normalized').json()
+        # same file and version, but the other preprocessing must not reuse the cached prediction
+        self.assertEqual(production['model_version'], normalized['model_version'])
+        self.assertNotEqual(production['probabilities'], normalized['probabilities'])
+
+    def test_score_images_with_a_model(self):
+        import csv
+        import io
+
+        from django.core.management import call_command
+
+        models = dict(settings.INFERENCE_MODELS)
+        models['reversed'] = {'classes': ('pneumonia', 'normal')}
+        output = os.path.join(settings.MEDIA_ROOT, 'scores.csv')
+        with self.settings(INFERENCE_MODELS=models):
+            scores = {}
+            for model in ('production', 'reversed', 'candidate'):
+                call_command('score_images', self.image_path, '--model', model, '--output', output,
+                             stdout=io.StringIO())
+                with open(output, newline='') as f:
+                    scores[model] = next(csv.DictReader(f))
+                self.assertEqual(scores[model]['model'], model)
+
+            expected = self.predict('candidate').json()['probabilities']
+        self.assertAlmostEqual(float(scores['candidate']['probability_pneumonia']), expected['pneumonia'], places=5)
+        # the outputs are labelled with each model's own classes
+        self.assertEqual(scores['reversed']['probability_normal'], scores['production']['probability_pneumonia'])
+        self.assertNotEqual(scores['reversed']['result'], scores['production']['result'])
+
+    def test_shadow(self):
+        import io
+
+        from .prediction_cache import cached_inference, cached_inference_batch, prediction_cache
+        from .shadow import get_executor, shadow_stats
+
+        with open(self.image_path, 'rb') as f:
+            data = f.read()
+
+        with self.settings(INFERENCE_SHADOW_MODEL='candidate', INFERENCE_SHADOW_SAMPLE_RATE=1.):
+            production = cached_inference(io.BytesIO(data))
+            # candidate predictions are never shadowed themselves
+            cached_inference(io.BytesIO(data), model='candidate')
+            # the comparison runs on the single shadow thread, after which this no-op runs
+            get_executor().submit(lambda: None).result(timeout=30)
+
+        stats = shadow_stats()['candidate']
+        self.assertEqual(stats['comparisons'], 1)
+        self.assertEqual(stats['errors'], 0)
+        self.assertEqual(sum(stats['confusion'].values()), 1)
+        self.assertTrue(next(iter(stats['confusion'])).startswith(production[1] + '->'))
+
+        # cache hits are not compared again
+        with self.settings(INFERENCE_SHADOW_MODEL='candidate', INFERENCE_SHADOW_SAMPLE_RATE=1.):
+            cached_inference(io.BytesIO(data))
+            cached_inference_batch([data])
+            get_executor().submit(lambda: None).result(timeout=30)
+        self.assertEqual(shadow_stats()['candidate']['comparisons'], 1)
+
+        prediction_cache.clear()
+        with self.settings(INFERENCE_SHADOW_MODEL='candidate', INFERENCE_SHADOW_SAMPLE_RATE=0.):
+            cached_inference(io.BytesIO(data))
+        self.assertEqual(shadow_stats()['candidate']['comparisons'], 1)
+
+
+class WarmupTest(SimpleTestCase):
+    """
+    Checks that startup imports no inference libraries and that the warm-up loads and runs the models.
+    """
+
+    def test_lazy_imports(self):
+        import subprocess
+        import sys
+
+        script = ('import sys, django; django.setup()\n'
+                  'from django.urls import get_resolver; get_resolver().url_patterns\n'
+                  'print(",".join(m for m in ("numpy", "cv2", "PIL.Image", "onnxruntime") if m in sys.modules))')
+        env = dict(os.environ, DJANGO_SETTINGS_MODULE='PulmoInsight.settings', PULMOINSIGHT_WARMUP='off')
+        process = subprocess.run([sys.executable, '-c', script], cwd=settings.BASE_DIR, env=env,
+                                 capture_output=True, text=True, timeout=60)
+        self.assertEqual(process.returncode, 0, process.stderr)
+        self.assertEqual(process.stdout.strip(), '')
+
+    def test_warm_up(self):
+        from .onnx_inference import model_registry
+        from .warmup import start_warmup, warm_up
+
+        tmp_dir = use_synthetic_model(self)
+        model_path = settings.INFERENCE_MODEL_PATH
+
+        with self.assertLogs('pneumonia_app.warmup', level='INFO'):
+            timings = warm_up()
+        self.assertEqual(list(timings), [settings.INFERENCE_DEFAULT_MODEL])
+        self.assertIn(model_path, model_registry.stats())
+
+        model_registry.unload(model_path)
+        with self.assertLogs('pneumonia_app.warmup', level='INFO'):
+            start_warmup('background').join(timeout=30)
+        self.assertIn(model_path, model_registry.stats())
+        model_registry.unload(model_path)
+
+        # a missing model is logged, the process still starts
+        with self.settings(INFERENCE_MODEL_PATH=os.path.join(tmp_dir, 'missing.onnx')):
+            with self.assertLogs('pneumonia_app.warmup', level='ERROR'):
+                self.assertIsNone(start_warmup('sync'))
+
+    def test_benchmark_startup(self):
+        import io
+        import json
+        import shutil
+        import tempfile
+
+        from django.core.management import call_command
+
+        try:
+            import onnx  # noqa: F401
+        except ImportError:
+            self.skipTest('the synthetic model requires the onnx package')
+
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        output = os.path.join(tmp_dir, 'startup.json')
+        optimized_dir = os.path.join(tmp_dir, 'onnx')
+        call_command('benchmark_startup', '--repeat', '1', '--modes', 'off,sync', '--synthetic',
+                     '--optimized-model-dir', optimized_dir, '--output', output, stderr=io.StringIO())
+
+        with open(output) as f:
+            report = json.load(f)
+        self.assertTrue(report['model']['synthetic'])
+        self.assertEqual(set(report['results']), {'off', 'sync'})
+        # without a warm-up nothing heavy is imported at startup, the sync warm-up imports the stack
+        self.assertEqual(report['results']['off']['heavy_modules_after_startup'], [])
+        self.assertIn('onnxruntime', report['results']['sync']['heavy_modules_after_startup'])
+        for name in ('process_ms', 'setup_ms', 'first_page_ms', 'first_inference_ms', 'second_inference_ms'):
+            self.assertGreater(report['results']['off'][name]['mean_ms'], 0, name)
+        # the probes wrote their optimized graph to the given folder
+        self.assertTrue(os.listdir(optimized_dir))
+
+
+class FeatureStoreTest(TestCase):
+    """
+    Checks the feature store of preprocessed record images and scoring from it without decoding.
+    """
+
+    def setUp(self):
+        import shutil
+
+        from .feature_store import close_shards
+        from .models import MedicalRecord, Patient
+
+        tmp_dir = use_synthetic_model(self, FEATURE_STORE_SHARD_SIZE=2)
+        self.addCleanup(close_shards)
+
+        os.makedirs(os.path.join(tmp_dir, 'pulmonary_images'))
+        patient = Patient.objects.create(name='patient', gender='male', age=30, occupation='teacher',
+                                         phone_number='123', address='street')
+        self.records = []
+        for name in ('normal1.jpeg', 'normal2.jpeg', 'person1_bacteria_1.jpeg'):
+            shutil.copy(os.path.join(SAMPLE_DIR, name), os.path.join(tmp_dir, 'pulmonary_images', name))
+            self.records.append(MedicalRecord.objects.create(patient=patient,
+                                                             pulmonary_image=f'pulmonary_images/{name}'))
+
+    def test_put_get(self):
+        from .derivatives import load_model_input
+        from .feature_store import ensure_features, get_features
+        from .models import MedicalRecord
+
+        for record in self.records:
+            ensure_features(record)
+
+        # three rows fill the first shard of two and start the second
+        slots = [(record.stored_features.shard, record.stored_features.row) for record in self.records]
+        self.assertEqual(slots, [(0, 0), (0, 1), (1, 0)])
+
+        for record in MedicalRecord.objects.filter(patient=self.records[0].patient).select_related('stored_features'):
+            with self.assertNumQueries(0):
+                features = get_features(record)
+            self.assertFalse(features.flags.writeable)
+            np.testing.assert_array_equal(features, load_model_input(record.pulmonary_image.path))
+
+        # a record pointing to another image is preprocessed again, into its old row
+        record = self.records[0]
+        record.pulmonary_image = 'pulmonary_images/normal2.jpeg'
+        record.save()
+        self.assertIsNone(get_features(record))
+        ensure_features(record)
+        self.assertEqual((record.stored_features.shard, record.stored_features.row), (0, 0))
+        np.testing.assert_array_equal(get_features(record), get_features(self.records[1]))
+
+    def test_inference_without_decoding(self):
+        from unittest import mock
+
+        from .feature_store import ensure_features, record_inference
+        from .onnx_inference import inference_resnet18sam, read_image
+
+        record = self.records[2]
+        ensure_features(record)
+        expected = inference_resnet18sam(read_image(record.pulmonary_image.path))
+
+        with mock.patch('pneumonia_app.prediction_cache.read_image', side_effect=AssertionError('decoded')), \
+                mock.patch('pneumonia_app.prediction_cache.load_model_input', side_effect=AssertionError('decoded')):
+            _, result, probabilities = record_inference(record)
+        self.assertEqual(result, expected[1])
+        np.testing.assert_allclose(probabilities, expected[2], rtol=1e-6)
+
+    def test_score_records(self):
+        import io
+        from unittest import mock
+
+        from django.core.management import call_command
+
+        from .models import InferenceResult, StoredFeatures
+
+        # the first run decodes the originals and fills the store
+        output = io.StringIO()
+        call_command('score_images', '--records', '--workers', '2', stdout=output, stderr=io.StringIO())
+        self.assertIn('Scored 3 images (0 failed, 0 from the feature store)', output.getvalue())
+        self.assertEqual(StoredFeatures.objects.count(), 3)
+        self.assertFalse(InferenceResult.objects.filter(inference_time__isnull=True).exists())
+        scores = dict(InferenceResult.objects.values_list('medical_record_id', 'probability_pneumonia'))
+
+        # re-scoring the archive reads every image from the store
+        InferenceResult.objects.all().delete()
+        output = io.StringIO()
+        with mock.patch('pneumonia_app.management.commands.score_images.read_image',
+                        side_effect=AssertionError('decoded')):
+            call_command('score_images', '--records', stdout=output, stderr=io.StringIO())
+        self.assertIn('Scored 3 images (0 failed, 3 from the feature store)', output.getvalue())
+        rescored = dict(InferenceResult.objects.values_list('medical_record_id', 'probability_pneumonia'))
+        self.assertEqual(rescored.keys(), scores.keys())
+        for record_id, probability in scores.items():
+            self.assertAlmostEqual(rescored[record_id], probability, places=5)
+
+
+class InferenceJobTest(TestCase):
+    """
+    Checks the background inference jobs: their status transitions, retries and re-queueing.
+    """
+
+    def setUp(self):
+        import shutil
+        from unittest import mock
+
+        from .models import InferenceResult, MedicalRecord, Patient
+
+        tmp_dir = use_synthetic_model(self, INFERENCE_JOB_MAX_RETRIES=2, INFERENCE_JOB_RETRY_DELAY=5)
+
+        # the job closes stale connections, which would end the test case's transaction
+        close_old_connections = mock.patch('pneumonia_app.jobs.close_old_connections')
+        close_old_connections.start()
+        self.addCleanup(close_old_connections.stop)
+        # retries are recorded instead of scheduled
+        submit = mock.patch('pneumonia_app.jobs._submit')
+        self.submit = submit.start()
+        self.addCleanup(submit.stop)
+
+        os.makedirs(os.path.join(tmp_dir, 'pulmonary_images'))
+        shutil.copy(os.path.join(SAMPLE_DIR, 'normal1.jpeg'), os.path.join(tmp_dir, 'pulmonary_images'))
+        patient = Patient.objects.create(name='patient', gender='male', age=30, occupation='teacher',
+                                         phone_number='123', address='street')
+        self.record = MedicalRecord.objects.create(patient=patient, pulmonary_image='pulmonary_images/normal1.jpeg')
+        self.result = InferenceResult.objects.create(medical_record=self.record)
+
+    def run_job(self):
+        from .jobs import run_inference_job
+
+        with self.captureOnCommitCallbacks(execute=True):
+            run_inference_job(self.result.id)
+        self.result.refresh_from_db()
+        return self.result
+
+    def test_done(self):
+        from .models import InferenceResult
+        from .onnx_inference import get_model_version
+
+        result = self.run_job()
+        self.assertEqual((result.status, result.attempts, result.error), (InferenceResult.STATUS_DONE, 1, ''))
+        self.assertIn(result.result, ('normal', 'pneumonia'))
+        self.assertIsNotNone(result.probability_pneumonia)
+        self.assertEqual(result.model_version, get_model_version())
+        self.submit.assert_not_called()
+
+        # a finished job is not run again
+        self.assertEqual(self.run_job().attempts, 1)
+
+    def test_probabilities_by_label(self):
+        from .models import InferenceResult
+
+        expected = self.run_job()
+        normal, pneumonia, label = expected.probability_normal, expected.probability_pneumonia, expected.result
+        InferenceResult.objects.filter(id=self.result.id).update(status=InferenceResult.STATUS_PENDING)
+
+        # a default model listing pneumonia first stores the same probability under each label
+        models = dict(settings.INFERENCE_MODELS)
+        models['reversed'] = dict(models[settings.INFERENCE_DEFAULT_MODEL], classes=('pneumonia', 'normal'))
+        with self.settings(INFERENCE_MODELS=models, INFERENCE_DEFAULT_MODEL='reversed'):
+            result = self.run_job()
+        self.assertAlmostEqual(result.probability_normal, pneumonia, places=5)
+        self.assertAlmostEqual(result.probability_pneumonia, normal, places=5)
+        self.assertNotEqual(result.result, label)
+
+    def test_retry_backoff(self):
+        from unittest import mock
+
+        from .models import InferenceResult
+
+        # the retry is only submitted once the row says pending, a fast retry never sees it running
+        self.submit.side_effect = lambda result_id, delay=0: self.assertEqual(
+            InferenceResult.objects.get(id=result_id).status, InferenceResult.STATUS_PENDING)
+
+        failing = mock.patch('pneumonia_app.prediction_cache.cached_inference', side_effect=RuntimeError('model failed'))
+        with failing, self.assertLogs('pneumonia_app.jobs', level='ERROR'):
+            # retried after 5 s, then 10 s, then given up
+            for attempt, delay in ((1, 5), (2, 10)):
+                result = self.run_job()
+                self.assertEqual((result.status, result.attempts), (InferenceResult.STATUS_PENDING, attempt))
+                self.submit.assert_called_with(result.id, delay=delay)
+
+            self.submit.reset_mock()
+            result = self.run_job()
+        self.assertEqual((result.status, result.attempts), (InferenceResult.STATUS_FAILED, 3))
+        self.assertEqual(result.error, 'model failed')
+        self.submit.assert_not_called()
+
+    def test_image_too_large_is_not_retried(self):
+        from .models import InferenceResult
+
+        with self.settings(IMAGE_MAX_PIXELS=100), self.assertLogs('pneumonia_app.jobs', level='ERROR'):
+            result = self.run_job()
+        self.assertEqual((result.status, result.attempts), (InferenceResult.STATUS_FAILED, 1))
+        self.submit.assert_not_called()
+
+    def test_requeue(self):
+        from unittest import mock
+
+        from .jobs import enqueue_pending, start_requeue
+        from .models import InferenceResult, MedicalRecord
+
+        # one job left running by a crashed worker, one pending, one done
+        InferenceResult.objects.filter(id=self.result.id).update(status=InferenceResult.STATUS_RUNNING)
+        for status in (InferenceResult.STATUS_PENDING, InferenceResult.STATUS_DONE):
+            record = MedicalRecord.objects.create(patient=self.record.patient,
+                                                  pulmonary_image=self.record.pulmonary_image)
+            InferenceResult.objects.create(medical_record=record, status=status)
+
+        self.assertEqual(enqueue_pending(), 2)
+        self.assertEqual(sorted(call.args[0] for call in self.submit.call_args_list),
+                         list(InferenceResult.objects.exclude(status=InferenceResult.STATUS_DONE)
+                              .order_by('id').values_list('id', flat=True)))
+
+        self.assertIsNone(start_requeue(enabled=False))
+        with mock.patch('pneumonia_app.jobs.enqueue_pending', return_value=2) as requeue, \
+                self.assertLogs('pneumonia_app.jobs', level='INFO'):
+            start_requeue(enabled=True).join(timeout=30)
+        requeue.assert_called_once_with()
+
+
+class DbWriteBenchmarkTest(SimpleTestCase):
+    """
+    Smoke-runs benchmark_db_writes, which writes to its own throwaway SQLite databases.
+    """
+
+    def test_report(self):
+        import io
+        import json
+        import shutil
+        import tempfile
+
+        from django.core.management import call_command
+        from django.db import connections
+
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        output = os.path.join(tmp_dir, 'db.json')
+        call_command('benchmark_db_writes', '--threads', '1,2', '--operations', '3', '--profiles',
+                     'sqlite-default,sqlite-tuned', '--output', output, stderr=io.StringIO())
+
+        with open(output) as f:
+            report = json.load(f)
+        self.assertEqual(report['operations_per_writer'], 3)
+        self.assertEqual(set(report['results']), {'sqlite-default', 'sqlite-tuned'})
+        for profile in report['results'].values():
+            self.assertEqual(set(profile), {'threads=1', 'threads=2'})
+            for result in profile.values():
+                self.assertEqual(result['operations'] + result['failed'], 3 * result['threads'])
+                self.assertGreater(result['writes_per_second'], 0)
+        self.assertNotIn('benchmark', connections.settings)
+
+    def test_unknown_profile(self):
+        import io
+
+        from django.core.management import CommandError, call_command
+
+        with self.assertRaisesMessage(CommandError, 'Unknown profiles: oracle'):
+            call_command('benchmark_db_writes', '--profiles', 'oracle', stdout=io.StringIO(), stderr=io.StringIO())
+
+
+class DownloadTest(SimpleTestCase):
+    """
+    Checks the validators, conditional requests and byte ranges of downloads.serve_file.
+    """
+
+    def setUp(self):
+        import tempfile
+
+        from django.test import RequestFactory
+
+        self.factory = RequestFactory()
+        self.content = bytes(range(256)) * 40
+        f = tempfile.NamedTemporaryFile(suffix='.png', delete=False)
+        self.addCleanup(os.remove, f.name)
+        with f:
+            f.write(self.content)
+        self.path = f.name
+
+    def serve(self, **headers):
+        from .downloads import serve_file
+
+        return serve_file(self.factory.get('/download/', headers=headers), self.path, filename='scan.png')
+
+    @staticmethod
+    def body(response):
+        return b''.join(response.streaming_content)
+
+    def test_full_file(self):
+        response = self.serve()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.body(response), self.content)
+        self.assertEqual(response['Content-Type'], 'image/png')
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        self.assertTrue(response['ETag'].startswith('"'))
+        self.assertTrue(response['Last-Modified'].endswith('GMT'))
+
+    def test_not_modified(self):
+        validators = self.serve()
+        for headers in ({'If-None-Match': validators['ETag']},
+                        {'If-Modified-Since': validators['Last-Modified']}):
+            response = self.serve(**headers)
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response['ETag'], validators['ETag'])
+            self.assertEqual(response['Last-Modified'], validators['Last-Modified'])
+            self.assertEqual(response.content, b'')
+
+    def test_range(self):
+        response = self.serve(Range='bytes=100-199')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], f'bytes 100-199/{len(self.content)}')
+        self.assertEqual(response['Content-Length'], '100')
+        self.assertEqual(self.body(response), self.content[100:200])
+
+        # suffix range, and an end past the file clamped to it
+        self.assertEqual(self.body(self.serve(Range='bytes=-10')), self.content[-10:])
+        self.assertEqual(self.body(self.serve(Range=f'bytes={len(self.content) - 5}-99999')), self.content[-5:])
+
+        etag = response['ETag']
+        self.assertEqual(self.serve(Range='bytes=0-9', **{'If-Range': etag}).status_code, 206)
+
+    def test_if_range_mismatch(self):
+        # the client's copy is outdated, it gets the whole file
+        response = self.serve(Range='bytes=0-9', **{'If-Range': '"outdated"'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.body(response), self.content)
+
+    def test_unsatisfiable_range(self):
+        for header in (f'bytes={len(self.content)}-', 'bytes=-0', 'bytes=20-10'):
+            response = self.serve(Range=header)
+            self.assertEqual(response.status_code, 416)
+            self.assertEqual(response['Content-Range'], f'bytes */{len(self.content)}')
+
+    def test_missing_file(self):
+        from django.http import Http404
+
+        from .downloads import serve_file
+
+        with self.assertRaises(Http404):
+            serve_file(self.factory.get('/download/'), self.path + '.missing')
+
+
+class PredictionCacheTest(SimpleTestCase):
+    """
+    Checks that replacing the model file invalidates both tiers of the prediction cache.
+    """
+
+    def setUp(self):
+        use_synthetic_model(self)
+
+        with open(os.path.join(SAMPLE_DIR, 'normal1.jpeg'), 'rb') as f:
+            self.data = f.read()
+
+    def predict(self):
+        import io
+
+        from .prediction_cache import cached_inference
+
+        return cached_inference(io.BytesIO(self.data), shadow=False)
+
+    def test_model_file_change(self):
+        import hashlib
+
+        from .onnx_inference import get_model_spec, get_model_version
+        from .prediction_cache import PredictionCache, prediction_cache
+
+        spec = get_model_spec()
+        digest = hashlib.sha256(self.data).hexdigest()
+        version = get_model_version()
+
+        stats = prediction_cache.stats()
+        first = self.predict()
+        np.testing.assert_array_equal(self.predict()[2], first[2])
+        # the second lookup hits the in-process LRU
+        self.assertEqual(prediction_cache.stats()['hits'], stats['hits'] + 1)
+        self.assertEqual(prediction_cache.stats()['misses'], stats['misses'] + 1)
+
+        # another process starts with an empty LRU and finds the prediction in the persistent cache
+        other_process = PredictionCache()
+        self.assertIsNotNone(other_process.get(digest, version, spec.name, spec.config_hash))
+        self.assertEqual((other_process.persistent_hits, other_process.stats()['size']), (1, 1))
+
+        replace_model_file(settings.INFERENCE_MODEL_PATH, seed=1)
+        new_version = get_model_version()
+        self.assertNotEqual(new_version, version)
+
+        # neither tier answers for the new model, and the LRU drops the entries of the old one
+        self.assertIsNone(other_process.get(digest, new_version, spec.name, spec.config_hash))
+        self.assertEqual(other_process.stats()['size'], 0)
+
+        misses = prediction_cache.stats()['misses']
+        second = self.predict()
+        self.assertEqual(prediction_cache.stats()['misses'], misses + 1)
+        self.assertNotEqual(second[2].tolist(), first[2].tolist())
+        self.assertEqual(prediction_cache.stats()['versions'][spec.name], new_version)
+        self.assertEqual(prediction_cache.stats()['size'], 1)
+
+
+class InferenceBatcherTest(SimpleTestCase):
+    """
+    Checks how the micro-batcher splits concurrent requests into batches and reports model errors.
+    """
+
+    def test_batches(self):
+        import threading
+
+        from .batching import InferenceBatcher
+
+        sizes = []
+        release = threading.Event()
+
+        def run(batch):
+            # the first batch holds the worker until every request is queued
+            release.wait(timeout=5)
+            sizes.append(len(batch))
+            return [batch.reshape(len(batch), -1)[:, :1] * 2], 1.5
+
+        batcher = InferenceBatcher(run, max_batch_size=3, max_wait_ms=50)
+        futures = [batcher.submit(np.full((1, 1, 2, 2), i, dtype=np.float32)) for i in range(7)]
+        release.set()
+
+        for i, future in enumerate(futures):
+            outs, run_time = future.result(timeout=5)
+            # every request gets its own row, shaped like a single-image run
+            self.assertEqual(outs[0].tolist(), [[2. * i]])
+            self.assertEqual(run_time, 1.5)
+        # requests queued while a batch runs are split into full batches of at most max_batch_size
+        self.assertEqual(sum(sizes), 7)
+        self.assertEqual(max(sizes), 3)
+        self.assertEqual(batcher.stats()['items'], 7)
+        self.assertEqual(batcher.stats()['largest_batch'], max(sizes))
+
+    def test_model_error(self):
+        import threading
+
+        from .batching import InferenceBatcher
+
+        release = threading.Event()
+
+        def run(batch):
+            release.wait(timeout=5)
+            raise RuntimeError('model failed')
+
+        batcher = InferenceBatcher(run, max_batch_size=4, max_wait_ms=50)
+        futures = [batcher.submit(np.zeros((1, 1, 2, 2), dtype=np.float32)) for _ in range(4)]
+        release.set()
+
+        # every caller of the failed batches gets the error
+        for future in futures:
+            with self.assertRaisesMessage(RuntimeError, 'model failed'):
+                future.result(timeout=5)
+        self.assertEqual(batcher.stats()['failed'], 4)
+        self.assertEqual(batcher.stats()['batches'], 0)
+
+
+class ModelRegistryTest(SimpleTestCase):
+    """
+    Checks that the model registry shares one session per file and reloads it when the file changes.
+    """
+
+    def test_reload_on_mtime_change(self):
+        from .onnx_inference import ModelRegistry
+
+        use_synthetic_model(self)
+        model_path = settings.INFERENCE_MODEL_PATH
+        registry = ModelRegistry()
+
+        session = registry.get_session(model_path)
+        version = registry.get_version(model_path)
+        self.assertIs(registry.get_session(model_path), session)
+        self.assertEqual(registry.stats()[model_path]['loads'], 1)
+
+        replace_model_file(model_path, seed=1)
+        new_session = registry.get_session(model_path)
+        self.assertIsNot(new_session, session)
+        self.assertNotEqual(registry.get_version(model_path), version)
+        self.assertEqual(registry.stats()[model_path]['loads'], 2)
+        self.assertEqual(registry.stats()[model_path]['mtime'], os.stat(model_path).st_mtime_ns)
+
+        # the version follows the bytes: restoring the old file brings back the old version
+        replace_model_file(model_path, seed=0)
+        self.assertEqual(registry.get_version(model_path), version)
+        self.assertEqual(registry.stats()[model_path]['loads'], 3)
+
+        registry.unload(model_path)
+        self.assertEqual(registry.stats(), {})
+
+
+class IOBindingTest(SimpleTestCase):
+    """
+    Checks that runs with INFERENCE_IO_BINDING give the same outputs as plain session.run.
+    """
+
+    def test_matches_plain_run(self):
+        from .onnx_inference import run_model
+
+        use_synthetic_model(self)
+        rng = np.random.default_rng(0)
+
+        for batch_size in (1, 3, 1):
+            batch = rng.random((batch_size, 1, IMAGE_SIZE, IMAGE_SIZE), dtype=np.float32)
+            with self.settings(INFERENCE_IO_BINDING=False):
+                expected, _ = run_model(batch)
+            with self.settings(INFERENCE_IO_BINDING=True):
+                outs, _ = run_model(batch)
+
+            self.assertEqual(len(outs), len(expected))
+            for out, expected_out in zip(outs, expected):
+                self.assertEqual(out.shape, expected_out.shape)
+                np.testing.assert_allclose(out, expected_out, rtol=1e-5, atol=1e-6)
+
+    def test_buffers_are_reused(self):
+        from .onnx_inference import run_model
+
+        use_synthetic_model(self, INFERENCE_IO_BINDING=True)
+        batch = np.zeros((2, 1, IMAGE_SIZE, IMAGE_SIZE), dtype=np.float32)
+
+        # the outputs are per-thread buffers the next run of the same shape writes into
+        first, _ = run_model(batch)
+        kept = first[0].copy()
+        second, _ = run_model(batch + 1.)
+        self.assertIs(second[0], first[0])
+        self.assertFalse(np.allclose(second[0], kept))
+
+
+class ScoreImagesTest(SimpleTestCase):
+    """
+    Smoke-runs score_images over a folder with a synthetic model, including resuming a run.
+    """
+
+    def test_folder(self):
+        import io
+        import json
+        import shutil
+
+        from django.core.management import call_command
+
+        tmp_dir = use_synthetic_model(self)
+        images = os.path.join(tmp_dir, 'images')
+        os.makedirs(os.path.join(images, 'nested'))
+        shutil.copy(os.path.join(SAMPLE_DIR, 'normal1.jpeg'), images)
+        shutil.copy(os.path.join(SAMPLE_DIR, 'person1_bacteria_1.jpeg'), os.path.join(images, 'nested'))
+        with open(os.path.join(images, 'broken.png'), 'wb') as f:
+            f.write(b'not an image')
+        with open(os.path.join(images, 'notes.txt'), 'w') as f:
+            f.write('not scored')
+
+        output = os.path.join(tmp_dir, 'scores.jsonl')
+        stdout, stderr = io.StringIO(), io.StringIO()
+        call_command('score_images', images, '--output', output, '--batch-size', '1', '--workers', '2',
+                     stdout=stdout, stderr=stderr)
+        self.assertIn('Scored 2 images (1 failed', stdout.getvalue())
+        self.assertIn('broken.png', stderr.getvalue())
+
+        with open(output) as f:
+            rows = [json.loads(line) for line in f]
+        self.assertEqual(sorted(os.path.relpath(row['key'], images) for row in rows),
+                         ['nested/person1_bacteria_1.jpeg', 'normal1.jpeg'])
+        for row in rows:
+            self.assertIn(row['result'], ('normal', 'pneumonia'))
+            self.assertTrue(0. <= row['probability_normal'] <= 1. and 0. <= row['probability_pneumonia'] <= 1.)
+            self.assertEqual(row['model'], settings.INFERENCE_DEFAULT_MODEL)
+
+        # a resumed run only scores what is missing
+        shutil.copy(os.path.join(SAMPLE_DIR, 'normal1.jpeg'), os.path.join(images, 'copy.jpeg'))
+        stdout = io.StringIO()
+        call_command('score_images', images, '--output', output, '--resume', stdout=stdout, stderr=io.StringIO())
+        self.assertIn('Scored 1 images', stdout.getvalue())
+        with open(output) as f:
+            self.assertEqual(len(f.readlines()), 3)
+
+    def test_arguments(self):
+        from django.core.management import CommandError, call_command
+
+        with self.assertRaisesMessage(CommandError, 'Give at least one path or --records.'):
+            call_command('score_images')
+        with self.assertRaisesMessage(CommandError, '--output must end with .csv or .jsonl'):
+            call_command('score_images', SAMPLE_DIR, '--output', 'scores.txt')
+
+
+class BenchmarkInferenceTest(SimpleTestCase):
+    """
+    Smoke-runs benchmark_inference on a synthetic model with a single short iteration.
+    """
+
+    def test_report(self):
+        import io
+        import json
+
+        from django.core.management import call_command
+
+        from unittest import mock
+
+        from .onnx_inference import model_registry
+
+        def benchmark_requests(paths, tmp_dir, repeat):
+            # the requests need a database of their own, only their model load is run here
+            model_registry.get_session()
+            return {}
+
+        tmp_dir = use_synthetic_model(self)
+        # the benchmark must not write optimized graphs into the configured folder
+        optimized_dir = os.path.join(tmp_dir, 'optimized')
+        output = os.path.join(tmp_dir, 'bench.json')
+        with self.settings(INFERENCE_OPTIMIZED_MODEL_DIR=optimized_dir), \
+                mock.patch('pneumonia_app.management.commands.benchmark_inference.Command.benchmark_requests',
+                           side_effect=benchmark_requests) as requests:
+            call_command('benchmark_inference', '--synthetic', '--repeat', '1', '--batch-sizes', '1,2',
+                         '--threads', '1', '--large-size', '256', '--output', output, stderr=io.StringIO())
+        requests.assert_called_once()
+        self.assertFalse(os.path.exists(optimized_dir))
+
+        with open(output) as f:
+            report = json.load(f)
+        self.assertTrue(report['model']['synthetic'])
+        results = report['results']
+        for name in ('session_create', 'decode', 'preprocess'):
+            self.assertGreater(results[name]['mean_ms'], 0, name)
+        self.assertEqual(set(results['run']), {'threads=1,batch=1', 'threads=1,batch=2'})
+        self.assertEqual(set(results['decode_large']), {'jpeg,full', 'jpeg,reduced', 'png16,full', 'png16,reduced'})
+
+
+class QuantizeModelTest(SimpleTestCase):
+    """
+    Smoke-runs quantize_model on a synthetic model and checks its accuracy gate.
+    """
+
+    def quantize(self, *args):
+        import io
+        import json
+        import logging
+
+        from django.core.management import call_command
+
+        output = io.StringIO()
+        images = [os.path.join(SAMPLE_DIR, name) for name in ('normal1.jpeg', 'person1_bacteria_1.jpeg')]
+        # the quantization tools warn on the root logger about graphs not pre-processed for them
+        root_logger = logging.getLogger()
+        level = root_logger.level
+        root_logger.setLevel(logging.ERROR)
+        try:
+            call_command('quantize_model', *images, '--variants', 'int8-dynamic', *args, stdout=output,
+                         stderr=io.StringIO())
+        finally:
+            root_logger.setLevel(level)
+        return json.loads(output.getvalue())
+
+    def test_gate(self):
+        from .onnx_inference import variant_path
+
+        use_synthetic_model(self)
+        try:
+            from onnxruntime import quantization  # noqa: F401
+        except ImportError:
+            self.skipTest('onnxruntime quantization tools are unavailable')
+        path = variant_path(settings.INFERENCE_MODEL_PATH, 'int8-dynamic')
+
+        report = self.quantize('--min-agreement', '0', '--max-probability-diff', '1')
+        variant = report['int8-dynamic']
+        self.assertEqual((variant['built'], variant['passed'], variant['images']), (True, True, 2))
+        self.assertEqual(variant['path'], path)
+        self.assertTrue(os.path.exists(path))
+        self.assertEqual(report['fp32']['path'], settings.INFERENCE_MODEL_PATH)
+
+        # a variant failing the gate is removed unless asked to keep it
+        os.remove(path)
+        variant = self.quantize('--max-probability-diff', '-1')['int8-dynamic']
+        self.assertEqual((variant['passed'], variant['path']), (False, None))
+        self.assertFalse(os.path.exists(path))
+
+        self.quantize('--max-probability-diff', '-1', '--keep-failed')
+        self.assertTrue(os.path.exists(path))
+
+    def test_unknown_variant(self):
+        import io
+
+        from django.core.management import CommandError, call_command
+
+        use_synthetic_model(self)
+        with self.assertRaisesMessage(CommandError, 'Unknown variants: int4'):
+            call_command('quantize_model', '--variants', 'int4', stdout=io.StringIO(), stderr=io.StringIO())
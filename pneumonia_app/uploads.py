@@ -0,0 +1,219 @@
+import os
+import re
+import threading
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.utils import timezone
+
+from .decoding import ImageTooLarge, check_image_size
+from .models import ChunkedUpload, MedicalRecord, UploadedImage
+from .storage import content_addressed_storage, hash_file
+
+IMAGE_EXTENSIONS = ('.jpeg', '.jpg', '.png', '.bmp', '.tif', '.tiff')
+CONTENT_RANGE_RE = re.compile(r'^bytes (\d+)-(\d+)/(\d+)$')
+READ_SIZE = 64 * 1024
+
+# Completed uploads are stored in the upload folder of the field they are meant for
+TARGET_DIRS = {
+    ChunkedUpload.TARGET_MEDICAL_RECORD: MedicalRecord._meta.get_field('pulmonary_image').upload_to.rstrip('/'),
+    ChunkedUpload.TARGET_IMAGE: UploadedImage._meta.get_field('image').upload_to.rstrip('/'),
+}
+
+
+class UploadError(Exception):
+    """
+    A chunked upload request that cannot be accepted, with the HTTP status to answer it with.
+    """
+
+    def __init__(self, message, status=400, upload=None):
+        super().__init__(message)
+        self.status = status
+        self.upload = upload
+
+
+# upload id -> (offset, SHA-256 of the bytes before offset), so chunks are hashed as they arrive
+_hashers = {}
+_hashers_lock = threading.Lock()
+
+
+def part_path(upload):
+    """
+    Returns the path of the temporary file holding the bytes received so far.
+    """
+    return os.path.join(settings.CHUNKED_UPLOAD_DIR, f'{upload.id}.part')
+
+
+def _get_hasher(upload):
+    with _hashers_lock:
+        entry = _hashers.pop(upload.id, None)
+    if entry is not None and entry[0] == upload.offset:
+        return entry[1]
+
+    # received by another process or before a restart: rehash what is on disk
+    return hash_file(part_path(upload), length=upload.offset)
+
+
+def upload_status(upload):
+    """
+    Returns the JSON description of an upload sent back to the client.
+    """
+    return {
+        'upload_id': str(upload.id),
+        'filename': upload.filename,
+        'target': upload.target,
+        'size': upload.size,
+        'offset': upload.offset,
+        'status': upload.status,
+        'chunk_size': settings.CHUNKED_UPLOAD_CHUNK_SIZE,
+        'sha256': upload.sha256 or None,
+        'name': upload.stored_name or None,
+    }
+
+
+def clear_expired_uploads():
+    """
+    Deletes uploads (and their temporary files) not touched for CHUNKED_UPLOAD_EXPIRY seconds.
+
+    The stored files of completed uploads stay until collect_blobs finds nothing refers to them.
+    """
+    cutoff = timezone.now() - timezone.timedelta(seconds=settings.CHUNKED_UPLOAD_EXPIRY)
+    expired = ChunkedUpload.objects.filter(updated_at__lt=cutoff)
+    for upload in expired.filter(status=ChunkedUpload.STATUS_UPLOADING):
+        with _hashers_lock:
+            _hashers.pop(upload.id, None)
+        try:
+            os.remove(part_path(upload))
+        except FileNotFoundError:
+            pass
+    expired.delete()
+
+
+def start_upload(user, filename, size, target=ChunkedUpload.TARGET_MEDICAL_RECORD):
+    """
+    Starts a resumable upload of `size` bytes and returns its ChunkedUpload.
+    """
+    filename = os.path.basename(filename or '')
+    if not filename.lower().endswith(IMAGE_EXTENSIONS):
+        raise UploadError(f'Unsupported file type, expected one of {", ".join(IMAGE_EXTENSIONS)}')
+    if target not in TARGET_DIRS:
+        raise UploadError(f'Unknown upload target: {target}')
+    try:
+        size = int(size)
+    except (TypeError, ValueError):
+        raise UploadError('Missing or invalid size')
+    if not 0 < size <= settings.CHUNKED_UPLOAD_MAX_SIZE:
+        raise UploadError(f'The file must be between 1 and {settings.CHUNKED_UPLOAD_MAX_SIZE} bytes', status=413)
+
+    clear_expired_uploads()
+
+    upload = ChunkedUpload.objects.create(user=user, filename=filename, size=size, target=target)
+    os.makedirs(settings.CHUNKED_UPLOAD_DIR, exist_ok=True)
+    open(part_path(upload), 'wb').close()
+    return upload
+
+
+def append_chunk(upload_id, user, stream, content_range):
+    """
+    Appends one chunk, read from stream, to an upload and completes the upload after its last byte.
+
+    Args:
+        upload_id: Id of the ChunkedUpload.
+        user: The user who started the upload.
+        stream: File-like object the chunk is read from (the request).
+        content_range: 'bytes <first>-<last>/<size>' header of the chunk. The chunk must start at
+            the upload's current offset.
+
+    Returns:
+        The updated ChunkedUpload.
+    """
+    match = CONTENT_RANGE_RE.match(content_range or '')
+    if not match:
+        raise UploadError('Missing or invalid Content-Range header')
+    first, last, size = (int(value) for value in match.groups())
+
+    with transaction.atomic():
+        upload = ChunkedUpload.objects.select_for_update().filter(id=upload_id, user=user).first()
+        if upload is None:
+            raise UploadError('Upload not found', status=404)
+        if upload.status == ChunkedUpload.STATUS_COMPLETE:
+            return upload
+        if size != upload.size or last < first or last >= upload.size:
+            raise UploadError('Content-Range does not match the upload', upload=upload)
+        if first != upload.offset:
+            # the client resumes from the offset in the response
+            raise UploadError('Chunk does not start at the current offset', status=409, upload=upload)
+
+        hasher = _get_hasher(upload)
+        remaining = last - first + 1
+        with open(part_path(upload), 'r+b') as f:
+            # drop anything past the offset left by an interrupted request
+            f.seek(upload.offset)
+            f.truncate()
+            while remaining > 0:
+                chunk = stream.read(min(READ_SIZE, remaining))
+                if not chunk:
+                    # connection dropped: keep what arrived, the client resumes from the new offset
+                    break
+                f.write(chunk)
+                hasher.update(chunk)
+                upload.offset += len(chunk)
+                remaining -= len(chunk)
+
+        if upload.offset < upload.size:
+            with _hashers_lock:
+                _hashers[upload.id] = (upload.offset, hasher)
+            upload.save()
+        else:
+            error = _image_error(part_path(upload))
+            if error is None:
+                _complete(upload, hasher.hexdigest())
+                upload.save()
+            else:
+                # the error is raised once the deletion is committed
+                os.remove(part_path(upload))
+                upload.delete()
+                upload = None
+
+    if upload is None:
+        raise UploadError(*error)
+    return upload
+
+
+def _image_error(path):
+    # (message, status) if the file is not an image the app can decode, else None
+    from PIL import Image
+
+    try:
+        with Image.open(path) as image:
+            check_image_size(*image.size)
+            image.verify()
+    except ImageTooLarge as e:
+        return str(e), 413
+    except Exception:
+        return 'The uploaded file is not a valid image', 400
+    return None
+
+
+def _complete(upload, digest):
+    upload.sha256 = digest
+    # identical images are stored once
+    upload.stored_name = content_addressed_storage.store(part_path(upload), digest, TARGET_DIRS[upload.target],
+                                                         upload.filename)
+    upload.status = ChunkedUpload.STATUS_COMPLETE
+
+
+def completed_upload(user, upload_id, target):
+    """
+    Returns the user's completed upload with the given id and target, or None.
+    """
+    # anonymous users have no uploads, and filtering on one would raise
+    if not upload_id or not user.is_authenticated:
+        return None
+    try:
+        return ChunkedUpload.objects.filter(id=upload_id, user=user, target=target,
+                                            status=ChunkedUpload.STATUS_COMPLETE).first()
+    except ValidationError:
+        # not a valid UUID
+        return None
@@ -1,7 +1,7 @@
 from django.urls import path
 from django.conf import settings
 from django.conf.urls.static import static
-from pneumonia_app import views
+from pneumonia_app import api, views
 
 urlpatterns = [
     # Display the main page
@@ -47,10 +47,19 @@ urlpatterns = [
     # path('patient_home/help/', views., name='test'),
 
     path('upload/', views.upload, name='upload_view'),
+    path('upload/chunked/', views.chunked_upload_start, name='chunked_upload_start'),
+    path('upload/chunked/<uuid:upload_id>/', views.chunked_upload, name='chunked_upload'),
 
     path('delete_record/<int:record_id>/', views.delete_record, name='delete_record'),
     path('download/<str:filename>/', views.download_image, name='download_image'),
+    path('derivatives/<str:kind>/<path:name>', views.image_derivative, name='image_derivative'),
     path('patient_home/history/detailed_info/', views.patient_detailed_info, name='detailed_info'),
+
+    path('metrics', views.metrics, name='metrics'),
+
+    # JSON API
+    path('api/predict/', api.predict, name='api_predict'),
+    path('api/predict/batch/', api.predict_batch, name='api_predict_batch'),
 ]
 
 # provide MEDIA_URL service
@@ -1,5 +1,6 @@
 # Import necessary modules from Django
-from django.http import HttpResponse, JsonResponse
+from asgiref.sync import sync_to_async
+from django.http import Http404, HttpResponse, JsonResponse
 from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth import authenticate, login
 from django.contrib.auth.decorators import login_required
@@ -9,6 +10,19 @@ from django.contrib.auth import get_user_model
 from django.contrib import messages
 from django.conf import settings
 from django.utils import timezone
+from django.utils.http import urlencode
+from django.db.models import (
+    BooleanField,
+    Case,
+    CharField,
+    DateTimeField,
+    OuterRef,
+    Q,
+    Subquery,
+    TextField,
+    Value,
+    When
+)
 
 # Import forms and models from the current app
 from .forms import (
@@ -22,11 +36,13 @@ from .forms import (
     DoctorCommentForm
 )
 from .models import (
+    ChunkedUpload,
     UploadedImage,
     Doctor,
     Patient,
     MedicalRecord,
     DiagnosisRecord,
+    InferenceResult,
     PatientPost,
     PatientComment,
     DoctorPost,
@@ -35,14 +51,21 @@ from .models import (
 
 # Import os module for operating system related functionalities
 import os
+import logging
 
-# Import custom module for ONNX model inference
-from .onnx_inference import inference_resnet18sam
+# The inference modules (prediction_cache, onnx_inference, derivatives) pull in onnxruntime,
+# OpenCV and NumPy, so they are imported by the views that need them, keeping startup and
+# every other view free of those imports
+from .async_inference import InferenceQueueFull, busy_response, run_in_executor
+from .jobs import enqueue_inference
+from .downloads import serve_file
+from .uploads import UploadError, append_chunk, completed_upload, start_upload, upload_status
+from .profiles import get_doctor, get_patient
+from .dashboard import get_stats as get_dashboard_stats
+from .community import get_feed_page
+from .metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, registry as metrics_registry
 
-# Import necessary modules for image processing
-from PIL import Image
-import numpy as np
-import cv2 as cv
+logger = logging.getLogger(__name__)
 
 
 def index(request):
@@ -184,23 +207,74 @@ def password_reset_view(request):
 def upload(request):
     """
     Handles file upload requests.
+
+    Note:
+    Each image is stored once under its content hash (see storage.py) and recorded as an
+    UploadedImage. Large files should use the chunked upload endpoints below instead.
     """
     if request.method == 'POST' and request.FILES.get('file'):
-        # If request method is POST and a file is uploaded
-        uploaded_file = request.FILES['file']
-
-        # Handle file logic, simply save the file to the 'media' directory
-        with open('media/' + uploaded_file.name, 'wb+') as destination:
-            for chunk in uploaded_file.chunks():
-                destination.write(chunk)
+        # If request method is POST and files are uploaded
+        images = []
+        for uploaded_file in request.FILES.getlist('file'):
+            form = ImageUploadForm(files={'image': uploaded_file})
+            if not form.is_valid():
+                return JsonResponse({'status': 'error', 'message': f'{uploaded_file.name} is not a valid image.'},
+                                    status=400)
+            image = form.save()
+            images.append({'image_id': image.id, 'name': image.image.name})
 
         # Return success response if file upload is successful
-        return JsonResponse({'status': 'success'})
+        return JsonResponse({'status': 'success', 'images': images})
     else:
         # Return error response if no file is received
         return JsonResponse({'status': 'error', 'message': 'File not received.'})
 
 
+@login_required
+def chunked_upload_start(request):
+    """
+    Starts a resumable upload.
+
+    POST filename, size and target ('medical_record' or 'image'). The response carries the
+    upload_id, the offset to send from (0) and the suggested chunk_size.
+    """
+    if request.method != 'POST':
+        return JsonResponse({'status': 'error', 'message': 'POST required.'}, status=405)
+
+    try:
+        upload = start_upload(request.user, request.POST.get('filename'), request.POST.get('size'),
+                              request.POST.get('target', ChunkedUpload.TARGET_MEDICAL_RECORD))
+    except UploadError as e:
+        return JsonResponse({'status': 'error', 'message': str(e)}, status=e.status)
+    return JsonResponse(upload_status(upload), status=201)
+
+
+@login_required
+def chunked_upload(request, upload_id):
+    """
+    GET returns the progress of a resumable upload, so a client can resume from its offset.
+    PUT appends the request body, described by a 'Content-Range: bytes <first>-<last>/<size>'
+    header, at the current offset. The response to the last chunk has status 'complete' and
+    the name the image was stored under; pass its upload_id to the upload forms.
+    """
+    if request.method == 'GET':
+        upload = get_object_or_404(ChunkedUpload, id=upload_id, user=request.user)
+        return JsonResponse(upload_status(upload))
+
+    if request.method != 'PUT':
+        return JsonResponse({'status': 'error', 'message': 'GET or PUT required.'}, status=405)
+
+    try:
+        # the body is streamed into the partial file, never loaded into memory as a whole
+        upload = append_chunk(upload_id, request.user, request, request.headers.get('Content-Range'))
+    except UploadError as e:
+        response = {'status': 'error', 'message': str(e)}
+        if e.upload is not None:
+            response['offset'] = e.upload.offset
+        return JsonResponse(response, status=e.status)
+    return JsonResponse(upload_status(upload))
+
+
 @login_required
 def doctor_home(request):
     """
@@ -208,117 +282,123 @@ def doctor_home(request):
     """
     user = request.user  # Get the current user
 
-    # Get diagnosis records with diagnosis status 'No'
-    no_diagnosis_records = DiagnosisRecord.objects.filter(diagnosis_status='No')
+    # Counters are served from the cache, so the page costs the same however many records exist
+    stats = get_dashboard_stats()
 
-    print(f"no diagnosis patients:{no_diagnosis_records}")  # Print number of patients without diagnosis
+    return render(request, 'doctor/doctor_home.html',
+                  {'user': user, 'num_patients': stats['pending'], 'stats': stats})
 
-    # Count the number of patients without diagnosis
-    patients_with_no_diagnosis = len([record.patient for record in no_diagnosis_records])
 
-    return render(request, 'doctor/doctor_home.html', {'user': user, 'num_patients': patients_with_no_diagnosis})
+# Number of patients shown per page of the doctor's records
+RECORDS_PAGE_SIZE = 50
 
 
 # Display each medical record uploaded by patients
 def doctor_records(request):
     """
     Renders the doctor's records page, displaying medical records uploaded by patients.
+
+    Note:
+    Each patient is annotated with their latest medical record and latest diagnosis record
+    through subqueries, the search criteria are applied in SQL, and the list is paginated by
+    patient id (?before=<id>), so a page costs a constant number of queries.
     """
     # Get search criteria
     search_diagnosis_result = request.GET.get('search_diagnosis_result', 'All')
     search_diagnosis_status = request.GET.get('search_diagnosis_status', 'None')
     search_controversy_status = request.GET.get('search_controversy_status', 'None')
 
-    # Print search criteria
-    print(f"Search keyword for diagnosis_result: {search_diagnosis_result}")
-    print(f"Search keyword for diagnosis_status: {search_diagnosis_status}")
-    print(f"Search keyword for controversy_status: {search_controversy_status}")
-
-    # Get patient and diagnosis record information
-    patients = Patient.objects.all()
-    diagnosis_records = DiagnosisRecord.objects.select_related('patient').all()
-
-    # Print patient information
-    # patients_to_delete = Patient.objects.filter(name='TestDoctorUser1')
-    # patients_to_delete.delete()
-    print(f"Patients information: {patients}")
-
-    # Merge data
-    merged_data = []
-    for patient in patients:
-        medical_record = patient.medical_records.first()
-
-        # Check if diagnosis record exists
-        diagnosis_record = diagnosis_records.filter(patient=patient).first()
-
-        diagnosis_status = 'No'
-        diagnosis_result = None
-        diagnosis_time = None
-        diagnostician = None
-        controversy_status = None
-
-        # Create diagnosis record if it doesn't exist
-        if not diagnosis_record:
-            diagnosis_record = DiagnosisRecord(patient=patient, diagnosis_status='No',
-                                               diagnosis_result=None, diagnosis_time=None,
-                                               diagnostician=None, controversy_status=None)
-            diagnosis_record.save()
-        else:
-            if diagnosis_record.diagnosis_status == 'Yes':
-                diagnosis_status = 'Yes'
-                diagnosis_result = diagnosis_record.diagnosis_result
-                diagnosis_time = diagnosis_record.diagnosis_time
-                diagnostician = diagnosis_record.diagnostician
-                controversy_status = diagnosis_record.controversy_status
-
-        # Append merged data
-        merged_data.append(
-            {'patient': patient, 'medical_record': medical_record, 'diagnosis_status': diagnosis_status,
-             'diagnosis_result': diagnosis_result, 'diagnosis_time': diagnosis_time, 'diagnostician': diagnostician,
-             'controversy_status': controversy_status})
-
-    # Filter data based on diagnosis result search criteria
+    # Latest medical record and latest diagnosis record of each patient
+    latest_record = MedicalRecord.objects.filter(patient=OuterRef('pk')).order_by('-upload_time', '-id')
+    latest_diagnosis = DiagnosisRecord.objects.filter(patient=OuterRef('pk')).order_by('-created_at', '-id')
+
+    # Diagnosis details are only shown once the diagnosis has been made
+    diagnosed = Q(latest_diagnosis_status='Yes')
+    patients = Patient.objects.annotate(
+        medical_record_id=Subquery(latest_record.values('id')[:1]),
+        pulmonary_image=Subquery(latest_record.values('pulmonary_image')[:1]),
+        upload_time=Subquery(latest_record.values('upload_time')[:1]),
+        latest_diagnosis_status=Subquery(latest_diagnosis.values('diagnosis_status')[:1]),
+    ).annotate(
+        diagnosis_status=Case(When(diagnosed, then=Value('Yes')), default=Value('No'), output_field=CharField()),
+        diagnosis_result=Case(When(diagnosed, then=Subquery(latest_diagnosis.values('diagnosis_result')[:1])),
+                              default=None, output_field=TextField()),
+        diagnosis_time=Case(When(diagnosed, then=Subquery(latest_diagnosis.values('diagnosis_time')[:1])),
+                            default=None, output_field=DateTimeField()),
+        diagnostician=Case(When(diagnosed, then=Subquery(latest_diagnosis.values('diagnostician')[:1])),
+                           default=None, output_field=CharField()),
+        controversy_status=Case(When(diagnosed, then=Subquery(latest_diagnosis.values('controversy_status')[:1])),
+                                default=None, output_field=BooleanField()),
+    )
+
+    # Filter data based on the search criteria
     if search_diagnosis_result in ['Normal', 'Pneumonia']:
-        filtered_data = [data for data in merged_data if data['diagnosis_result'] == search_diagnosis_result]
-    else:
-        filtered_data = merged_data
-
-    # Filter data based on diagnosis status search criteria
-    if search_diagnosis_status != 'None':
-        filtered_data = [data for data in filtered_data if data['diagnosis_status'] == search_diagnosis_status]
-
-    # Filter data based on controversy status search criteria
-    if search_controversy_status != 'None':
-        filtered_data = [data for data in filtered_data if str(data['controversy_status']) == search_controversy_status]
-
-    return render(request, 'doctor/doctor_records.html', {'merged_data': filtered_data})
-
-
-def diagnose_patient(request, patient_id, record_id):
+        patients = patients.filter(diagnosis_result=search_diagnosis_result)
+    if search_diagnosis_status in ['Yes', 'No']:
+        patients = patients.filter(diagnosis_status=search_diagnosis_status)
+    if search_controversy_status in ['True', 'False']:
+        patients = patients.filter(controversy_status=search_controversy_status == 'True')
+
+    # Keyset pagination, newest patients first
+    before = request.GET.get('before')
+    if before and before.isdigit():
+        patients = patients.filter(id__lt=int(before))
+    page = list(patients.order_by('-id')[:RECORDS_PAGE_SIZE + 1])
+
+    # Links to the next and first page keep the search criteria
+    query = request.GET.copy()
+    query.pop('before', None)
+    first_page = query.urlencode() if before else None
+
+    next_page = None
+    if len(page) > RECORDS_PAGE_SIZE:
+        page = page[:RECORDS_PAGE_SIZE]
+        query['before'] = page[-1].id
+        next_page = query.urlencode()
+
+    return render(request, 'doctor/doctor_records.html',
+                  {'merged_data': page, 'first_page': first_page, 'next_page': next_page})
+
+
+async def diagnose_patient(request, patient_id, record_id):
     """
     Renders the page to diagnose a patient based on their medical record.
+
+    Note:
+    Inference runs on the bounded executor (see async_inference.py), so the worker keeps
+    serving other requests meanwhile. Answers 503 with Retry-After when the executor is full.
     """
+    from .feature_store import record_inference
+    from .onnx_inference import model_registry
+
     # Get the patient, medical record, and diagnosis record
-    patient = get_object_or_404(Patient, id=patient_id)
-    medical_record = MedicalRecord.objects.filter(patient=patient)
+    patient = await sync_to_async(get_object_or_404)(Patient, id=patient_id)
     diagnosis_record = DiagnosisRecord.objects.filter(patient=patient)
 
-    print("Patient's medical record information retrieved!")
+    logger.debug('Medical records of patient %s retrieved', patient_id)
 
     # Get the current medical record
-    current_medical_record = get_object_or_404(MedicalRecord, id=record_id)
+    current_medical_record = await sync_to_async(get_object_or_404)(
+        MedicalRecord.objects.select_related('stored_features'), id=record_id)
 
     if current_medical_record:
-        image_path = current_medical_record.pulmonary_image.path
-        # Open the original image
-        original_image = np.array(Image.open(image_path))
-
-        # Convert to grayscale if necessary
-        if len(original_image.shape) == 3:
-            original_image = cv.cvtColor(original_image, cv.COLOR_RGB2GRAY)
-
-        # Perform inference using the model
-        inference_time, inference_result, inference_probabilities = inference_resnet18sam(original_image)
+        try:
+            # Use the result precomputed at upload time if it was produced by the current model
+            version = await run_in_executor(model_registry.get_version)
+            precomputed = await InferenceResult.objects.filter(medical_record=current_medical_record,
+                                                               status=InferenceResult.STATUS_DONE,
+                                                               model_version=version).afirst()
+            if precomputed:
+                inference_time = precomputed.inference_time
+                inference_result = precomputed.result
+                inference_probabilities = precomputed.get_probabilities()
+            else:
+                # Perform inference using the model, reusing the cached prediction for this image if any
+                # and starting from the preprocessed copy in the feature store instead of decoding
+                inference_time, inference_result, inference_probabilities = await run_in_executor(
+                    record_inference, current_medical_record)
+        except InferenceQueueFull:
+            return busy_response()
 
         # Control button visibility
         upload_success = True
@@ -332,13 +412,16 @@ def diagnose_patient(request, patient_id, record_id):
         }
 
         # Render the page with patient, medical record, diagnosis record, and inference results
-        return render(request, 'doctor/diagnose_patient.html', {
+        return await sync_to_async(render)(request, 'doctor/diagnose_patient.html', {
             'patient': patient,
             'current_medical_record': current_medical_record,
             'diagnosis_record': diagnosis_record,
             'context': context,
         })
 
+    # Redirect to the doctor's records page after deletion
+    return redirect('doctor_records')
+
 
 def save_diagnosis(request, patient_id, record_id):
     """
@@ -348,9 +431,10 @@ def save_diagnosis(request, patient_id, record_id):
         # Get the patient
         patient = get_object_or_404(Patient, id=patient_id)
 
-        # Get the diagnosis record for the patient
+        # Get the diagnosis record for the patient, creating it if the patient has none yet
         diagnosis_record = DiagnosisRecord.objects.filter(patient=patient).first()
-        print(f'diagnosis_record:{diagnosis_record}')
+        if diagnosis_record is None:
+            diagnosis_record = DiagnosisRecord(patient=patient)
 
         # Update diagnosis record information
         diagnosis_record.diagnosis_status = 'Yes'
@@ -379,7 +463,7 @@ def delete_diagnosis_record(request, record_id):
     """
     Deletes the diagnosis record identified by the given record_id.
     """
-    print("Deleting DiagnosisRecord with record_id:", record_id)
+    logger.info('Deleting DiagnosisRecord %s', record_id)
 
     # Get the diagnosis record by its ID
     diagnosis_record = get_object_or_404(DiagnosisRecord, id=record_id)
@@ -391,74 +475,91 @@ def delete_diagnosis_record(request, record_id):
     return redirect('doctor_records')
 
 
-def doctor_analyze(request):
+def _analyze_image(path, spec):
+    from .derivatives import ensure_derivatives
+    from .prediction_cache import cached_inference
+
+    # Create the thumbnails and the model-ready copy the inference below runs on
+    ensure_derivatives(path)
+    # Perform inference using the model, reusing the cached prediction for this image if any
+    return cached_inference(path, model=spec)
+
+
+async def doctor_analyze(request):
     """
     Handles image analysis by the doctor.
+
+    Note:
+    Decoding and inference run on the bounded executor (see async_inference.py), so the worker
+    keeps serving other requests meanwhile. Answers 503 with Retry-After when the executor is full.
+    The optional 'model' field picks one of settings.INFERENCE_MODELS.
     """
+    from .onnx_inference import UnknownModel, get_model_spec
+
+    # Models the doctor can choose from
+    models = list(settings.INFERENCE_MODELS)
+
     if request.method == 'POST':
+        try:
+            spec = get_model_spec(request.POST.get('model') or None)
+        except UnknownModel as e:
+            return HttpResponse(str(e), status=400)
+
         # If request method is POST, process the form data
         form = ImageUploadForm(request.POST, request.FILES)
-        if form.is_valid():
+
+        # The image either comes with the form or was sent before as a chunked upload
+        upload = await sync_to_async(completed_upload)(request.user, request.POST.get('upload_id'),
+                                                       ChunkedUpload.TARGET_IMAGE)
+        latest_image = None
+        if upload:
+            latest_image = await UploadedImage.objects.acreate(image=upload.stored_name)
+            image_name = upload.filename
+        elif await sync_to_async(form.is_valid)():
             # Save the form data
-            form.save()
-
-            # Query the latest uploaded image
-            latest_image = UploadedImage.objects.filter(image__isnull=False).order_by('-id').first()
-            # print("image name:", latest_image.image.name)
-            if latest_image:
-                # Open the original image
-                original_image = np.array(Image.open(latest_image.image.path))
-
-                # Convert to grayscale if necessary
-                if len(original_image.shape) == 3:
-                    original_image = cv.cvtColor(original_image, cv.COLOR_RGB2GRAY)
-
-                # Perform inference using the model
-                inference_time, inference_result, inference_probabilities = inference_resnet18sam(original_image)
-                # print(inference_probabilities)
-
-                # Control button visibility
-                upload_success = True
-
-                # Add image name, inference time, and result to the context dictionary
-                context = {
-                    'image_name': latest_image.image.name.split("/")[1],
-                    'latest_image': latest_image,
-                    'inference_time': inference_time,
-                    'inference_result': inference_result,
-                    'upload_success': upload_success,
-                    'inference_probabilities': inference_probabilities,
-                }
-
-                # Render the page with image analysis results
-                return render(request, 'doctor/doctor_analyze.html', context)
+            latest_image = await sync_to_async(form.save)()
+            image_name = request.FILES['image'].name
+
+        if latest_image:
+            try:
+                inference_time, inference_result, inference_probabilities = await run_in_executor(
+                    _analyze_image, latest_image.image.path, spec)
+            except InferenceQueueFull:
+                return busy_response()
+
+            # Control button visibility
+            upload_success = True
+
+            # Add image name, inference time, and result to the context dictionary
+            context = {
+                'image_name': image_name,
+                'model': spec.name,
+                'latest_image': latest_image,
+                'inference_time': inference_time,
+                'inference_result': inference_result,
+                'upload_success': upload_success,
+                'inference_probabilities': inference_probabilities,
+            }
+
+            # Render the page with image analysis results
+            return await sync_to_async(render)(request, 'doctor/doctor_analyze.html', context)
     else:
         # If request method is not POST, display the form
         form = ImageUploadForm()
 
-    return render(request, 'doctor/doctor_analyze.html', {'form': form})
+    return await sync_to_async(render)(request, 'doctor/doctor_analyze.html', {'form': form, 'models': models})
 
 
-@login_required
 def doctor_community(request):
     """
     Renders the doctor's community page.
     """
-    # Get the username of the currently logged-in user
-    username = request.user.username
-
     # Check if the current user has filled out basic information; if not, display a warning to complete the profile
-    try:
-        # Get doctor instance for the logged-in user
-        doctor = Doctor.objects.get(name=username)
-        # print(f"Get doctor information: {doctor}")
-    except Doctor.DoesNotExist:
+    doctor = get_doctor(request)
+    if doctor is None:
         # If the doctor instance does not exist, return a message prompting to complete personal information
         return HttpResponse('Please complete your personal information!')
 
-    # Get all posts in the community, ordered by creation time
-    posts = DoctorPost.objects.all().order_by('-created_at')
-
     # Handle the form for posting new messages in the community
     if request.method == 'POST':
         post_form = DoctorPostForm(request.POST)
@@ -471,9 +572,15 @@ def doctor_community(request):
     else:
         post_form = DoctorPostForm()
 
+    # Get one page of posts (newest first), with their author and number of comments
+    before = request.GET.get('before')
+    posts, next_before = get_feed_page('doctor', int(before) if before and before.isdigit() else None)
+
     # Render the doctor's community page with posts and post form
     return render(request, 'doctor/doctor_community.html',
-                  {'posts': posts, 'doctor': doctor, 'post_form': post_form})
+                  {'posts': posts, 'doctor': doctor, 'post_form': post_form,
+                   'first_page': '' if before else None,
+                   'next_page': urlencode({'before': next_before}) if next_before else None})
 
 
 def doctor_help(request):
@@ -490,14 +597,9 @@ def patient_home(request):
     # Get the current logged-in user
     user = request.user
 
-    # Retrieve diagnosis records related to the current user
-    diagnosis_records = DiagnosisRecord.objects.filter(patient__name=user.username)
-
     # Initialize diagnosis status variable
     diagnosis_status = None
 
-    # print(diagnosis_status)
-
     return render(request, 'patient/patient_home.html', {'user': user, 'diagnosis_status': diagnosis_status})
 
 
@@ -511,13 +613,18 @@ def patient_basic_info_upload(request):
             # Extract data from the form
             patient_name = form.cleaned_data['name']
 
-            # Check if patient exists, otherwise create a new patient object
-            try:
-                patient = Patient.objects.get(name=patient_name)
-            except Patient.DoesNotExist:
+            # Use the user's profile (or the unlinked one named after their username), otherwise create one.
+            # Other unlinked profiles are linked by `python manage.py link_profiles`, never by a typed name.
+            patient = get_patient(request)
+            if patient is None:
                 patient = Patient(name=patient_name)
 
+            # Link the profile to the logged-in user
+            if request.user.is_authenticated:
+                patient.user = request.user
+
             # Update patient object fields with form data
+            patient.name = patient_name
             patient.gender = form.cleaned_data['gender']
             patient.age = form.cleaned_data['age']
             patient.marital_status = form.cleaned_data['marital_status']
@@ -554,12 +661,19 @@ def doctor_basic_info_upload(request):
         form = DoctorBasicInfoForm(request.POST)
         if form.is_valid():
             doctor_name = form.cleaned_data['name']
-            try:
-                doctor = Doctor.objects.get(name=doctor_name)
-            except Doctor.DoesNotExist:
+
+            # Use the user's profile (or the unlinked one named after their username), otherwise create one.
+            # Other unlinked profiles are linked by `python manage.py link_profiles`, never by a typed name.
+            doctor = get_doctor(request)
+            if doctor is None:
                 doctor = Doctor(name=doctor_name)
 
+            # Link the profile to the logged-in user
+            if request.user.is_authenticated:
+                doctor.user = request.user
+
             # Update doctor object fields
+            doctor.name = doctor_name
             doctor.gender = form.cleaned_data['gender']
             doctor.age = form.cleaned_data['age']
             doctor.marital_status = form.cleaned_data['marital_status']
@@ -590,13 +704,9 @@ def patient_medical_history_upload(request):
     """
     Renders the page for uploading patient medical history.
     """
-    # Get the username of the current logged-in user
-    username = request.user.username
-
-    try:
-        # Get the patient instance if the user has completed personal information
-        patient_instance = Patient.objects.get(name=username)
-    except Patient.DoesNotExist:
+    # Get the patient instance if the user has completed personal information
+    patient_instance = get_patient(request)
+    if patient_instance is None:
         return HttpResponse('Please complete your personal information!')
 
     if request.method == 'POST':
@@ -610,18 +720,33 @@ def patient_medical_history_upload(request):
         image_form = ImageUploadForm(request.POST, request.FILES)
         medical_form = PatientMedicalHistoryForm(request.POST)
 
+        # The image may also have been sent before as a chunked upload
+        upload = completed_upload(request.user, request.POST.get('upload_id'), ChunkedUpload.TARGET_MEDICAL_RECORD)
+
         # Check if both forms exist
-        if image_file and medical_history and symptoms and other:
+        if (image_file or upload) and medical_history and symptoms and other:
             # Create a new medical record
             new_medical_record = MedicalRecord(patient=patient_instance)
 
-            if image_form.is_valid() and medical_form.is_valid():
-                new_medical_record.pulmonary_image = image_form.cleaned_data['image']
+            if (upload or image_form.is_valid()) and medical_form.is_valid():
+                if upload:
+                    new_medical_record.pulmonary_image = upload.stored_name
+                    new_medical_record.image_name = upload.filename
+                else:
+                    new_medical_record.pulmonary_image = image_form.cleaned_data['image']
+                    new_medical_record.image_name = image_file.name
                 new_medical_record.medical_history = medical_form.cleaned_data['medical_history']
                 new_medical_record.symptoms = medical_form.cleaned_data['symptoms']
                 new_medical_record.other = medical_form.cleaned_data['other']
                 # Save the patient instance to the database
                 new_medical_record.save()
+
+                # Make sure the patient shows up as awaiting diagnosis
+                if not DiagnosisRecord.objects.filter(patient=patient_instance).exists():
+                    DiagnosisRecord.objects.create(patient=patient_instance, diagnosis_status='No')
+
+                # Precompute the prediction in the background so the doctor's page renders instantly
+                enqueue_inference(new_medical_record)
                 return HttpResponse("Success")
 
     else:
@@ -644,25 +769,16 @@ def patient_history(request):
     Returns:
         Rendered HttpResponse object representing the patient's history page.
     """
-    # Get the username of the current logged-in user
-    username = request.user.username
+    # Get the patient profile of the current logged-in user
+    patient = get_patient(request)
 
     try:
         # Query the basic and diagnosis records of the patient
-        patient_basic_records = MedicalRecord.objects.filter(patient__name=username)
-        patient_diagnosis_records = DiagnosisRecord.objects.filter(patient__name=username)
+        patient_basic_records = MedicalRecord.objects.filter(patient=patient).select_related('patient')
+        patient_diagnosis_record = DiagnosisRecord.objects.filter(patient=patient).first()
 
-        # Check if there are any diagnosis records
-        if patient_diagnosis_records.first() is not None:
-            # Try to get the diagnosis status
-            try:
-                patient_diagnosis_status = patient_diagnosis_records.first().diagnosis_status
-            except AttributeError:
-                # Set diagnosis status to None if there's an exception (NoneType has no attribute 'diagnosis_status')
-                patient_diagnosis_status = None
-        else:
-            # Set diagnosis status to None if there are no diagnosis records
-            patient_diagnosis_status = None
+        # Set diagnosis status to None if there are no diagnosis records
+        patient_diagnosis_status = patient_diagnosis_record.diagnosis_status if patient_diagnosis_record else None
 
         # Compile the records
         records = {'patient_basic_records': patient_basic_records,
@@ -680,17 +796,35 @@ def download_image(request, filename):
     Downloads an image file.
     """
     # Build the file path
-    file_path = os.path.join(settings.MEDIA_ROOT, 'pulmonary_images', filename)
+    name = os.path.basename(filename)
+    file_path = os.path.join(settings.MEDIA_ROOT, 'pulmonary_images', name)
 
-    # Open the file and create an HttpResponse object
-    with open(file_path, 'rb') as file:
-        response = HttpResponse(file.read(),
-                                content_type='image/png')  # Adjust content_type according to the actual file type
+    # Files are stored under their content hash: download them under the name they were uploaded with,
+    # the requesting patient's own record first since identical uploads share the file
+    records = MedicalRecord.objects.filter(pulmonary_image=f'pulmonary_images/{name}').exclude(image_name='')
+    patient = get_patient(request)
+    record = (patient and records.filter(patient=patient).first()) or records.first()
 
-    # Set the file name and add download headers
-    response['Content-Disposition'] = f'attachment; filename={filename}'
+    # Stream the file with caching headers and Range support
+    return serve_file(request, file_path, filename=record.image_name if record else None, as_attachment=True)
 
-    return response
+
+# Serves a thumbnail or model-ready copy of an uploaded image.
+def image_derivative(request, kind, name):
+    """
+    Serves a derivative of an uploaded image, (re)creating it if it is missing or out of date.
+    """
+    from .derivatives import DERIVATIVES, get_derivative, source_path
+
+    if kind not in DERIVATIVES:
+        raise Http404('Unknown derivative')
+
+    try:
+        path = get_derivative(source_path(name), kind)
+    except (ValueError, FileNotFoundError):
+        raise Http404('Image not found')
+
+    return serve_file(request, path)
 
 
 # Handles the deletion of medical records.
@@ -703,13 +837,12 @@ def delete_record(request, record_id):
         record = MedicalRecord.objects.get(id=record_id)
         record.delete()
 
-        # Also delete associated patient and diagnosis records
-        patient_record = Patient.objects.get(name=request.user.username)
+        # Also delete associated patient and diagnosis records (deleting the patient cascades to them)
+        patient_record = get_patient(request)
+        if patient_record is None:
+            raise Patient.DoesNotExist('Patient matching query does not exist.')
         patient_record.delete()
 
-        diagnose_record = DiagnosisRecord.objects.get(patient__name=request.user.username)
-        diagnose_record.delete()
-
         return JsonResponse({'success': True})
     except MedicalRecord.DoesNotExist:
         return JsonResponse({'success': False, 'error': 'Record not found'})
@@ -722,10 +855,11 @@ def patient_detailed_info(request):
     """
     Renders the detailed information page of a patient's medical records.
     """
-    username = request.user.username
-    patient = get_object_or_404(Patient, name=username)
-    basic_records = MedicalRecord.objects.filter(patient__name=username).order_by('-upload_time')[:1]
-    diagnosis_records = DiagnosisRecord.objects.filter(patient__name=username)
+    patient = get_patient(request)
+    if patient is None:
+        raise Http404('No Patient matches the given query.')
+    basic_records = MedicalRecord.objects.filter(patient=patient).order_by('-upload_time')[:1]
+    diagnosis_records = DiagnosisRecord.objects.filter(patient=patient)
 
     return render(request, 'patient/patient_detailed_info.html',
                   {'patient': patient, 'basic_records': basic_records, 'diagnosis_records': diagnosis_records})
@@ -737,19 +871,11 @@ def patient_community(request):
     """
     Renders the patient community page.
     """
-    # Get the username of the current logged-in user
-    username = request.user.username
-
     # Check if the current user has filled in their basic information, display warning if not
-    try:
-        # Get the patient instance
-        patient = Patient.objects.get(name=username)
-    except Patient.DoesNotExist:
+    patient = get_patient(request)
+    if patient is None:
         return HttpResponse('Please complete your personal information!')
 
-    # Get all posts in the patient community
-    posts = PatientPost.objects.all().order_by('-created_at')
-
     # Handle form for submitting new posts
     if request.method == 'POST':
         post_form = PatientPostForm(request.POST)
@@ -762,8 +888,14 @@ def patient_community(request):
     else:
         post_form = PatientPostForm()
 
+    # Get one page of posts (newest first), with their author and number of comments
+    before = request.GET.get('before')
+    posts, next_before = get_feed_page('patient', int(before) if before and before.isdigit() else None)
+
     return render(request, 'patient/patient_community.html',
-                  {'posts': posts, 'patient': patient, 'post_form': post_form})
+                  {'posts': posts, 'patient': patient, 'post_form': post_form,
+                   'first_page': '' if before else None,
+                   'next_page': urlencode({'before': next_before}) if next_before else None})
 
 
 # Deletes a post from the patient community.
@@ -774,7 +906,8 @@ def delete_patient_post(request, post_id):
     post = get_object_or_404(PatientPost, id=post_id)
 
     # Check user permissions to ensure only the author can delete the post
-    if request.user.username == post.patient.name:
+    patient = get_patient(request)
+    if patient is not None and post.patient_id == patient.id:
         post.delete()
 
     # Redirect to the patient community page or other appropriate page
@@ -789,7 +922,8 @@ def delete_doctor_post(request, post_id):
     post = get_object_or_404(DoctorPost, id=post_id)
 
     # Check user permissions to ensure only the author can delete the post
-    if request.user.username == post.doctor.name:
+    doctor = get_doctor(request)
+    if doctor is not None and post.doctor_id == doctor.id:
         post.delete()
 
     # Redirect to the community page or other appropriate page
@@ -803,13 +937,15 @@ def view_patient_comments(request, post_id):
     Renders the view for patient post comments in the patient community.
     """
     # Get the post object
-    post = get_object_or_404(PatientPost, id=post_id)
+    post = get_object_or_404(PatientPost.objects.select_related('patient'), id=post_id)
 
     # Get the patient object corresponding to the current logged-in user
-    patient = Patient.objects.get(name=request.user)
+    patient = get_patient(request)
+    if patient is None:
+        return HttpResponse('Please complete your personal information!')
 
     # Get all comments for the post
-    comments = PatientComment.objects.filter(post=post).order_by('-created_at')
+    comments = PatientComment.objects.filter(post=post).select_related('patient').order_by('-created_at')
 
     # Handle comment submission form
     if request.method == 'POST':
@@ -836,7 +972,8 @@ def delete_patient_comment(request, comment_id, post_id):
     comment = get_object_or_404(PatientComment, id=comment_id)
 
     # In a real-world project, there might be permission checks to ensure only the comment author or administrators can delete comments
-    if request.user.username == comment.patient.name:
+    patient = get_patient(request)
+    if patient is not None and comment.patient_id == patient.id:
         # Perform the deletion operation
         comment.delete()
 
@@ -850,13 +987,15 @@ def view_doctor_comments(request, post_id):
     Renders the view for doctor post comments in the doctor community.
     """
     # Get the post object
-    post = get_object_or_404(DoctorPost, id=post_id)
+    post = get_object_or_404(DoctorPost.objects.select_related('doctor'), id=post_id)
 
-    # Get the patient object corresponding to the current logged-in user
-    doctor = Doctor.objects.get(name=request.user)
+    # Get the doctor object corresponding to the current logged-in user
+    doctor = get_doctor(request)
+    if doctor is None:
+        return HttpResponse('Please complete your personal information!')
 
     # Get all comments for the post
-    comments = DoctorComment.objects.filter(post=post).order_by('-created_at')
+    comments = DoctorComment.objects.filter(post=post).select_related('doctor').order_by('-created_at')
 
     # Handle comment submission form
     if request.method == 'POST':
@@ -864,7 +1003,7 @@ def view_doctor_comments(request, post_id):
         if comment_form.is_valid():
             new_comment = comment_form.save(commit=False)
             new_comment.post = post
-            new_comment.patient = doctor
+            new_comment.doctor = doctor
             new_comment.save()
             return redirect('view_doctor_comments', post_id=post_id)
     else:
@@ -883,7 +1022,8 @@ def delete_doctor_comment(request, comment_id, post_id):
     comment = get_object_or_404(DoctorComment, id=comment_id)
 
     # In a real-world project, there might be permission checks to ensure only the comment author or administrators can delete comments
-    if request.user.username == comment.doctor.name:
+    doctor = get_doctor(request)
+    if doctor is not None and comment.doctor_id == doctor.id:
         # Perform the deletion operation
         comment.delete()
 
@@ -895,3 +1035,15 @@ def patient_help(request):
     Renders the patient's help page. Needs improvement.
     """
     return render(request, 'patient/patient_help.html')
+
+
+# Serves the metrics of this process to a local Prometheus scraper.
+def metrics(request):
+    """
+    Returns the request, database and inference metrics in the Prometheus text format.
+
+    Only clients listed in settings.METRICS_ALLOWED_IPS may read them.
+    """
+    if request.META.get('REMOTE_ADDR') not in settings.METRICS_ALLOWED_IPS:
+        return HttpResponse('Forbidden', status=403)
+    return HttpResponse(metrics_registry.render(), content_type=METRICS_CONTENT_TYPE)
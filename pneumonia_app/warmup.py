@@ -0,0 +1,97 @@
+from time import perf_counter
+import logging
+import os
+import sys
+import threading
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+WARMUP_MODES = ('off', 'sync', 'background')
+
+_thread = None
+
+
+def warm_up(models=None):
+    """
+    Loads models and runs each once on a blank image, so the first request finds everything ready.
+
+    Besides the session build this imports onnxruntime, OpenCV and NumPy, creates the
+    batcher thread and the input buffers and lets onnxruntime make its first-run allocations.
+
+    Args:
+        models: Names in settings.INFERENCE_MODELS, default the default model and
+            settings.INFERENCE_SHADOW_MODEL (if set).
+
+    Returns:
+        {model name: {'load_time', 'run_time'}} in milliseconds.
+    """
+    start_time = perf_counter()
+    import numpy as np
+
+    from . import prediction_cache  # noqa: F401, imports the rest of the inference stack
+    from .onnx_inference import get_model_spec, inference_resnet18sam, model_registry
+    import_time = 1000. * (perf_counter() - start_time)
+
+    if models is None:
+        models = [settings.INFERENCE_DEFAULT_MODEL]
+        if settings.INFERENCE_SHADOW_MODEL and settings.INFERENCE_SHADOW_MODEL not in models:
+            models.append(settings.INFERENCE_SHADOW_MODEL)
+
+    timings = {}
+    for name in models:
+        spec = get_model_spec(name)
+
+        start_time = perf_counter()
+        model_registry.get_session(spec.path)
+        load_time = 1000. * (perf_counter() - start_time)
+
+        start_time = perf_counter()
+        inference_resnet18sam(np.zeros((spec.image_size, spec.image_size), dtype=np.uint8), model=spec)
+        run_time = 1000. * (perf_counter() - start_time)
+
+        timings[spec.name] = {'load_time': load_time, 'run_time': run_time}
+        logger.info('Warmed up %s: load %.1f ms, first run %.1f ms', spec.name, load_time, run_time)
+
+    logger.info('Warm-up done in %.1f ms (imports %.1f ms)',
+                import_time + sum(t['load_time'] + t['run_time'] for t in timings.values()), import_time)
+    return timings
+
+
+def _safe_warm_up():
+    # a missing or broken model must not keep the process from starting, requests report the error
+    try:
+        warm_up()
+    except Exception:
+        logger.exception('Warm-up failed')
+
+
+def is_reloader_parent():
+    # `runserver` with the autoreloader runs ready() in a parent process that never serves requests
+    return 'runserver' in sys.argv and '--noreload' not in sys.argv and os.environ.get('RUN_MAIN') != 'true'
+
+
+def start_warmup(mode=None):
+    """
+    Starts the warm-up configured by settings.INFERENCE_WARMUP, called from AppConfig.ready().
+
+    Returns:
+        The warm-up thread in 'background' mode, else None.
+    """
+    global _thread
+
+    mode = settings.INFERENCE_WARMUP if mode is None else mode
+    if mode not in WARMUP_MODES:
+        logger.warning('Unknown INFERENCE_WARMUP %r, expected one of %s', mode, ', '.join(WARMUP_MODES))
+        return None
+    if mode == 'off' or is_reloader_parent():
+        return None
+
+    if mode == 'sync':
+        _safe_warm_up()
+        return None
+
+    _thread = threading.Thread(target=_safe_warm_up, name='inference-warmup', daemon=True)
+    _thread.start()
+    return _thread